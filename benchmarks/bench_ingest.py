@@ -0,0 +1,102 @@
+"""
+Ingest benchmark: today's double read_csv_auto path vs the single-pass ingest profile.
+
+Generates a wide synthetic CUR export (100+ columns, only six of which the models use)
+and loads it both ways into fresh on-disk warehouses.
+
+    python benchmarks/bench_ingest.py --size-gb 4 --columns 120
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import duckdb
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from src.analyze_costs import CloudBillHunter
+
+MODEL_COLUMNS = {
+    "lineItem/UsageStartDate": "TIMESTAMP '2023-01-01' + INTERVAL (i % 2160) HOUR",
+    "lineItem/ResourceId": "'i-' || (i % 50000)::VARCHAR",
+    "lineItem/ProductCode": "['AmazonEC2', 'AmazonRDS', 'AmazonS3', 'AWSLambda'][1 + i % 4]",
+    "lineItem/UsageAmount": "CASE WHEN i % 20 = 0 THEN 0 ELSE (i % 24) + 0.5 END",
+    "lineItem/UnblendedCost": "round((i % 997) / 100.0, 4)",
+    "resourceTags/user:Owner": "['engineering', 'data-science', 'marketing', NULL][1 + i % 4]",
+}
+
+def _filler(n):
+    """CUR-like padding: ids, prices and free text the models never read"""
+    kinds = ["'arn:aws:ec2:us-east-1:' || (i * {k})::VARCHAR", "round(i * 0.0{k}, 6)", "'OnDemand-{k}'"]
+    return {f"product/attr{k:03d}": kinds[k % 3].format(k=k + 1) for k in range(n)}
+
+def generate_wide_cur(path, size_gb, total_columns):
+    """Writes a CUR-shaped CSV of roughly size_gb with DuckDB (fast, bounded memory)"""
+    columns = {"identity/LineItemId": "md5(i::VARCHAR)"}
+    columns.update(MODEL_COLUMNS)
+    columns.update(_filler(max(total_columns - len(columns), 0)))
+    select = ", ".join(f'{expr} AS "{name}"' for name, expr in columns.items())
+
+    # Size a sample first, then scale the row count to the requested file size
+    sample = path + ".sample"
+    duckdb.execute(f"COPY (SELECT {select} FROM range(10000) t(i)) TO '{sample}' (HEADER)")
+    rows = int(size_gb * 1024 ** 3 / (os.path.getsize(sample) / 10000))
+    os.remove(sample)
+
+    print(f"🎲 Generating {rows:,} rows x {len(columns)} columns (~{size_gb} GB) -> {path}")
+    duckdb.execute(f"COPY (SELECT {select} FROM range({rows}) t(i)) TO '{path}' (HEADER)")
+    return rows
+
+def legacy_ingest(db_path, csv_path):
+    """The pre-profile path: sniff + parse the whole file twice, keep every column"""
+    con = duckdb.connect(db_path)
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS bronze_billing AS SELECT * FROM read_csv_auto('{csv_path}') WHERE 1=0;
+        INSERT INTO bronze_billing SELECT * FROM read_csv_auto('{csv_path}');
+    """)
+    con.close()
+
+def profile_ingest(db_path, csv_path):
+    engine = CloudBillHunter(db_path=db_path)
+    try:
+        engine.ingest_data(csv_path)
+    finally:
+        engine.close()
+
+def run(size_gb, total_columns, workdir):
+    csv_path = os.path.join(workdir, "wide_cur.csv")
+    generate_wide_cur(csv_path, size_gb, total_columns)
+    csv_bytes = os.path.getsize(csv_path)
+
+    results = {}
+    for name, ingest in (("legacy (read_csv_auto x2)", legacy_ingest), ("ingest profile", profile_ingest)):
+        db_path = os.path.join(workdir, f"{name.split()[0]}.duckdb")
+        start = time.perf_counter()
+        ingest(db_path, csv_path)
+        elapsed = time.perf_counter() - start
+        results[name] = (elapsed, os.path.getsize(db_path))
+
+    print(f"\n📊 {csv_bytes / 1024 ** 3:.2f} GB CSV, {total_columns} columns")
+    print(f"{'path':<28}{'seconds':>10}{'MB/s':>10}{'warehouse MB':>15}")
+    for name, (elapsed, db_bytes) in results.items():
+        print(f"{name:<28}{elapsed:>10.2f}{csv_bytes / 1024 ** 2 / elapsed:>10.1f}{db_bytes / 1024 ** 2:>15.1f}")
+
+    legacy, profile = (r[0] for r in results.values())
+    print(f"\n⚡ Speedup: {legacy / profile:.1f}x")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-gb", type=float, default=2.0, help="approximate CSV size to generate")
+    parser.add_argument("--columns", type=int, default=120, help="total CUR columns in the file")
+    parser.add_argument("--workdir", default=None, help="where to write the CSV and warehouses (default: a temp dir)")
+    args = parser.parse_args()
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        run(args.size_gb, args.columns, args.workdir)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            run(args.size_gb, args.columns, workdir)
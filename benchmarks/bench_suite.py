@@ -0,0 +1,334 @@
+"""
+Benchmark suite: generated CUR fixtures at several scales, through the engine and the API.
+
+For every scale it measures ingest_data, the pipeline (full and incremental, per stage),
+the scan-in-place audit (src/scan.py), /zombies and /analyze/upload latency under concurrent clients, and peak memory.
+Results are written as JSON and can be compared against a saved baseline:
+
+    python benchmarks/bench_suite.py --scales 10k,1m --save-baseline
+    python benchmarks/bench_suite.py --scales 10k,1m --baseline benchmarks/baseline.json
+
+The comparison exits with status 1 when any timing or memory figure regresses by more
+than --tolerance, so it can gate a CI job.
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+
+import duckdb
+import pyarrow.csv as pa_csv
+import requests
+import yaml
+
+ROOT_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(ROOT_DIR)
+
+from src import generate_data
+from src.analyze_costs import CloudBillHunter
+from src import scan
+
+SCALES = {'10k': 10_000, '1m': 1_000_000, '50m': 50_000_000}
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+FIXTURE_END_DATE = date(2024, 3, 31)
+
+# Differences below these are noise, whatever the ratio
+NOISE_FLOOR = {'_seconds': 0.02, '_ms': 2.0, '_mb': 8.0}
+
+# --- FIXTURES ---
+
+def fixture_path(workdir, rows, seed=42):
+    return os.path.join(workdir, f"cur_{rows}_{seed}.csv")
+
+def ensure_fixture(workdir, rows, seed=42):
+    """Generated once per (rows, seed) and reused across runs of the suite"""
+    path = fixture_path(workdir, rows, seed)
+    if not os.path.exists(path):
+        generate_data.generate_billing_data(rows, path, 'csv', seed=seed, end_date=FIXTURE_END_DATE)
+    return path
+
+def upload_body(index, rows):
+    """A small, unique CUR file for upload benchmarks (different seed -> different content hash)"""
+    pool = generate_data.build_resource_pool(50, 0.05, seed=1000 + index)
+    table = generate_data.generate_chunk(0, 0, rows, rows, pool, FIXTURE_END_DATE, 0, 1000 + index)
+    buffer = io.BytesIO()
+    pa_csv.write_csv(table, buffer)
+    return buffer.getvalue()
+
+# --- ENGINE ---
+
+def _stage_timings(run, mode):
+    """Per-stage figures the engine recorded for a run (see CloudBillHunter.stage_metrics)"""
+    timings = {}
+    for stage in run['stages']:
+        timings[f"{mode}_{stage['stage']}_seconds"] = stage['seconds']
+        timings[f"{mode}_{stage['stage']}_spilled_mb"] = stage['spilled_bytes'] / 1024 ** 2
+    return timings
+
+def _engine_phase(db_path, csv_path, delta_path, queue):
+    """Runs in a fresh process so ru_maxrss is this phase's peak alone"""
+    timings = {}
+    engine = CloudBillHunter(db_path=db_path)
+    try:
+        start = time.perf_counter()
+        engine.ingest_data(csv_path)
+        timings['ingest_seconds'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        run = engine.run_pipeline()
+        timings['pipeline_full_seconds'] = time.perf_counter() - start
+        timings.update(_stage_timings(run, 'full'))
+
+        engine.ingest_data(delta_path)
+        start = time.perf_counter()
+        run = engine.run_pipeline()
+        timings['pipeline_incremental_seconds'] = time.perf_counter() - start
+        timings.update(_stage_timings(run, 'incremental'))
+
+        timings['bronze_rows'] = engine.con.execute("SELECT COUNT(*) FROM bronze_billing").fetchone()[0]
+        timings['fact_rows'] = engine.con.execute("SELECT COUNT(*) FROM silver_fact_usage").fetchone()[0]
+        timings['daily_rows'] = engine.con.execute("SELECT COUNT(*) FROM silver_daily_usage").fetchone()[0]
+        timings['gold_rows'] = engine.con.execute("SELECT COUNT(*) FROM gold_zombie_report").fetchone()[0]
+    finally:
+        engine.close()
+    # Linux reports kilobytes, macOS bytes
+    scale = 1024 if sys.platform == 'darwin' else 1
+    timings['engine_peak_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale / 1024
+    queue.put(timings)
+
+def bench_engine(db_path, csv_path, delta_path):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_engine_phase, args=(db_path, csv_path, delta_path, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def bench_scan(csv_path):
+    """Time to first answer scanning the CUR file in place (src/scan.py), with no warehouse"""
+    with open(os.path.join(ROOT_DIR, 'config.yaml')) as f:
+        config = yaml.safe_load(f)
+    start = time.perf_counter()
+    con, _ = scan.open_scan([csv_path], config)
+    try:
+        zombies = len(scan.detect_zombies(con).fetchall())
+    finally:
+        con.close()
+    return {'scan_seconds': time.perf_counter() - start, 'scan_zombies': zombies}
+
+# --- API ---
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _peak_rss_mb(pid):
+    """High-water RSS of a running process (Linux /proc); None elsewhere"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+def _percentiles(samples, prefix):
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000
+    return {
+        f"{prefix}_p50_ms": statistics.median(ordered) * 1000,
+        f"{prefix}_p95_ms": pick(0.95),
+        f"{prefix}_p99_ms": pick(0.99),
+    }
+
+def _timed_get(url):
+    start = time.perf_counter()
+    response = requests.get(url, timeout=60)
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+class ApiServer:
+    """uvicorn plus the writer worker, pointed at a benchmark warehouse"""
+    def __init__(self, db_path, jobs_dir):
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        env = dict(os.environ, WAREHOUSE_PATH=db_path, JOBS_DIR=jobs_dir)
+        self.api = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "src.api:app", "--port", str(self.port), "--log-level", "warning"],
+            cwd=ROOT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        self.worker = subprocess.Popen(
+            [sys.executable, "-m", "src.worker"], cwd=ROOT_DIR, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        for _ in range(300):
+            try:
+                requests.get(self.url, timeout=1)
+                return
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError("API did not start")
+
+    def stop(self):
+        for process in (self.api, self.worker):
+            process.terminate()
+            process.wait(timeout=30)
+
+def bench_zombies(url, clients, requests_per_client):
+    """Warm: repeated identical queries (result cache). Cold: a distinct query per request."""
+    results = {}
+    urls = {
+        'zombies_warm': [f"{url}/zombies?limit=100"] * (clients * requests_per_client),
+        'zombies_cold': [f"{url}/zombies?limit=100&min_cost={n / 1000}" for n in range(clients * requests_per_client)],
+    }
+    for name, batch in urls.items():
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            samples = list(pool.map(_timed_get, batch))
+        results.update(_percentiles(samples, name))
+        results[f"{name}_rps"] = len(batch) / (time.perf_counter() - start)
+    return results
+
+def bench_uploads(url, clients, rows_per_upload):
+    """Time to 202 Accepted, and to the job being done (queue + worker + pipeline)"""
+    bodies = [upload_body(i, rows_per_upload) for i in range(clients)]
+
+    def upload(index):
+        start = time.perf_counter()
+        response = requests.post(f"{url}/analyze/upload", data=bodies[index],
+                                 headers={"X-Filename": f"bench-upload-{index}.csv"}, timeout=60)
+        response.raise_for_status()
+        accepted = time.perf_counter() - start
+        status_url = url + response.json()["status_url"]
+        while requests.get(status_url, timeout=60).json()["status"] not in ("done", "failed"):
+            time.sleep(0.05)
+        return accepted, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        samples = list(pool.map(upload, range(clients)))
+    results = _percentiles([s[0] for s in samples], 'upload_accept')
+    results.update(_percentiles([s[1] for s in samples], 'upload_done'))
+    return results
+
+# --- SUITE ---
+
+def run_scale(label, rows, workdir, clients, requests_per_client, upload_rows):
+    print(f"\n📏 Scale {label}: {rows:,} rows")
+    csv_path = ensure_fixture(workdir, rows)
+    delta_path = ensure_fixture(workdir, max(rows // 100, 100), seed=43)
+
+    db_path = os.path.join(workdir, f"bench_{label}.duckdb")
+    jobs_dir = os.path.join(workdir, f"jobs_{label}")
+    for stale in (db_path, f"{db_path}.version", f"{db_path}.wal"):
+        if os.path.exists(stale):
+            os.remove(stale)
+    shutil.rmtree(f"{db_path}.snapshots", ignore_errors=True)
+
+    result = {'rows': rows, 'fixture_bytes': os.path.getsize(csv_path)}
+    result.update(bench_engine(db_path, csv_path, delta_path))
+    result['ingest_rows_per_second'] = rows / result['ingest_seconds']
+    result.update(bench_scan(csv_path))
+    result['scan_speedup'] = (result['ingest_seconds'] + result['pipeline_full_seconds']) / result['scan_seconds']
+
+    server = ApiServer(db_path, jobs_dir)
+    try:
+        result.update(bench_zombies(server.url, clients, requests_per_client))
+        result.update(bench_uploads(server.url, clients, upload_rows))
+        result['api_peak_mb'] = _peak_rss_mb(server.api.pid)
+        result['worker_peak_mb'] = _peak_rss_mb(server.worker.pid)
+    finally:
+        server.stop()
+    return result
+
+def compare(results, baseline, tolerance):
+    """Returns [(metric, baseline, current, ratio)] for lower-is-better figures that got worse"""
+    regressions = []
+    for scale, metrics in results['results'].items():
+        for metric, current in metrics.items():
+            suffix = next((s for s in NOISE_FLOOR if metric.endswith(s)), None)
+            previous = baseline.get('results', {}).get(scale, {}).get(metric)
+            if suffix is None or current is None or not previous:
+                continue
+            if current > previous * (1 + tolerance) and current - previous > NOISE_FLOOR[suffix]:
+                regressions.append((f"{scale}.{metric}", previous, current, current / previous))
+    return regressions
+
+def print_report(results):
+    for scale, metrics in results['results'].items():
+        print(f"\n📊 {scale}")
+        for metric, value in metrics.items():
+            print(f"  {metric:<40}{value:>14.3f}" if isinstance(value, float) else f"  {metric:<40}{value!s:>14}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="10k,1m", help=f"comma-separated, from {', '.join(SCALES)}")
+    parser.add_argument("--workdir", default=None, help="fixtures and warehouses (default: a temp dir; reuse one to cache fixtures)")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent API clients")
+    parser.add_argument("--requests", type=int, default=25, help="/zombies requests per client")
+    parser.add_argument("--upload-rows", type=int, default=5000, help="rows per uploaded file")
+    parser.add_argument("--output", default="bench_results.json", help="where to write this run's JSON")
+    parser.add_argument("--baseline", default=None, help="baseline JSON to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help=f"also write the results to {DEFAULT_BASELINE}")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown ratio before failing")
+    args = parser.parse_args()
+
+    def run(workdir):
+        return {
+            'meta': {
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'duckdb': duckdb.__version__,
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'clients': args.clients,
+            },
+            'results': {
+                label: run_scale(label, SCALES[label], workdir, args.clients, args.requests, args.upload_rows)
+                for label in args.scales.split(',')
+            },
+        }
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        results = run(args.workdir)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = run(workdir)
+
+    print_report(results)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\n💾 Results written to {args.output}")
+    if args.save_baseline:
+        with open(DEFAULT_BASELINE, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"📌 Baseline saved to {DEFAULT_BASELINE}")
+
+    if args.baseline and not os.path.exists(args.baseline):
+        print(f"\n⚠️  No baseline at {args.baseline}; skipping the comparison (record one with --save-baseline)")
+    elif args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n🚨 {len(regressions)} regression(s) beyond {args.tolerance:.0%}:")
+            for metric, previous, current, ratio in regressions:
+                print(f"  {metric:<48}{previous:>12.3f} -> {current:>12.3f}  ({ratio:.2f}x)")
+            sys.exit(1)
+        print(f"\n✅ No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+
+if __name__ == "__main__":
+    main()
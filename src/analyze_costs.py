@@ -1,65 +1,1503 @@
 import duckdb
 import yaml
 import os
+import io
+import gzip
+import hashlib
+import csv
+import time
+import json
+import glob
+import shutil
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+from src.model_dag import Model, load_models, referenced_relations, select_models, waves
+
+try:
+    import zstandard
+except ImportError:  # zstd uploads are optional
+    zstandard = None
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("ENGINE")
 
+FINGERPRINT_CHUNK_BYTES = 1024 * 1024
+
+def fingerprint_file(path):
+    """Returns (sha256 hex digest, size in bytes) of a file, read in chunks without parsing it"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(FINGERPRINT_CHUNK_BYTES), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Arrow types the streaming reader parses directly; anything else arrives as text and is cast by DuckDB
+ARROW_TYPES = {'DOUBLE': pa.float64(), 'BIGINT': pa.int64(), 'INTEGER': pa.int32(), 'VARCHAR': pa.string()}
+
+class PayloadTooLarge(Exception):
+    """An upload exceeded uploads.max_bytes (measured after decompression)"""
+
+class UnsupportedEncoding(Exception):
+    """An upload used a Content-Encoding the engine cannot decode"""
+
+class _Prepend:
+    """Puts already-consumed bytes back in front of a stream"""
+    def __init__(self, head, stream):
+        self._head = head
+        self._stream = stream
+
+    def read(self, n=-1):
+        if not self._head:
+            return self._stream.read(n)
+        if n is None or n < 0:
+            data, self._head = self._head + self._stream.read(), b''
+        else:
+            data, self._head = self._head[:n], self._head[n:]
+        return data
+
+class _FingerprintingReader(io.RawIOBase):
+    """Passes bytes through while hashing and counting them, enforcing a size cap"""
+    def __init__(self, stream, max_bytes=None):
+        self._stream = stream
+        self._max_bytes = max_bytes
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._stream.read(len(buffer))
+        self.size += len(data)
+        if self._max_bytes and self.size > self._max_bytes:
+            raise PayloadTooLarge(f"Upload exceeds {self._max_bytes} bytes")
+        self.digest.update(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+def check_encoding(encoding):
+    """Validates a Content-Encoding up front; returns it normalized ('' for none)"""
+    encoding = (encoding or '').strip().lower()
+    if encoding == 'zstd' and zstandard is None:
+        raise UnsupportedEncoding("zstd uploads need the 'zstandard' package")
+    if encoding not in ('', 'identity', 'gzip', 'x-gzip', 'zstd'):
+        raise UnsupportedEncoding(f"Unsupported Content-Encoding: {encoding}")
+    return encoding
+
+def open_decompressed(stream, encoding=None):
+    """
+    Wraps a binary stream so reads return plain CSV bytes.
+    gzip/zstd are taken from the Content-Encoding, or detected from the magic bytes.
+    """
+    encoding = check_encoding(encoding)
+    head = stream.read(4)
+    stream = _Prepend(head, stream)
+
+    if encoding in ('gzip', 'x-gzip') or (not encoding and head.startswith(GZIP_MAGIC)):
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    if encoding == 'zstd' or (not encoding and head.startswith(ZSTD_MAGIC)):
+        if zstandard is None:
+            raise UnsupportedEncoding("zstd uploads need the 'zstandard' package")
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    return stream
+
+def _sql_str(value):
+    """Quotes a value as a SQL string literal"""
+    return "'" + str(value).replace("'", "''") + "'"
+
+def _ident(name):
+    """Quotes a column name as a SQL identifier"""
+    return '"' + str(name).replace('"', '""') + '"'
+
+def read_csv_header(path):
+    """Reads only the header row of a CSV or CSV.gz (no type sniffing)"""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', newline='', encoding='utf-8-sig') as f:
+        return next(csv.reader(f), [])
+
+def profile_select(header, columns):
+    """
+    Maps a file header onto the ingest profile ({CUR column: type}, matched case-insensitively)
+    and returns the typed select list for bronze; profile columns missing from the file become NULLs.
+    """
+    present = {h.lower(): h for h in header}
+    if not any(c.lower() in present for c in columns):
+        raise ValueError("File has none of the CUR columns in the ingest profile")
+    return ",\n".join(
+        f"CAST({_ident(present[c.lower()])} AS {t}) AS {_ident(c)}" if c.lower() in present else f"NULL::{t} AS {_ident(c)}"
+        for c, t in columns.items()
+    )
+
+def projected_csv_select(csv_paths, header, columns):
+    """
+    Builds a single-pass, typed read of CUR files sharing one header (a path or a list): the
+    header fixes the column list, profile columns get their declared types, and only profile
+    columns are selected, so DuckDB's projection pushdown skips converting everything else.
+    """
+    by_lower = {c.lower(): t for c, t in columns.items()}
+    struct = ", ".join(f"{_sql_str(h)}: {_sql_str(by_lower.get(h.lower(), 'VARCHAR'))}" for h in header)
+    paths = [csv_paths] if isinstance(csv_paths, str) else list(csv_paths)
+    return f"""
+        SELECT {profile_select(header, columns)}
+        FROM read_csv([{', '.join(_sql_str(p) for p in paths)}], header=true, auto_detect=false,
+                      delim=',', quote='"', escape='"', columns={{{struct}}})
+    """
+
+# --- RESOURCE PROFILE ---
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+def duckdb_settings(config):
+    """
+    DuckDB connect() options from config.yaml's resources profile: memory cap, threads,
+    spill directory (relative paths resolve from the project root) and insertion order.
+    Settings left out keep DuckDB's defaults.
+    """
+    resources = config.get('resources') or {}
+    settings = {}
+    if resources.get('memory_limit'):
+        settings['memory_limit'] = str(resources['memory_limit'])
+    if resources.get('threads'):
+        settings['threads'] = int(resources['threads'])
+    if resources.get('temp_directory'):
+        settings['temp_directory'] = os.path.join(PROJECT_ROOT, resources['temp_directory'])
+    if resources.get('preserve_insertion_order') is not None:
+        settings['preserve_insertion_order'] = bool(resources['preserve_insertion_order'])
+    return settings
+
+# --- WAREHOUSE VERSION & GOLD SNAPSHOTS ---
+# Readers never open the warehouse: each finished Gold build is copied into an immutable
+# snapshot file, and the version sidecar (replaced atomically) points readers at the latest one.
+WRITER_CONNECT_ATTEMPTS = 100
+WRITER_CONNECT_DELAY_SECONDS = 0.1
+
+def version_file(db_path):
+    return f"{db_path}.version"
+
+def snapshot_dir(db_path):
+    return f"{db_path}.snapshots"
+
+def snapshot_path(db_path, version):
+    return os.path.join(snapshot_dir(db_path), f"gold_v{version}.duckdb")
+
+def read_warehouse_version(db_path):
+    """The Gold version counter bumped by each publish (0 before the first refresh)"""
+    try:
+        with open(version_file(db_path), 'r') as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+def current_snapshot(db_path):
+    """(version, path) of the latest published Gold snapshot; path is None before the first publish"""
+    version = read_warehouse_version(db_path)
+    path = snapshot_path(db_path, version)
+    return version, (path if os.path.exists(path) else None)
+
+def _write_atomic(path, text):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+# --- PARQUET BRONZE ---
+# Optional storage.bronze_backend=parquet: one file per (batch, partition), laid out as
+# <parquet_dir>/billing_month=YYYY-MM/account_id=<id>/batch_<id>_<n>.parquet
+BRONZE_PARTITIONS = ('billing_month', 'account_id')
+
+def _batch_of_file(path):
+    """batch_12_0.parquet -> 12 (None for files the engine did not write)"""
+    name = os.path.basename(path)
+    if not (name.startswith('batch_') and name.endswith('.parquet')):
+        return None
+    try:
+        return int(name.split('_')[1])
+    except (IndexError, ValueError):
+        return None
+
+def _scoped(scope_cte, model_sql):
+    """
+    Runs a model against a CTE that shadows one of its inputs (e.g. bronze_billing limited
+    to some batches). The model becomes a subquery, so it may have a WITH clause of its own.
+    """
+    return f"{scope_cte} SELECT * FROM ({model_sql})"
+
+def _id_list(ids):
+    """Renders ids for an IN (...) clause; an empty list matches nothing"""
+    return ", ".join(str(int(i)) for i in ids) or "NULL"
+
 class CloudBillHunter:
-    # UPDATED: Accept db_path for testing
-    def __init__(self, config_path='config.yaml', db_path=None):
+    # UPDATED: Accept db_path for testing; config (an already-loaded dict) overrides config_path
+    def __init__(self, config_path='config.yaml', db_path=None, config=None):
         self.root_dir = os.path.dirname(os.path.abspath(__file__))
         config_full_path = os.path.join(self.root_dir, '..', config_path)
-        
-        with open(config_full_path, 'r') as f:
-            self.config = yaml.safe_load(f)
+
+        if config is None:
+            with open(config_full_path, 'r') as f:
+                config = yaml.safe_load(f)
+        self.config = config
             
         # If no path provided, use the default from config/hardcoded
         if db_path is None:
              db_path = os.path.join(self.root_dir, '..', 'data/warehouse.duckdb')
         
         self.db_path = db_path
-        self.con = duckdb.connect(database=self.db_path) 
+        self.settings = duckdb_settings(self.config)  # also holds for cursors: the settings are database-wide
+        self.con = self._connect_writer()
+        self._ensure_batch_ledger()
+        self._ensure_metrics_table()
+        self._ensure_model_state()
+        self._republish_if_behind()
+
+        # Per-statement profiles (rows scanned, bytes read, spill) for the stage metrics
+        self._profiling = hasattr(self.con, 'get_profiling_information')
+        if self._profiling:
+            self.con.execute("SET enable_profiling = 'no_output'")
+        self._local = threading.local()  # the stage being timed, per model-building thread
+        self.stage_metrics = []
+        self.last_run = None
+
+    def _connect_writer(self):
+        """
+        Waits for DuckDB's exclusive lock (another writer, e.g. the watcher, may hold it)
+        instead of failing on the first conflict. Readers use snapshots and never hold it.
+        """
+        if self.db_path == ':memory:':
+            return duckdb.connect(database=self.db_path, config=self.settings)
+
+        for attempt in range(WRITER_CONNECT_ATTEMPTS):
+            try:
+                return duckdb.connect(database=self.db_path, config=self.settings)
+            except (duckdb.IOException, duckdb.ConnectionException):
+                if attempt == WRITER_CONNECT_ATTEMPTS - 1:
+                    raise
+                time.sleep(WRITER_CONNECT_DELAY_SECONDS)
+
+    def _publish_snapshot(self, graph):
+        """
+        Copies the committed Gold models (and pipeline_metrics) into a new snapshot file, then
+        bumps the version: the atomic replace of the version sidecar is the pointer swap.
+        Caches keyed on the old version go stale; snapshots beyond snapshots.keep are deleted.
+        """
+        if self.db_path == ':memory:':
+            return
+        version = read_warehouse_version(self.db_path) + 1
+        path = snapshot_path(self.db_path, version)
+        tmp_path = f"{path}.tmp"
+        os.makedirs(snapshot_dir(self.db_path), exist_ok=True)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)  # left behind by a publish that crashed
+
+        tables = [n for n in graph if graph[n].layer == 'gold'] + ['pipeline_metrics']
+        tables = [t for t in tables if self._table_exists(t)]
+        self.con.execute(f"ATTACH {_sql_str(tmp_path)} AS gold_snapshot")
+        try:
+            for table in tables:
+                self.con.execute(f"CREATE TABLE gold_snapshot.{table} AS SELECT * FROM main.{table}")
+        finally:
+            self.con.execute("DETACH gold_snapshot")
+        os.replace(tmp_path, path)
+        _write_atomic(version_file(self.db_path), str(version))
+        logger.info(f"🔖 Warehouse version -> {version} (snapshot of {len(tables)} tables)")
+        self._collect_snapshots(version)
+
+    def _republish_if_behind(self):
+        """
+        Publishes again when the last committed run never reached a snapshot (the process died
+        between commit and publish), so readers do not serve stale Gold until new data arrives.
+        Snapshots carry pipeline_metrics, so their newest run_id says which run they hold.
+        """
+        if self.db_path == ':memory:':
+            return False
+        committed = self.con.execute("SELECT MAX(run_id) FROM pipeline_metrics").fetchone()[0]
+        if committed is None:
+            return False
+        _, path = current_snapshot(self.db_path)
+        if path is not None:
+            self.con.execute(f"ATTACH {_sql_str(path)} AS published_snapshot (READ_ONLY)")
+            try:
+                published = self.con.execute("SELECT MAX(run_id) FROM published_snapshot.pipeline_metrics").fetchone()[0]
+            finally:
+                self.con.execute("DETACH published_snapshot")
+            if published is not None and published >= committed:
+                return False
+        logger.info(f"🔁 Run {committed} was committed but never published: republishing Gold")
+        self._publish_snapshot(self._models())
+        return True
+
+    def _collect_snapshots(self, current):
+        """Deletes snapshots older than the newest snapshots.keep; open readers keep their file handle"""
+        keep = max(1, int(self.config.get('snapshots', {}).get('keep', 3)))
+        for path in glob.glob(os.path.join(snapshot_dir(self.db_path), 'gold_v*.duckdb')):
+            try:
+                version = int(os.path.basename(path)[len('gold_v'):-len('.duckdb')])
+            except ValueError:
+                continue
+            if version <= current - keep:
+                try:
+                    os.remove(path)
+                except OSError as e:  # e.g. still open on Windows; retried after the next publish
+                    logger.warning(f"⚠️  Could not remove snapshot {path}: {e}")
 
-    def _read_sql(self, model_name):
-        path = os.path.join(self.root_dir, 'sql/models', f"{model_name}.sql")
+    def _read_sql(self, model_name, folder='models'):
+        path = os.path.join(self.root_dir, 'sql', folder, f"{model_name}.sql")
         with open(path, 'r') as f:
-            return f.read()
+            return f.read().strip().rstrip(';')
+
+    def _set_detection_rules(self, as_of_sql, params=None, con=None):
+        """
+        Binds config.yaml's business_rules, the detector parameters (as <detector>_<name>) and
+        as_of_date (the latest billed day, from as_of_sql) as session variables the Gold models
+        and detectors read with getvariable(). Returns as_of_date.
+        """
+        con = con or self.con
+        rules = self.config.get('business_rules', {})
+        con.execute("SET VARIABLE zombie_threshold_days = ?", [int(rules.get('zombie_threshold_days', 7))])
+        con.execute("SET VARIABLE min_cost_threshold = ?", [float(rules.get('min_cost_threshold', 0.01))])
+        settings = self.config.get('detectors', {})
+        con.execute("SET VARIABLE detector_window_days = ?", [int(settings.get('window_days', 14))])
+        con.execute("SET VARIABLE detector_min_history_days = ?", [int(settings.get('min_history_days', 7))])
+        for name, detector_params in self.detectors.items():
+            for param, value in detector_params.items():
+                con.execute(f"SET VARIABLE {_ident(f'{name}_{param}')} = ?", [value])
+        con.execute(f"SET VARIABLE as_of_date = ({as_of_sql})", params)
+        return con.execute("SELECT getvariable('as_of_date')").fetchone()[0]
+
+    # --- ANOMALY DETECTORS ---
+    @property
+    def detectors(self):
+        """Enabled detectors from config.yaml: {name: {parameter: value}}, one SQL file each in sql/detectors"""
+        rules = self.config.get('detectors', {}).get('rules') or {}
+        enabled = {}
+        for name, params in rules.items():
+            params = dict(params or {})
+            if not params.pop('enabled', True):
+                continue
+            if name == 'features' or not os.path.exists(os.path.join(self.root_dir, 'sql/detectors', f"{name}.sql")):
+                raise ValueError(f"Unknown detector '{name}': add sql/detectors/{name}.sql")
+            enabled[name] = params
+        return enabled
+
+    def _findings_sql(self):
+        """
+        Every enabled detector over one materialized windowed pass of silver_daily_usage,
+        as rows of the unified findings shape (gold_findings).
+        """
+        detectors = [
+            f"SELECT '{name}' as detector, * FROM ({self._read_sql(name, 'detectors')})" for name in self.detectors
+        ] or ["SELECT NULL as detector, NULL::INTEGER as resource_key, NULL::DATE as usage_date, "
+              "NULL::DOUBLE as observed, NULL::DOUBLE as expected, NULL::DOUBLE as score, NULL::DOUBLE as impact "
+              "WHERE false"]
+        union = "\nUNION ALL\n".join(detectors)
+        return f"""
+            WITH detector_features AS MATERIALIZED ({self._read_sql('features', 'detectors')}),
+                 findings AS ({union})
+            SELECT
+                CAST(f.detector AS VARCHAR) as detector,
+                d.resource_id,
+                d.service,
+                d.owner_team,
+                f.usage_date,
+                CAST(f.observed AS DOUBLE) as observed,
+                CAST(f.expected AS DOUBLE) as expected,
+                CAST(f.score AS DOUBLE) as score,
+                CAST(f.impact AS DOUBLE) as impact
+            FROM findings f
+                JOIN silver_dim_resource d ON d.resource_key = f.resource_key AND d.is_current
+            ORDER BY impact DESC, detector, resource_id, usage_date
+        """
+
+    # --- PIPELINE METRICS ---
+    @property
+    def observability(self):
+        return self.config.get('observability', {})
+
+    @property
+    def _current_stage(self):
+        return getattr(self._local, 'stage', None)
+
+    @_current_stage.setter
+    def _current_stage(self, stage):
+        self._local.stage = stage
+
+    def _ensure_metrics_table(self):
+        """One row per stage of every ingest and pipeline run, read by the API's /metrics"""
+        self.con.execute("""
+            CREATE SEQUENCE IF NOT EXISTS pipeline_run_seq START 1;
+            CREATE TABLE IF NOT EXISTS pipeline_metrics (
+                run_id BIGINT,              -- pipeline run (NULL for ingests)
+                batch_id BIGINT,            -- bronze batch (ingests only)
+                recorded_at TIMESTAMP,
+                mode VARCHAR,               -- ingest | full | incremental | partial | compact
+                layer VARCHAR,              -- bronze | silver | gold
+                stage VARCHAR,
+                seconds DOUBLE,
+                rows BIGINT,                -- rows written by the stage
+                rows_scanned BIGINT,
+                bytes_read BIGINT,
+                spilled_bytes BIGINT,       -- peak temp-directory use: > 0 means DuckDB spilled
+                peak_buffer_bytes BIGINT
+            );
+        """)
+
+    @contextmanager
+    def _stage(self, layer, name):
+        """Times a block of pipeline statements; _exec() folds each statement's profile into it"""
+        stage = {"layer": layer, "stage": name, "seconds": 0.0, "rows": 0, "rows_scanned": 0,
+                 "bytes_read": 0, "spilled_bytes": 0, "peak_buffer_bytes": 0, "profiles": []}
+        self._current_stage = stage
+        started = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            self._current_stage = None
+        stage["seconds"] = round(time.perf_counter() - started, 4)
+        self._save_slow_profile(stage)
+        del stage["profiles"]
+        self.stage_metrics.append(stage)
+        logger.info(
+            f"⏱️  {layer}.{name}: {stage['seconds']}s, {stage['rows']} rows written, "
+            f"{stage['rows_scanned']} scanned{', SPILLED ' + str(stage['spilled_bytes']) + ' bytes' if stage['spilled_bytes'] else ''}"
+        )
+
+    def _exec(self, sql, params=None, con=None):
+        """Executes one pipeline statement, adding its DuckDB profile to the current stage"""
+        con = con or self.con
+        result = con.execute(sql, params)
+        stage = self._current_stage
+        if stage is not None and self._profiling:
+            profile = json.loads(con.get_profiling_information(format='json'))
+            stage["rows_scanned"] += profile.get("cumulative_rows_scanned", 0)
+            stage["bytes_read"] += profile.get("total_bytes_read", 0)
+            stage["spilled_bytes"] = max(stage["spilled_bytes"], profile.get("system_peak_temp_dir_size", 0))
+            stage["peak_buffer_bytes"] = max(stage["peak_buffer_bytes"], profile.get("system_peak_buffer_memory", 0))
+            if self.observability.get('explain_slow_stages'):
+                stage["profiles"].append(profile)
+        return result
+
+    def _save_slow_profile(self, stage):
+        """
+        Opt-in (observability.explain_slow_stages): a stage slower than slow_stage_seconds keeps
+        the EXPLAIN ANALYZE operator tree of every statement it ran, as JSON in profiles_dir.
+        """
+        threshold = self.observability.get('slow_stage_seconds')
+        if threshold is None or stage["seconds"] < threshold or not stage["profiles"]:
+            return
+        profiles_dir = self.observability.get('profiles_dir') or 'data/profiles'
+        os.makedirs(profiles_dir, exist_ok=True)
+        path = os.path.join(profiles_dir, f"{datetime.now():%Y%m%dT%H%M%S%f}-{stage['layer']}-{stage['stage']}.json")
+        with open(path, 'w') as f:
+            json.dump({"stage": stage["stage"], "seconds": stage["seconds"], "statements": stage["profiles"]}, f, indent=2)
+        stage["profile_path"] = path
+        logger.warning(f"🐢 {stage['layer']}.{stage['stage']} took {stage['seconds']}s; profile saved to {path}")
+
+    def _record_metrics(self, mode, run_id=None, batch_id=None):
+        """Persists the collected stage metrics (inside the caller's transaction) and applies retention"""
+        for stage in self.stage_metrics:
+            self.con.execute(
+                "INSERT INTO pipeline_metrics VALUES (?, ?, now(), ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [run_id, batch_id, mode, stage["layer"], stage["stage"], stage["seconds"], stage["rows"],
+                 stage["rows_scanned"], stage["bytes_read"], stage["spilled_bytes"], stage["peak_buffer_bytes"]]
+            )
+        retention_days = self.observability.get('metrics_retention_days', 30)
+        self.con.execute(
+            f"DELETE FROM pipeline_metrics WHERE recorded_at < now() - INTERVAL {int(retention_days)} DAY"
+        )
+
+    @property
+    def ingest_columns(self):
+        """The ingest profile from config.yaml: {CUR column: DuckDB type}, in bronze column order"""
+        return self.config['ingest']['columns']
+
+    @property
+    def bronze_backend(self):
+        """'duckdb' (a table in the warehouse file) or 'parquet' (Hive-partitioned files)"""
+        return self.config.get('storage', {}).get('bronze_backend', 'duckdb')
+
+    def _storage_dir(self, key, default_name):
+        configured = self.config.get('storage', {}).get(key)
+        if configured:
+            return os.path.abspath(configured)
+        if self.db_path == ':memory:':
+            raise ValueError(f"In-memory warehouses need storage.{key} for Parquet bronze")
+        return os.path.join(os.path.dirname(os.path.abspath(self.db_path)), default_name)
+
+    @property
+    def bronze_dir(self):
+        return self._storage_dir('parquet_dir', 'bronze')
+
+    def _ensure_bronze_table(self):
+        columns = ",\n".join(f"{_ident(c)} {t}" for c, t in self.ingest_columns.items())
+        self.con.execute(f"""
+            CREATE TABLE IF NOT EXISTS bronze_billing (
+                {columns},
+                _batch_id BIGINT
+            )
+        """)
+        # Profile columns added to config.yaml after the table was created
+        existing = {c[0] for c in self.con.execute("DESCRIBE bronze_billing").fetchall()}
+        for column, column_type in self.ingest_columns.items():
+            if column not in existing:
+                self.con.execute(f"ALTER TABLE bronze_billing ADD COLUMN {_ident(column)} {column_type}")
+
+    def _ensure_bronze_storage(self):
+        """Makes 'bronze_billing' resolve for the configured backend (table, or view over Parquet)"""
+        if self.bronze_backend != 'parquet':
+            self._ensure_bronze_table()
+            return
+
+        if self._table_exists('bronze_billing', table_type='BASE TABLE'):
+            # Switching an existing warehouse over: export each batch, then drop the table
+            logger.info("🔧 Moving bronze_billing out to Parquet partitions...")
+            batch_ids = [r[0] for r in self.con.execute("SELECT DISTINCT _batch_id FROM bronze_billing").fetchall()]
+            for batch_id in batch_ids:
+                self._copy_to_parquet(f"SELECT * EXCLUDE (_batch_id) FROM bronze_billing WHERE _batch_id = {batch_id}", batch_id)
+            self.con.execute("DROP TABLE bronze_billing")
+        self._create_bronze_view()
+
+    def _create_bronze_view(self):
+        """
+        bronze_billing becomes a view over the partition tree. Only live manifest batches are
+        visible, so files of an uncommitted or superseded batch never leak into Silver/Gold.
+        """
+        live = "_batch_id IN (SELECT batch_id FROM bronze_batches WHERE replaced_by IS NULL)"
+        if glob.glob(os.path.join(self.bronze_dir, '*', '*', '*.parquet')):
+            pattern = os.path.join(self.bronze_dir, '*', '*', '*.parquet').replace('\\', '/')
+            hive_types = ", ".join(f"{_sql_str(p)}: VARCHAR" for p in BRONZE_PARTITIONS)
+            source = f"""
+                SELECT * FROM read_parquet({_sql_str(pattern)}, hive_partitioning=true, hive_types={{{hive_types}}})
+                WHERE {live}
+            """
+        else:
+            # No files yet: an empty relation with the bronze schema
+            columns = ", ".join(f"NULL::{t} AS {_ident(c)}" for c, t in self.ingest_columns.items())
+            partitions = ", ".join(f"NULL::VARCHAR AS {p}" for p in BRONZE_PARTITIONS)
+            source = f"SELECT {columns}, NULL::BIGINT AS _batch_id, {partitions} WHERE false"
+        self.con.execute(f"CREATE OR REPLACE VIEW bronze_billing AS {source}")
+
+    def _copy_to_parquet(self, select_sql, batch_id):
+        """Writes one batch as Parquet files under its billing month / account partitions"""
+        target = self.bronze_dir.replace('\\', '/')
+        os.makedirs(target, exist_ok=True)
+        return self._exec(f"""
+            COPY (
+                SELECT *,
+                       {batch_id}::BIGINT AS _batch_id,
+                       strftime("LineItem/UsageStartDate", '%Y-%m') AS billing_month,
+                       "LineItem/UsageAccountId" AS account_id
+                FROM ({select_sql})
+            ) TO {_sql_str(target)} (
+                FORMAT PARQUET,
+                PARTITION_BY ({', '.join(BRONZE_PARTITIONS)}),
+                FILENAME_PATTERN 'batch_{batch_id}_{{i}}',
+                OVERWRITE_OR_IGNORE
+            )
+        """).fetchone()[0]
+
+    def _write_bronze(self, select_sql, batch_id):
+        """Appends one batch of profile-shaped rows to bronze; returns the row count"""
+        self._ensure_bronze_storage()
+        if self.bronze_backend == 'parquet':
+            row_count = self._copy_to_parquet(select_sql, batch_id)
+            self._create_bronze_view()
+            return row_count
+        return self._exec(f"""
+            INSERT INTO bronze_billing BY NAME
+            SELECT *, {batch_id}::BIGINT AS _batch_id FROM ({select_sql})
+        """).fetchone()[0]
+
+    def _collect_bronze_files(self):
+        """Removes Parquet files whose batch is not live in the manifest (superseded or never committed)"""
+        if self.bronze_backend != 'parquet' or not os.path.isdir(self.bronze_dir):
+            return
+        live = {r[0] for r in self.con.execute(
+            "SELECT batch_id FROM bronze_batches WHERE replaced_by IS NULL"
+        ).fetchall()}
+        removed = 0
+        for path in glob.glob(os.path.join(self.bronze_dir, '*', '*', 'batch_*.parquet')):
+            if _batch_of_file(path) not in live:
+                os.remove(path)
+                removed += 1
+        for folder in glob.glob(os.path.join(self.bronze_dir, '*', '*')) + glob.glob(os.path.join(self.bronze_dir, '*')):
+            if os.path.isdir(folder) and not os.listdir(folder):
+                os.rmdir(folder)
+        if removed:
+            logger.info(f"🧹 Removed {removed} superseded bronze file(s)")
+
+    def _profile_select(self, header):
+        return profile_select(header, self.ingest_columns)
+
+    def _projected_csv_select(self, csv_path, header):
+        return projected_csv_select(csv_path, header, self.ingest_columns)
+
+    def _table_exists(self, table_name, table_type=None):
+        return self.con.execute(
+            "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = ? AND table_type = COALESCE(?, table_type)",
+            [table_name, table_type]
+        ).fetchone()[0] > 0
+
+    def _ensure_batch_ledger(self):
+        """
+        Every ingest is a numbered batch. The ledger doubles as the load manifest:
+        it fingerprints each file and records which batches Silver/Gold have absorbed.
+        """
+        self.con.execute("""
+            CREATE SEQUENCE IF NOT EXISTS bronze_batch_seq START 1;
+            CREATE TABLE IF NOT EXISTS bronze_batches (
+                batch_id BIGINT PRIMARY KEY,
+                source VARCHAR,
+                content_hash VARCHAR UNIQUE,
+                file_size BIGINT,
+                billing_period DATE,
+                row_count BIGINT,
+                loaded_at TIMESTAMP,
+                processed_at TIMESTAMP,
+                replaced_by BIGINT,
+                retracted_at TIMESTAMP,
+                source_key VARCHAR,
+                account_ids VARCHAR
+            );
+        """)
+        # Ledgers from before restatements were keyed on the source's identity: their batches get
+        # no key, so nothing new is ever taken as a restatement of them
+        self.con.execute("ALTER TABLE bronze_batches ADD COLUMN IF NOT EXISTS source_key VARCHAR")
+        self.con.execute("ALTER TABLE bronze_batches ADD COLUMN IF NOT EXISTS account_ids VARCHAR")
+        # Copies compact_bronze() dropped, by row hash: the batch that loaded them and the batch
+        # whose copy was kept, so replacing the kept batch can bring them back
+        self.con.execute("""
+            CREATE TABLE IF NOT EXISTS bronze_dropped_copies (
+                row_hash UBIGINT,
+                batch_id BIGINT,
+                kept_by BIGINT,
+                copies BIGINT
+            )
+        """)
+
+        # Warehouses created before batch tracking: adopt the existing bronze rows as batch 0.
+        # It is left unprocessed, so the next run_pipeline() does a full rebuild.
+        if self._table_exists('bronze_billing', table_type='BASE TABLE'):
+            columns = [c[0] for c in self.con.execute("DESCRIBE bronze_billing").fetchall()]
+            if '_batch_id' not in columns:
+                logger.info("🔧 Migrating legacy bronze_billing to batch tracking...")
+                self.con.execute("ALTER TABLE bronze_billing ADD COLUMN _batch_id BIGINT DEFAULT 0")
+                self.con.execute("""
+                    INSERT INTO bronze_batches (batch_id, source, row_count, loaded_at)
+                    SELECT 0, 'legacy', COUNT(*), now() FROM bronze_billing
+                """)
 
     def close(self):
         """Closes the database connection to release the lock"""
         self.con.close()
         logger.info("🔒 Database connection closed.")
 
-    def ingest_data(self, csv_path):
-        """BRONZE LAYER: Raw Ingestion"""
+    def ingest_data(self, csv_path, where=None):
+        """
+        BRONZE LAYER: Raw Ingestion.
+        `where` (a SQL predicate over profile columns) keeps only matching rows, e.g. one shard's account.
+        Returns the new batch id, or None when the exact file was already loaded.
+        """
         logger.info("🏗️  Building BRONZE layer...")
         # Normalize path for DuckDB
         csv_path = os.path.normpath(csv_path).replace('\\', '/')
+        source = os.path.basename(csv_path)
+
+        # IDEMPOTENCY: identical content is skipped on a manifest lookup, before the CSV is parsed
+        content_hash, file_size = fingerprint_file(csv_path)
+        loaded = self.con.execute(
+            "SELECT batch_id FROM bronze_batches WHERE content_hash = ?", [content_hash]
+        ).fetchone()
+        if loaded:
+            logger.info(f"⏭️  Skipping {source}: identical content already loaded as batch {loaded[0]}")
+            return None
         
-        # FIX: The previous logic doubled the data on fresh runs.
-        # "CREATE TABLE AS SELECT" inserts data. Then "INSERT" inserted it again.
-        # We add "WHERE 1=0" to CREATE TABLE so it only creates the structure (empty).
-        self.con.execute(f"""
-            CREATE TABLE IF NOT EXISTS bronze_billing AS SELECT * FROM read_csv_auto('{csv_path}') WHERE 1=0;
-            INSERT INTO bronze_billing SELECT * FROM read_csv_auto('{csv_path}');
+        # SINGLE PASS: bronze has a fixed schema from the ingest profile, so the file is
+        # parsed exactly once, by the INSERT, with declared types and only the needed columns.
+        read_sql = self._projected_csv_select(csv_path, read_csv_header(csv_path))
+        if where:
+            read_sql = f"SELECT * FROM ({read_sql}) WHERE {where}"
+        self.stage_metrics = []
+        self.con.begin()
+        try:
+            batch_id = self.con.execute("SELECT nextval('bronze_batch_seq')").fetchone()[0]
+            with self._stage('bronze', 'ingest') as stage:
+                row_count = self._write_bronze(read_sql, batch_id)
+                self._register_batch(batch_id, source, content_hash, file_size, row_count, os.path.abspath(csv_path))
+                stage['rows'] = row_count
+            stage['bytes_read'] = file_size
+            self._record_metrics('ingest', batch_id=batch_id)
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            self._collect_bronze_files()
+            raise
+        self._collect_bronze_files()
+
+        logger.info(f"📦 Loaded batch {batch_id}: {row_count} rows from {source}")
+        return batch_id
+
+    def ingest_stream(self, stream, source, encoding=None):
+        """
+        BRONZE LAYER: Streaming ingestion of an upload body (any object with read(n)).
+        Bytes flow decompress -> fingerprint -> Arrow CSV reader -> DuckDB in bounded blocks,
+        so memory stays flat and nothing is written to disk. The upload's name is its identity
+        for restatements.
+        Returns the new batch id, or None when identical content was already loaded.
+        """
+        logger.info(f"🏗️  Streaming {source} into BRONZE layer...")
+        upload_cfg = self.config['uploads']
+        raw = _FingerprintingReader(open_decompressed(stream, encoding), upload_cfg['max_bytes'])
+        text = io.BufferedReader(raw, buffer_size=upload_cfg['chunk_bytes'])
+
+        header = next(csv.reader([text.readline().decode('utf-8-sig')]), [])
+        select = self._profile_select(header)
+        by_lower = {c.lower(): t for c, t in self.ingest_columns.items()}
+        wanted = [h for h in header if h.lower() in by_lower]
+        batches = pa_csv.open_csv(
+            text,
+            read_options=pa_csv.ReadOptions(column_names=header, block_size=upload_cfg['chunk_bytes']),
+            convert_options=pa_csv.ConvertOptions(
+                include_columns=wanted,
+                column_types={h: ARROW_TYPES.get(by_lower[h.lower()], pa.string()) for h in wanted},
+                strings_can_be_null=True,  # empty cells are NULL, as with read_csv (e.g. a missing Owner tag)
+            ),
+        )
+
+        self.stage_metrics = []
+        self.con.begin()
+        try:
+            batch_id = self.con.execute("SELECT nextval('bronze_batch_seq')").fetchone()[0]
+            self.con.register('_upload_stream', batches)
+            with self._stage('bronze', 'ingest') as stage:
+                row_count = self._write_bronze(f"SELECT {select} FROM _upload_stream", batch_id)
+                stage['rows'] = row_count
+            stage['bytes_read'] = raw.size
+            self.con.unregister('_upload_stream')
+
+            # A stream can only be fingerprinted once it has been read: duplicates roll back
+            content_hash = raw.digest.hexdigest()
+            loaded = self.con.execute(
+                "SELECT batch_id FROM bronze_batches WHERE content_hash = ?", [content_hash]
+            ).fetchone()
+            if loaded:
+                self.con.rollback()
+                self._collect_bronze_files()
+                logger.info(f"⏭️  Skipping {source}: identical content already loaded as batch {loaded[0]}")
+                return None
+
+            self._register_batch(batch_id, source, content_hash, raw.size, row_count, source)
+            self._record_metrics('ingest', batch_id=batch_id)
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            self._collect_bronze_files()
+            raise
+        self._collect_bronze_files()
+
+        logger.info(f"📦 Loaded batch {batch_id}: {row_count} rows from {source} ({raw.size} bytes streamed)")
+        return batch_id
+
+    def _register_batch(self, batch_id, source, content_hash, file_size, row_count, source_key):
+        """
+        Writes the manifest entry for a freshly inserted batch and applies restatements.
+        source_key identifies where the batch came from (a file's absolute path, an upload's name).
+        """
+        # The entry goes in first: Parquet bronze only shows batches the manifest knows about
+        self.con.execute("""
+            INSERT INTO bronze_batches
+                (batch_id, source, content_hash, file_size, row_count, loaded_at, source_key)
+            VALUES (?, ?, ?, ?, ?, now(), ?)
+        """, [batch_id, source, content_hash, file_size, row_count, source_key])
+        billing_period, account_ids = self.con.execute(f"""
+            SELECT
+                date_trunc('month', MIN(CAST("LineItem/UsageStartDate" AS DATE)))::DATE,
+                string_agg(DISTINCT "LineItem/UsageAccountId", ',' ORDER BY "LineItem/UsageAccountId")
+            FROM bronze_billing WHERE _batch_id = {batch_id}
+        """).fetchone()
+        self.con.execute(
+            "UPDATE bronze_batches SET billing_period = ?, account_ids = ? WHERE batch_id = ?",
+            [billing_period, account_ids, batch_id]
+        )
+        self._replace_restated_batches(batch_id, source, billing_period)
+
+    def _replace_restated_batches(self, batch_id, source, billing_period):
+        """
+        RESTATEMENTS: AWS reissues a billing period of a report, e.g. dropped again at the same path.
+        The new batch supersedes older live batches with the same source (source_key), accounts and
+        period; their bronze rows are dropped and run_pipeline() retracts them from Silver/Gold.
+        Unrelated files that merely share a name (other folders, other accounts) are kept.
+        """
+        replaced = [r[0] for r in self.con.execute("""
+            SELECT b.batch_id FROM bronze_batches b, bronze_batches n
+            WHERE n.batch_id = ?
+                AND b.source_key = n.source_key
+                AND b.account_ids IS NOT DISTINCT FROM n.account_ids
+                AND b.billing_period = n.billing_period
+                AND b.batch_id <> n.batch_id AND b.replaced_by IS NULL
+        """, [batch_id]).fetchall()]
+        if not replaced:
+            return
+
+        logger.info(f"♻️  {source} restates {billing_period}: replacing batch(es) {replaced}")
+        if self.bronze_backend != 'parquet':
+            # (Parquet files drop out of the view with the manifest update and are removed after commit)
+            self._restore_dropped_copies(replaced)
+            self.con.execute(f"DELETE FROM bronze_billing WHERE _batch_id IN ({_id_list(replaced)})")
+        self.con.execute(
+            f"UPDATE bronze_batches SET replaced_by = ? WHERE batch_id IN ({_id_list(replaced)})",
+            [batch_id]
+        )
+
+    def _restore_dropped_copies(self, replaced):
+        """
+        Rows compaction dropped from other live batches because a replaced batch held the kept copy
+        are loaded again under their own batch, before the replaced rows go. Their records stay
+        until run_pipeline() retracts the replaced batch, which then rebuilds Silver in full.
+        """
+        columns = ", ".join(_ident(c) for c in self.ingest_columns)
+        restored = self.con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE _restored_copies AS
+            SELECT c.batch_id, c.copies, k.* EXCLUDE (_row_hash, _batch_id)
+            FROM bronze_dropped_copies c
+                JOIN (
+                    SELECT DISTINCT ON (_batch_id, _row_hash) *
+                    FROM (SELECT *, hash({columns}) AS _row_hash FROM bronze_billing WHERE _batch_id IN ({_id_list(replaced)}))
+                ) k ON k._row_hash = c.row_hash AND k._batch_id = c.kept_by
+            WHERE c.batch_id NOT IN ({_id_list(replaced)})
+                AND c.batch_id IN (SELECT batch_id FROM bronze_batches WHERE replaced_by IS NULL)
+        """).fetchone()[0]
+        # Copies the replaced batches lost themselves are gone with them
+        self.con.execute(f"DELETE FROM bronze_dropped_copies WHERE batch_id IN ({_id_list(replaced)})")
+        if not restored:
+            return
+        self.con.execute("""
+            INSERT INTO bronze_billing BY NAME
+            SELECT r.* EXCLUDE (batch_id, copies), r.batch_id AS _batch_id FROM _restored_copies r, range(r.copies)
+        """)
+        self.con.execute("""
+            UPDATE bronze_batches b SET row_count = b.row_count + r.copies
+            FROM (SELECT batch_id, SUM(copies) AS copies FROM _restored_copies GROUP BY batch_id) r
+            WHERE b.batch_id = r.batch_id
         """)
+        logger.info(f"♻️  Restored {restored} line item(s) compaction had dropped in favour of batch(es) {replaced}")
+
+    def run_pipeline(self, full_refresh=False):
+        """
+        Orchestrates the Silver and Gold transformations.
+        By default only bronze batches not yet processed are transformed and merged;
+        full_refresh=True (or a warehouse without Silver state) rebuilds everything.
+        """
+        pending = [r[0] for r in self.con.execute("""
+            SELECT batch_id FROM bronze_batches
+            WHERE processed_at IS NULL AND replaced_by IS NULL
+            ORDER BY batch_id
+        """).fetchall()]
+        # Replaced batches Silver already absorbed; batches replaced before processing never got in
+        retracted = [r[0] for r in self.con.execute("""
+            SELECT batch_id FROM bronze_batches
+            WHERE replaced_by IS NOT NULL AND processed_at IS NOT NULL AND retracted_at IS NULL
+            ORDER BY batch_id
+        """).fetchall()]
+
+        self._ensure_bronze_storage()
+        self._ensure_resource_keys()
+        graph = self._models()
+        states = self._model_states(graph)
+        recorded = self._recorded_states()
+        incremental_ready = all(self._table_exists(name) for name in graph) \
+            and 'untagged_cost' in self._columns('silver_daily_usage')  # (Silver from older releases gets rebuilt)
+        # Incremental merges assume the models did not change since they were built
+        code_changed = [name for name in graph if recorded.get(name, (None, None))[0] != states[name][0]]
+
+        mode = 'full' if (full_refresh or not incremental_ready or 0 in pending) else 'incremental'
+        if mode == 'incremental' and code_changed and (pending or retracted):
+            mode = 'full'
+        # Copies restored to already-processed batches are not in their Silver facts
+        restored = self.con.execute(
+            f"SELECT COUNT(*) FROM bronze_dropped_copies WHERE kept_by IN ({_id_list(retracted)})"
+        ).fetchone()[0]
+        if mode == 'incremental' and restored:
+            mode = 'full'
+        stale = []
+        if mode == 'incremental' and not (pending or retracted):
+            # No new data: rebuild only models whose SQL (or an upstream model) changed
+            stale = [name for name in graph if recorded.get(name, (None, None))[1] != states[name][1]]
+            if not stale:
+                logger.info("💤 No new bronze batches. Silver/Gold already up to date.")
+                self._republish_if_behind()
+                return None
+            mode = 'partial'
+
+        self.stage_metrics = []
+        started = time.perf_counter()
+        self.con.begin()
+        try:
+            run_id = self.con.execute("SELECT nextval('pipeline_run_seq')").fetchone()[0]
+            if mode == 'incremental':
+                self._incremental_refresh(pending, retracted)
+                self._record_states(states, graph)
+            else:
+                self._build_models(graph, stale or list(graph), states)
+
+            self.con.execute(f"UPDATE bronze_batches SET processed_at = now() WHERE batch_id IN ({_id_list(pending)})")
+            self.con.execute(f"UPDATE bronze_batches SET retracted_at = now() WHERE batch_id IN ({_id_list(retracted)})")
+            self.con.execute(f"DELETE FROM bronze_dropped_copies WHERE kept_by IN ({_id_list(retracted)})")
+            self._record_metrics(mode, run_id=run_id)
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
+
+        self._publish_snapshot(graph)
+        self.last_run = {
+            "run_id": run_id,
+            "mode": mode,
+            "batches": len(pending),
+            "retracted": len(retracted),
+            "seconds": round(time.perf_counter() - started, 4),
+            "stages": self.stage_metrics,
+        }
+        logger.info(f"✅ Data Refresh Complete ({mode}, {self.last_run['seconds']}s).")
+        return self.last_run
+
+    def _ensure_resource_keys(self):
+        """
+        Surrogate keys: every resource id gets a compact INTEGER once, for good. Fact, dimension
+        and totals join on it; full refreshes keep the registry, so keys never change.
+        """
+        self.con.execute("""
+            CREATE SEQUENCE IF NOT EXISTS resource_key_seq START 1;
+            CREATE TABLE IF NOT EXISTS silver_resource_keys (
+                resource_key INTEGER PRIMARY KEY,
+                resource_id VARCHAR UNIQUE
+            );
+        """)
+
+    def _columns(self, table_name):
+        return [c[0] for c in self.con.execute(f"DESCRIBE {table_name}").fetchall()]
+
+    def _assign_resource_keys(self, bronze_scope=""):
+        with self._stage('silver', 'silver_resource_keys') as stage:
+            sql_keys = self._read_sql('silver_resource_keys')
+            stage['rows'] = self._exec(f"INSERT INTO silver_resource_keys {_scoped(bronze_scope, sql_keys)}").fetchone()[0]
+
+    # --- MODEL DAG ---
+    def _ensure_model_state(self):
+        """What each model was last built from, so unchanged models can be skipped"""
+        self.con.execute("""
+            CREATE TABLE IF NOT EXISTS model_state (
+                model VARCHAR PRIMARY KEY,
+                code_hash VARCHAR,          -- the model's SQL (and the rules it binds)
+                state_hash VARCHAR,         -- code_hash + upstream states + live bronze batches
+                built_at TIMESTAMP
+            );
+        """)
+
+    def _models(self):
+        """The model graph: sql/models plus gold_findings, generated from the enabled detectors"""
+        return load_models(os.path.join(self.root_dir, 'sql/models'), extra=[Model('gold_findings', self._findings_sql())])
+
+    def _model_states(self, graph):
+        """
+        {model: (code_hash, state_hash)}. A model whose state hash matches the recorded one
+        would rebuild exactly the table it already has: neither its SQL, the rules it reads,
+        any upstream model nor (for models reading bronze) the live batches changed.
+        """
+        live_batches = self.con.execute(
+            "SELECT string_agg(batch_id::VARCHAR, ',' ORDER BY batch_id) FROM bronze_batches WHERE replaced_by IS NULL"
+        ).fetchone()[0] or ""
+        rules = json.dumps({k: self.config.get(k) for k in ('business_rules', 'detectors')}, sort_keys=True, default=str)
+        states = {}
+        for wave in waves(graph):
+            for name in wave:
+                model = graph[name]
+                code = model.code_hash(rules if 'getvariable(' in model.sql else "")
+                inputs = [states[d][1] for d in model.depends_on]
+                if 'bronze_billing' in referenced_relations(model.sql):
+                    inputs.append(live_batches)
+                states[name] = (code, hashlib.sha1("|".join([code] + inputs).encode()).hexdigest())
+        return states
+
+    def _recorded_states(self):
+        return {r[0]: (r[1], r[2]) for r in self.con.execute("SELECT model, code_hash, state_hash FROM model_state").fetchall()}
+
+    def _record_states(self, states, names, con=None):
+        for name in names:
+            (con or self.con).execute("INSERT OR REPLACE INTO model_state VALUES (?, ?, ?, now())", [name, *states[name]])
+
+    def _build_model(self, model, con):
+        """Materializes one model on con: a fresh table, a keyed table, or rows appended"""
+        with self._stage(model.layer, model.name) as stage:
+            if 'getvariable(' in model.sql:
+                self._set_detection_rules("SELECT MAX(usage_date) FROM silver_daily_usage", con=con)
+            if model.materialized == 'append':
+                stage['rows'] = self._exec(f"INSERT INTO {model.name} {model.sql}", con=con).fetchone()[0]
+            elif model.primary_key:
+                # Keyed, so incremental runs can merge into it
+                columns = ", ".join(f"{_ident(c[0])} {c[1]}" for c in con.execute(f"DESCRIBE {model.sql}").fetchall())
+                self._exec(f"""
+                    CREATE OR REPLACE TABLE {model.name} ({columns}, PRIMARY KEY ({', '.join(model.primary_key)}))
+                """, con=con)
+                stage['rows'] = self._exec(f"INSERT INTO {model.name} {model.sql}", con=con).fetchone()[0]
+            else:
+                stage['rows'] = self._exec(f"CREATE OR REPLACE TABLE {model.name} AS {model.sql}", con=con).fetchone()[0]
+
+    def _build_in_cursor(self, model, states):
+        """One model in its own connection and transaction (for concurrent waves)"""
+        cursor = self.con.cursor()
+        try:
+            if self._profiling:
+                cursor.execute("SET enable_profiling = 'no_output'")
+            cursor.begin()
+            try:
+                self._build_model(model, cursor)
+                self._record_states(states, [model.name], cursor)
+                cursor.commit()
+            except Exception:
+                cursor.rollback()
+                raise
+        finally:
+            cursor.close()
+
+    def _build_models(self, graph, names, states, workers=1):
+        """
+        Builds the named models wave by wave (a wave only needs earlier waves), recording
+        their states. workers=1 builds in order on the writer connection, inside the caller's
+        transaction; with more, a wave's models run concurrently and each commits on its own.
+        """
+        plan = waves(graph, names)
+        logger.info(f"🧱 Building {sum(map(len, plan))} model(s) in {len(plan)} wave(s)...")
+        for wave in plan:
+            if workers <= 1:
+                for name in wave:
+                    self._build_model(graph[name], self.con)
+                    self._record_states(states, [name])
+            else:
+                with ThreadPoolExecutor(max_workers=min(workers, len(wave))) as pool:
+                    list(pool.map(lambda name: self._build_in_cursor(graph[name], states), wave))
+
+    def run_models(self, select=None, workers=1, force=False):
+        """
+        Builds models by hand, e.g. select='silver_daily_usage+' (it and everything downstream)
+        while iterating on one layer. Models whose SQL and inputs are unchanged since their last
+        build are skipped unless force=True; workers > 1 runs independent models concurrently.
+        Silver must have absorbed every bronze batch first (run_pipeline()).
+        Returns the models built, in build order.
+        """
+        unprocessed = self.con.execute("""
+            SELECT COUNT(*) FROM bronze_batches
+            WHERE (processed_at IS NULL AND replaced_by IS NULL)
+               OR (replaced_by IS NOT NULL AND processed_at IS NOT NULL AND retracted_at IS NULL)
+        """).fetchone()[0]
+        if unprocessed:
+            raise ValueError(f"{unprocessed} bronze batch(es) not yet in Silver: run run_pipeline() first")
+
+        self._ensure_bronze_storage()
+        self._ensure_resource_keys()
+        graph = self._models()
+        states = self._model_states(graph)
+        recorded = self._recorded_states()
+        names = select_models(graph, select) if select else set(graph)
+        if not force:
+            names = {n for n in names if recorded.get(n, (None, None))[1] != states[n][1] or not self._table_exists(n)}
+        if not names:
+            logger.info("💤 Selected models are up to date.")
+            return []
+
+        self.stage_metrics = []
+        run_id = self.con.execute("SELECT nextval('pipeline_run_seq')").fetchone()[0]
+        if workers <= 1:
+            self.con.begin()
+            try:
+                self._build_models(graph, names, states)
+                self._record_metrics('models', run_id=run_id)
+                self.con.commit()
+            except Exception:
+                self.con.rollback()
+                raise
+        else:
+            self._build_models(graph, names, states, workers)
+            self._record_metrics('models', run_id=run_id)
+        self._publish_snapshot(graph)
+        return [name for wave in waves(graph, names) for name in wave]
+
+    def _incremental_refresh(self, batch_ids, retracted_ids=()):
+        """
+        Transforms only the given bronze batches and merges their per-resource totals.
+        Retracted (restated) batches are removed from Silver; resources they touched are recomputed.
+        Dimension history is rebuilt only for resources whose attributes the new rows could change.
+        """
+        # The model SQL reads 'bronze_billing'; a CTE of the same name scopes it to a subset
+        new_bronze = f"WITH bronze_billing AS (SELECT * FROM main.bronze_billing WHERE _batch_id IN ({_id_list(batch_ids)}))"
 
-    def run_pipeline(self):
-        """Orchestrates the Silver and Gold transformations"""
-        
         # --- SILVER LAYER ---
-        logger.info("🥈 Building SILVER layer...")
-        sql_fact = self._read_sql('silver_fact_usage')
-        self.con.execute(f"CREATE OR REPLACE TABLE silver_fact_usage AS {sql_fact}")
-        
-        sql_dim = self._read_sql('silver_dim_resource')
-        self.con.execute(f"CREATE OR REPLACE TABLE silver_dim_resource AS {sql_dim}")
-        
+        logger.info(f"🥈 Merging {len(batch_ids)} new / {len(retracted_ids)} retracted batch(es) into SILVER layer...")
+        self._assign_resource_keys(new_bronze)
+
+        with self._stage('silver', 'silver_fact_usage') as stage:
+            sql_fact = self._read_sql('silver_fact_usage')
+            self._exec(f"CREATE OR REPLACE TEMP TABLE _new_facts AS {_scoped(new_bronze, sql_fact)}")
+            self._exec(f"""
+                CREATE OR REPLACE TEMP TABLE _retracted AS
+                SELECT DISTINCT resource_key FROM silver_fact_usage WHERE batch_id IN ({_id_list(retracted_ids)})
+            """)
+            self._exec(f"DELETE FROM silver_fact_usage WHERE batch_id IN ({_id_list(retracted_ids)})")
+            stage['rows'] = self._exec("INSERT INTO silver_fact_usage SELECT * FROM _new_facts").fetchone()[0]
+
+        with self._stage('silver', 'silver_dim_resource') as stage:
+            # Rows on or after the current version's start that repeat its attributes leave the
+            # history unchanged; anything else (new resource, late data, a changed tag) is rebuilt
+            self._exec(f"""
+                CREATE OR REPLACE TEMP TABLE _dim_changed AS
+                SELECT DISTINCT k.resource_key
+                FROM ({_scoped(new_bronze, "SELECT * FROM bronze_billing")}) b
+                    JOIN silver_resource_keys k ON k.resource_id = b."LineItem/ResourceId"
+                    LEFT JOIN silver_dim_resource d ON d.resource_key = k.resource_key AND d.is_current
+                WHERE d.resource_key IS NULL
+                    OR b."LineItem/UsageStartDate" IS NULL
+                    OR CAST(b."LineItem/UsageStartDate" AS DATE) < d.valid_from
+                    OR b."LineItem/ProductCode" IS DISTINCT FROM d.service
+                    OR COALESCE(b."ResourceTags/user:Owner", 'Unknown') <> d.owner_team
+                UNION
+                SELECT resource_key FROM _retracted
+            """)
+            rebuild_bronze = """WITH bronze_billing AS (
+                SELECT * FROM main.bronze_billing
+                WHERE "LineItem/ResourceId" IN (
+                    SELECT resource_id FROM silver_resource_keys WHERE resource_key IN (SELECT resource_key FROM _dim_changed)
+                )
+            )"""
+            sql_dim = self._read_sql('silver_dim_resource')
+            self._exec("DELETE FROM silver_dim_resource WHERE resource_key IN (SELECT resource_key FROM _dim_changed)")
+            stage['rows'] = self._exec(f"INSERT INTO silver_dim_resource {_scoped(rebuild_bronze, sql_dim)}").fetchone()[0]
+
+        # Idle streaks are measured up to the latest billed day; remember where it stood
+        previous_as_of = self.con.execute("SELECT MAX(usage_date) FROM silver_daily_usage").fetchone()[0]
+        with self._stage('silver', 'silver_daily_usage') as stage:
+            sql_daily = self._read_sql('silver_daily_usage')
+            if retracted_ids:
+                # Subtracting float sums would not land exactly on zero usage: recompute those resources
+                self._exec("DELETE FROM silver_daily_usage WHERE resource_key IN (SELECT resource_key FROM _retracted)")
+                stage['rows'] += self._exec(f"""
+                    INSERT INTO silver_daily_usage
+                    SELECT * FROM ({sql_daily})
+                    WHERE resource_key IN (SELECT resource_key FROM _retracted)
+                """).fetchone()[0]
+            new_facts = """WITH silver_fact_usage AS (
+                SELECT * FROM _new_facts WHERE resource_key NOT IN (SELECT resource_key FROM _retracted)
+            )"""
+            stage['rows'] += self._exec(f"""
+                INSERT INTO silver_daily_usage
+                SELECT * FROM ({_scoped(new_facts, sql_daily)})
+                ON CONFLICT (resource_key, usage_date) DO UPDATE SET
+                    cost = cost + excluded.cost,
+                    usage_amount = usage_amount + excluded.usage_amount,
+                    line_items = line_items + excluded.line_items,
+                    untagged_cost = untagged_cost + excluded.untagged_cost
+            """).fetchone()[0]
+
+        # Totals of the touched resources are re-summed from their daily rows
+        with self._stage('silver', 'silver_resource_totals') as stage:
+            sql_totals = self._read_sql('silver_resource_totals')
+            touched = "SELECT resource_key FROM _new_facts UNION SELECT resource_key FROM _retracted"
+            self._exec(f"DELETE FROM silver_resource_totals WHERE resource_key IN ({touched})")
+            stage['rows'] = self._exec(f"""
+                INSERT INTO silver_resource_totals
+                SELECT * FROM ({sql_totals})
+                WHERE resource_key IN ({touched})
+            """).fetchone()[0]
+
         # --- GOLD LAYER ---
-        logger.info("🥇 Building GOLD layer...")
+        # Only resources with new or retracted facts, or a new dimension version, can change;
+        # when the latest billed day moves on, so can every open idle streak already in Gold
+        logger.info("🥇 Refreshing GOLD rows for affected resources...")
+        as_of = self._set_detection_rules("SELECT MAX(usage_date) FROM silver_daily_usage")
         sql_gold = self._read_sql('gold_zombie_report')
-        self.con.execute(f"CREATE OR REPLACE TABLE gold_zombie_report AS {sql_gold}")
-        
-        logger.info(f"✅ Data Refresh Complete.")
\ No newline at end of file
+        with self._stage('gold', 'gold_zombie_report') as stage:
+            if previous_as_of is not None and (as_of is None or as_of < previous_as_of):
+                # Retractions moved the latest day back: any resource's streak may end there now
+                self._exec("CREATE OR REPLACE TEMP TABLE _affected AS SELECT resource_key, resource_id FROM silver_resource_keys")
+                self._exec("DELETE FROM gold_zombie_report")
+                stage['rows'] = self._exec(f"INSERT INTO gold_zombie_report {sql_gold}").fetchone()[0]
+            else:
+                open_streaks = "" if as_of == previous_as_of else \
+                    "UNION SELECT resource_key FROM silver_resource_keys WHERE resource_id IN (SELECT resource_id FROM gold_zombie_report)"
+                self._exec(f"""
+                    CREATE OR REPLACE TEMP TABLE _affected AS
+                    SELECT k.resource_key, k.resource_id
+                    FROM silver_resource_keys k
+                    WHERE k.resource_key IN (
+                        SELECT resource_key FROM _new_facts
+                        UNION SELECT resource_key FROM _retracted
+                        UNION SELECT resource_key FROM _dim_changed
+                        {open_streaks}
+                    )
+                """)
+                affected_silver = """WITH
+                    silver_daily_usage AS (SELECT * FROM main.silver_daily_usage
+                                           WHERE resource_key IN (SELECT resource_key FROM _affected)),
+                    silver_resource_totals AS (SELECT * FROM main.silver_resource_totals
+                                               WHERE resource_key IN (SELECT resource_key FROM _affected))"""
+                self._exec("""
+                    DELETE FROM gold_zombie_report
+                    WHERE resource_id IN (SELECT resource_id FROM _affected)
+                """)
+                stage['rows'] = self._exec(f"""
+                    INSERT INTO gold_zombie_report
+                    {_scoped(affected_silver, sql_gold)}
+                """).fetchone()[0]
+
+        # Detector windows never cross resources: re-scoring the affected ones is exact
+        with self._stage('gold', 'gold_findings') as stage:
+            affected_daily = """WITH silver_daily_usage AS (
+                SELECT * FROM main.silver_daily_usage WHERE resource_key IN (SELECT resource_key FROM _affected)
+            )"""
+            self._exec("DELETE FROM gold_findings WHERE resource_id IN (SELECT resource_id FROM _affected)")
+            stage['rows'] = self._exec(f"""
+                INSERT INTO gold_findings
+                {_scoped(affected_daily, self._findings_sql())}
+            """).fetchone()[0]
+
+        # COUNT(DISTINCT) rollups do not merge: the cube is re-aggregated in one pass over the daily grain
+        with self._stage('gold', 'gold_cost_cube') as stage:
+            self._exec("DELETE FROM gold_cost_cube")
+            stage['rows'] = self._exec(f"INSERT INTO gold_cost_cube {self._read_sql('gold_cost_cube')}").fetchone()[0]
+        for table in ('_new_facts', '_retracted', '_dim_changed', '_affected'):
+            self.con.execute(f"DROP TABLE {table}")
+
+    def zombie_report(self, since=None):
+        """
+        Runs the Silver and Gold models straight over bronze rows used on or after `since`
+        (a date or ISO string), e.g. a "last 30 days" scan. The persisted tables are untouched.
+        On Parquet bronze only the billing_month partitions from `since` onward are read.
+        Returns the DuckDB result (use .fetchall(), .df(), ...).
+        """
+        filters, params = [], []
+        if since is not None:
+            since = date.fromisoformat(since) if isinstance(since, str) else since
+            filters.append('"LineItem/UsageStartDate" >= ?')
+            params.append(datetime(since.year, since.month, since.day))
+            if self.bronze_backend == 'parquet':
+                filters.append('billing_month >= ?')
+                params.append(since.strftime('%Y-%m'))
+        self._ensure_bronze_storage()
+        where = f"WHERE {' AND '.join(filters)}" if filters else ""
+        self._set_detection_rules(
+            f'SELECT MAX(CAST("LineItem/UsageStartDate" AS DATE)) FROM main.bronze_billing {where}', params
+        )
+        return self.con.execute(f"""
+            WITH bronze_billing AS (SELECT * FROM main.bronze_billing {where}),
+                 silver_resource_keys AS (
+                     SELECT CAST(row_number() OVER (ORDER BY resource_id) AS INTEGER) as resource_key, resource_id
+                     FROM (SELECT DISTINCT "LineItem/ResourceId" as resource_id FROM bronze_billing
+                           WHERE "LineItem/ResourceId" IS NOT NULL)
+                 ),
+                 silver_fact_usage AS ({self._read_sql('silver_fact_usage')}),
+                 silver_dim_resource AS ({self._read_sql('silver_dim_resource')}),
+                 silver_daily_usage AS ({self._read_sql('silver_daily_usage')}),
+                 silver_resource_totals AS ({self._read_sql('silver_resource_totals')})
+            SELECT * FROM ({self._read_sql('gold_zombie_report')})
+        """, params)
+
+    def archive_bronze_months(self, before):
+        """
+        Moves Parquet bronze partitions for billing months before `before` ('YYYY-MM')
+        to storage.archive_dir. Silver/Gold keep their rows until the next full refresh.
+        Returns the archived months.
+        """
+        if self.bronze_backend != 'parquet':
+            raise ValueError("Archiving needs storage.bronze_backend: parquet")
+        archive_dir = self._storage_dir('archive_dir', 'bronze_archive')
+        archived = []
+        for folder in sorted(glob.glob(os.path.join(self.bronze_dir, 'billing_month=*'))):
+            month = os.path.basename(folder).split('=', 1)[1]
+            if month >= before:
+                continue
+            target = os.path.join(archive_dir, os.path.basename(folder))
+            os.makedirs(archive_dir, exist_ok=True)
+            if os.path.exists(target):
+                # Month archived before (late files): merge into the existing folder
+                for account in os.listdir(folder):
+                    os.makedirs(os.path.join(target, account), exist_ok=True)
+                    for name in os.listdir(os.path.join(folder, account)):
+                        shutil.move(os.path.join(folder, account, name), os.path.join(target, account, name))
+                shutil.rmtree(folder)
+            else:
+                shutil.move(folder, target)
+            archived.append(month)
+        if archived:
+            self._create_bronze_view()
+            logger.info(f"🗄️  Archived bronze months {archived} to {archive_dir}")
+        return archived
+
+    # --- BRONZE MAINTENANCE ---
+    def compact_bronze(self):
+        """
+        Maintenance for the bronze table: drops rows that overlapping uploads loaded twice (a row
+        already loaded by an earlier live batch; repeats within one batch are kept) and records them
+        in bronze_dropped_copies, so a restatement of the kept batch restores them; rewrites the
+        rest sorted by (usage date, resource id) so DuckDB's min/max zone maps prune, and
+        reclaims the freed file space. Readers are unaffected (they read Gold snapshots).
+        When duplicates were dropped, Silver/Gold are fully rebuilt (before the space is reclaimed)
+        and a new snapshot is published. Returns a before/after report.
+        """
+        if self.bronze_backend == 'parquet':
+            raise ValueError("Compaction rewrites the bronze table; Parquet bronze is laid out per batch")
+        self._ensure_bronze_storage()
+        logger.info("🧽 Compacting BRONZE layer...")
+        rows_before, bytes_before = self._bronze_footprint()
+        probe_before = self._bronze_probe()
+
+        columns = ", ".join(_ident(c) for c in self.ingest_columns)
+        # The rewrite must land in sort order; the resources profile may let inserts reorder
+        preserve_order = self.con.execute("SELECT current_setting('preserve_insertion_order')").fetchone()[0]
+        self.con.execute("SET preserve_insertion_order = true")
+        self.stage_metrics = []
+        self.con.begin()
+        try:
+            with self._stage('bronze', 'compact') as stage:
+                ranked = f"SELECT *, MIN(_batch_id) OVER (PARTITION BY {columns}) AS _first_batch FROM bronze_billing"
+                # Record what is dropped, so restating the kept batch brings the other copies back
+                self._exec(f"""
+                    CREATE OR REPLACE TEMP TABLE _dropped_copies AS
+                    SELECT hash({columns}) AS row_hash, _batch_id AS batch_id, _first_batch AS kept_by, COUNT(*) AS copies
+                    FROM ({ranked})
+                    WHERE _batch_id <> _first_batch
+                    GROUP BY ALL
+                """)
+                self._exec("INSERT INTO bronze_dropped_copies SELECT * FROM _dropped_copies")
+                self._exec("""
+                    UPDATE bronze_batches b SET row_count = b.row_count - d.copies
+                    FROM (SELECT batch_id, SUM(copies) AS copies FROM _dropped_copies GROUP BY batch_id) d
+                    WHERE b.batch_id = d.batch_id
+                """)
+                stage['rows'] = self._exec(f"""
+                    CREATE OR REPLACE TABLE bronze_compacted AS
+                    SELECT * EXCLUDE (_first_batch) FROM ({ranked})
+                    WHERE _batch_id = _first_batch
+                    ORDER BY "LineItem/UsageStartDate", "LineItem/ResourceId"
+                """).fetchone()[0]
+                self._exec("DROP TABLE bronze_billing")
+                self._exec("ALTER TABLE bronze_compacted RENAME TO bronze_billing")
+            self._record_metrics('compact')
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            self.con.execute(f"SET preserve_insertion_order = {str(preserve_order).lower()}")
+            raise
+        self.con.execute(f"SET preserve_insertion_order = {str(preserve_order).lower()}")
+        rows_after = stage['rows']
+        if rows_after < rows_before:
+            # Silver still holds the dropped copies
+            self.run_pipeline(full_refresh=True)
+        self._reclaim_space()
+
+        _, bytes_after = self._bronze_footprint()
+        probe_after = self._bronze_probe()
+        report = {
+            "rows_before": rows_before,
+            "rows_after": rows_after,
+            "duplicates_removed": rows_before - rows_after,
+            "bytes_before": bytes_before,
+            "bytes_after": bytes_after,
+            "probe_seconds_before": probe_before[0],
+            "probe_seconds_after": probe_after[0],
+            "probe_rows_scanned_before": probe_before[1],
+            "probe_rows_scanned_after": probe_after[1],
+            "refreshed": rows_after < rows_before,
+        }
+        logger.info(
+            f"🧽 Bronze compacted: {report['duplicates_removed']} duplicate row(s) dropped, "
+            f"{bytes_before} -> {bytes_after} bytes, one-day scan {probe_before[0]}s -> {probe_after[0]}s "
+            f"({probe_before[1]} -> {probe_after[1]} rows read)"
+        )
+        return report
+
+    def _bronze_footprint(self):
+        """(bronze rows, warehouse bytes on disk once checkpointed)"""
+        rows = self.con.execute("SELECT COUNT(*) FROM bronze_billing").fetchone()[0]
+        if self.db_path == ':memory:':
+            return rows, 0
+        self.con.execute("CHECKPOINT")
+        return rows, os.path.getsize(self.db_path)
+
+    def _bronze_probe(self, repeats=3):
+        """
+        (seconds, rows scanned) of a one-day bronze query, the shape Silver's date filters take;
+        how many rows it reads shows how well the zone maps prune. Best of `repeats`.
+        """
+        day = self.con.execute(
+            'SELECT quantile_disc(CAST("LineItem/UsageStartDate" AS DATE), 0.5) FROM bronze_billing'
+        ).fetchone()[0]
+        if day is None:
+            return 0.0, 0
+        sql = """
+            SELECT COUNT(*), SUM("LineItem/UnblendedCost") FROM bronze_billing
+            WHERE "LineItem/UsageStartDate" >= ? AND "LineItem/UsageStartDate" < ?
+        """
+        params = [datetime(day.year, day.month, day.day), datetime(day.year, day.month, day.day) + timedelta(days=1)]
+        best, scanned = None, 0
+        for _ in range(repeats):
+            started = time.perf_counter()
+            self.con.execute(sql, params).fetchall()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        if self._profiling:
+            scanned = json.loads(self.con.get_profiling_information(format='json')).get("cumulative_rows_scanned", 0)
+        return round(best, 4), scanned
+
+    def _reclaim_space(self):
+        """
+        DuckDB reuses freed blocks but never shrinks its file: the catalog is copied into a fresh
+        file, which replaces the warehouse while the exclusive lock is still held. A writer waiting
+        for the lock then opens the new file; readers use snapshots and never notice.
+        """
+        if self.db_path == ':memory:':
+            return
+        tmp_path = f"{self.db_path}.compact.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)  # left behind by a compaction that crashed
+        self.con.execute("CHECKPOINT")
+        database = self.con.execute("SELECT current_database()").fetchone()[0]
+        self.con.execute("SET preserve_insertion_order = true")  # keep sorted tables sorted
+        self.con.execute(f"ATTACH {_sql_str(tmp_path)} AS compacted")
+        try:
+            self.con.execute(f"COPY FROM DATABASE {_ident(database)} TO compacted")
+        finally:
+            self.con.execute("DETACH compacted")
+        os.replace(tmp_path, self.db_path)
+        self.con.close()
+        self.con = self._connect_writer()
+        if self._profiling:
+            self.con.execute("SET enable_profiling = 'no_output'")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run the Silver/Gold pipeline, or build selected models")
+    parser.add_argument("--select", help="Models to build, e.g. 'silver_daily_usage+' (default: the pipeline)")
+    parser.add_argument("--workers", type=int, default=1, help="Independent models built concurrently (with --select)")
+    parser.add_argument("--full-refresh", action="store_true", help="Rebuild even unchanged models")
+    parser.add_argument("--db", help="Warehouse file (default: data/warehouse.duckdb)")
+    parser.add_argument("--compact", action="store_true", help="Deduplicate, re-sort and shrink bronze instead")
+    args = parser.parse_args()
+
+    engine = CloudBillHunter(db_path=args.db)
+    try:
+        if args.compact:
+            logger.info(f"📊 {json.dumps(engine.compact_bronze())}")
+        elif args.select:
+            built = engine.run_models(select=args.select, workers=args.workers, force=args.full_refresh)
+            logger.info(f"✅ Built {len(built)} model(s): {', '.join(built) or 'none'}")
+        else:
+            engine.run_pipeline(full_refresh=args.full_refresh)
+    finally:
+        engine.close()
@@ -1,79 +1,546 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
-import shutil
+from fastapi import BackgroundTasks, FastAPI, UploadFile, File, HTTPException, Request, Query
+from fastapi.responses import StreamingResponse, Response, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+from typing import List
+import pyarrow as pa
+import anyio
+import base64
+import hashlib
+import json
+import io
 import os
-import duckdb
+import yaml
 import logging
-from src.analyze_costs import CloudBillHunter
+from datetime import date
+from src.analyze_costs import PayloadTooLarge, UnsupportedEncoding, check_encoding, duckdb_settings
+from src.jobs import JobQueue
+from src.preview import preview_upload, refine_preview
+from src.readers import ReaderPool, ResultCache, SnapshotUnavailable
+from src.shards import member_versions, read_source
 
 # Initialize API and Logger
 app = FastAPI(title="Cloud Bill Hunter API", version="2.2.0")
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("API")
 
-# Setup paths
-UPLOAD_DIR = "data/uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-
 # UPDATED: Use Env Var for testing isolation
 WAREHOUSE_PATH = os.getenv("WAREHOUSE_PATH", "data/warehouse.duckdb")
+JOBS_DIR = os.getenv("JOBS_DIR", "data/jobs")
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config.yaml'), 'r') as f:
+    CONFIG = yaml.safe_load(f)
+UPLOAD_CONFIG = CONFIG['uploads']
+
+# Uploads are queued here and drained by the single writer (src/worker.py)
+job_queue = JobQueue(JOBS_DIR)
+
+# Reads reuse pooled connections and are answered from memory until Gold changes.
+# With sharding enabled they go to the federation of every shard's snapshot.
+reader_pool = ReaderPool(
+    read_source(WAREHOUSE_PATH, CONFIG), CONFIG['api']['reader_pool_size'], CONFIG['api']['reader_idle_seconds'], duckdb_settings(CONFIG)
+)
+result_cache = ResultCache(CONFIG['api']['result_cache_entries'])
 
 @app.get("/")
 def health_check():
     return {"status": "online", "service": "Cloud Bill Hunter", "version": "2.2.0"}
 
-@app.post("/analyze/upload")
-async def analyze_upload(file: UploadFile = File(...)):
+class RequestBodyReader:
+    """
+    Exposes the async request body as a blocking read(n) stream.
+    Only usable from a worker thread (run_in_threadpool), which pulls chunks off the event loop.
+    """
+    def __init__(self, request):
+        self._chunks = request.stream().__aiter__()
+        self._buffer = b""
+        self._done = False
+
+    def read(self, n=-1):
+        while not self._done and (n is None or n < 0 or len(self._buffer) < n):
+            try:
+                self._buffer += anyio.from_thread.run(self._chunks.__anext__)
+            except StopAsyncIteration:
+                self._done = True
+        if n is None or n < 0:
+            n = len(self._buffer)
+        data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+def _attach_preview(job_id, encoding):
+    """Approximate result of a queued upload (None if it cannot be computed, or the exact one won the race)"""
     try:
-        file_location = os.path.join(UPLOAD_DIR, file.filename)
-        with open(file_location, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-            
-        logger.info(f"📥 Received file: {file.filename}")
-
-        # Inject the correct Warehouse Path
-        engine = CloudBillHunter(db_path=WAREHOUSE_PATH)
-        try:
-            engine.ingest_data(file_location)
-            engine.run_pipeline()
-            
-            zombie_df = engine.con.execute("SELECT * FROM gold_zombie_report").df()
-            report = zombie_df.to_dict(orient="records")
-            total_waste = sum(item['total_wasted_cost'] for item in report)
-            
-            return {
-                "status": "success",
-                "zombies_found": len(report),
-                "total_wasted_cost": total_waste,
-                "details": report
-            }
-        finally:
-            engine.close()
+        preview = preview_upload(job_queue.payload_path(job_id), CONFIG, encoding)
+    except Exception as e:
+        logger.warning(f"Preview skipped for job {job_id}: {str(e)}")
+        return None
+    return preview if job_queue.set_preview(job_id, preview) else None
 
+def _refine_preview(job_id, encoding, preview):
+    """Background: replaces a job's sample preview with full-pass figures, while the job is still pending"""
+    try:
+        refined = refine_preview(job_queue.payload_path(job_id), CONFIG, preview, encoding)
+    except Exception as e:
+        logger.warning(f"Preview refinement skipped for job {job_id}: {str(e)}")
+        return
+    job_queue.set_preview(job_id, refined)
+
+@app.post("/analyze/upload", status_code=202)
+async def analyze_upload(request: Request, background_tasks: BackgroundTasks, file: UploadFile = File(None), preview: bool = False):
+    """
+    Accepts a CUR file as a multipart 'file' field, or as the raw request body
+    (name via X-Filename, gzip/zstd via Content-Encoding) and queues it for the writer.
+    Returns a job id at once; poll GET /jobs/{job_id} for progress and the result.
+    With ?preview=true the response also carries an approximate result from a sample of the
+    file (numbers flagged "approximate": true, with low/high bounds). A full pass over the file
+    then refines it in the background; GET /jobs/{job_id} shows the latest preview until the
+    exact result replaces it.
+    """
+    try:
+        # Security: never trust client paths. Unnamed uploads get a job-unique name from the queue,
+        # so they are never taken for a restatement of one another.
+        if file is not None:
+            source = os.path.basename(file.filename or "") or None
+            stream, encoding = file.file, None
+        else:
+            source = os.path.basename(request.headers.get("x-filename") or "") or None
+            stream, encoding = RequestBodyReader(request), request.headers.get("content-encoding")
+        encoding = check_encoding(encoding)
+
+        logger.info(f"📥 Receiving file: {source or '(unnamed)'}")
+        job_id = await run_in_threadpool(
+            job_queue.submit, stream, source, encoding, UPLOAD_CONFIG['max_bytes'], UPLOAD_CONFIG['chunk_bytes']
+        )
+        response = {"status": "queued", "job_id": job_id, "status_url": f"/jobs/{job_id}"}
+        if preview:
+            response["preview"] = await run_in_threadpool(_attach_preview, job_id, encoding)
+            if response["preview"] is not None:
+                background_tasks.add_task(_refine_preview, job_id, encoding, response["preview"])
+        return response
+
+    except PayloadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except UnsupportedEncoding as e:
+        raise HTTPException(status_code=415, detail=str(e))
     except Exception as e:
         logger.error(f"Analysis failed: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return job
+
+# --- /zombies QUERY PUSHDOWN ---
+ZOMBIE_COLUMNS = ("resource_id", "service", "owner_team", "total_wasted_cost")
+# Keyset pages are ordered by the sort column, then this to make every position unique
+# (Gold has exactly one row per resource)
+KEYSET_TIEBREAK = ("resource_id",)
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+STREAM_BATCH_ROWS = 10000
+
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def _decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def build_zombie_query(owner=None, service=None, min_cost=None, sort="-total_wasted_cost",
+                       fields=None, cursor=None, limit=None):
+    """
+    Translates /zombies parameters into one DuckDB query (filters, keyset position,
+    ordering, projection and limit all pushed down). Returns (sql, params, fields, key_count).
+    The last key_count columns of each row are the keyset values for the next cursor.
+    """
+    fields = [f.strip() for f in fields.split(",")] if fields else list(ZOMBIE_COLUMNS)
+    unknown = [f for f in fields if f not in ZOMBIE_COLUMNS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {unknown}")
+
+    descending = sort.startswith("-")
+    sort_column = sort.lstrip("-+")
+    if sort_column not in ZOMBIE_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"Unknown sort column: {sort_column}")
+    keys = [sort_column] + [c for c in KEYSET_TIEBREAK if c != sort_column]
+    # NULL never compares, so text keys are coalesced for the keyset
+    key_exprs = [k if k == "total_wasted_cost" else f"COALESCE({k}, '')" for k in keys]
+
+    where, params = [], []
+    if owner:
+        where.append(f"owner_team IN ({', '.join('?' for _ in owner)})")
+        params += owner
+    if service:
+        where.append(f"service IN ({', '.join('?' for _ in service)})")
+        params += service
+    if min_cost is not None:
+        where.append("total_wasted_cost >= ?")
+        params.append(min_cost)
+    if cursor:
+        position = _decode_cursor(cursor)
+        if len(position) != len(keys):
+            raise HTTPException(status_code=400, detail="Cursor does not match the sort order")
+        where.append(f"({', '.join(key_exprs)}) {'<' if descending else '>'} ({', '.join('?' for _ in keys)})")
+        params += position
+
+    direction = "DESC" if descending else "ASC"
+    sql = f"""
+        SELECT {', '.join(fields + [f'{e} AS _key{i}' for i, e in enumerate(key_exprs)])}
+        FROM gold_zombie_report
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        ORDER BY {', '.join(f'{e} {direction}' for e in key_exprs)}
+        {'LIMIT ' + str(int(limit)) if limit is not None else ''}
+    """
+    return sql, params, fields, len(keys)
+
+class _ChunkSink(io.RawIOBase):
+    """Collects what the Arrow IPC writer emits so it can be yielded chunk by chunk"""
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data, self.chunks = b"".join(self.chunks), []
+        return data
+
+def _stream_rows(sql, params, fields, output, version):
+    """Yields NDJSON lines or Arrow IPC chunks batch by batch; pandas is never involved"""
+    with reader_pool.connection(version) as con:
+        result = con.execute(sql, params)
+        # DuckDB >= 1.5 renamed fetch_record_batch
+        to_reader = getattr(result, "to_arrow_reader", None) or result.fetch_record_batch
+        reader = to_reader(STREAM_BATCH_ROWS)
+        if output == "arrow":
+            sink = _ChunkSink()
+            with pa.ipc.new_stream(sink, pa.schema([reader.schema.field(f) for f in fields])) as writer:
+                for batch in reader:
+                    writer.write_batch(batch.select(fields))
+                    yield sink.drain()
+            yield sink.drain()
+        else:
+            for batch in reader:
+                yield "".join(json.dumps(row) + "\n" for row in batch.select(fields).to_pylist())
+
+def _gold_ready(con, table="gold_zombie_report"):
+    return con.execute(
+        "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = ?", [table]
+    ).fetchone()[0] > 0
+
 @app.get("/zombies")
-def get_zombies():
-    if not os.path.exists(WAREHOUSE_PATH):
+def get_zombies(
+    request: Request,
+    owner: List[str] = Query(None, description="Owner team(s) to include"),
+    service: List[str] = Query(None, description="AWS service(s) to include"),
+    min_cost: float = Query(None, description="Minimum total_wasted_cost"),
+    sort: str = Query("-total_wasted_cost", description="Column to sort by; prefix '-' for descending"),
+    fields: str = Query(None, description="Comma-separated columns to return"),
+    cursor: str = Query(None, description="next_cursor from the previous page"),
+    limit: int = Query(None, ge=1, description="Page size (JSON: default 1000, max 10000; streams: unlimited)"),
+    format: str = Query("json", pattern="^(json|ndjson|arrow)$", description="json | ndjson | arrow"),
+):
+    """
+    Zombie resources with server-side filtering, sorting, field selection and keyset paging.
+    format=ndjson / format=arrow stream the result in constant memory.
+    Responses carry an ETag per warehouse version; If-None-Match gets a 304 until Gold changes.
+    """
+    # Validate and plan everything before touching the warehouse
+    page_size = min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    if format == "json":
+        # One extra row tells us whether another page exists
+        sql, params, selected, key_count = build_zombie_query(owner, service, min_cost, sort, fields, cursor, page_size + 1)
+        count_sql, count_params, _, _ = build_zombie_query(owner, service, min_cost, sort, "resource_id")
+    else:
+        sql, params, selected, key_count = build_zombie_query(owner, service, min_cost, sort, fields, cursor, limit)
+
+    version, snapshot = reader_pool.source.current()
+    if snapshot is None:
+        return {"status": "empty", "message": "No data yet."}
+
+    request_key = hashlib.sha1(repr(sorted(request.query_params.multi_items())).encode()).hexdigest()[:16]
+    etag = f'W/"{version}-{request_key}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    cached = result_cache.get(version, request_key) if format == "json" else None
+    if cached is not None:
+        return Response(content=cached, media_type="application/json", headers={"ETag": etag})
+
+    try:
+        with reader_pool.connection(version) as con:
+            if not _gold_ready(con):
+                return {"status": "empty", "message": "Pipeline has not run yet."}
+            if format == "json":
+                rows = con.execute(sql, params).fetchall()
+                total = con.execute(f"SELECT COUNT(*) FROM ({count_sql})", count_params).fetchone()[0]
+
+        if format != "json":
+            media_type = "application/vnd.apache.arrow.stream" if format == "arrow" else "application/x-ndjson"
+            return StreamingResponse(_stream_rows(sql, params, selected, format, version), media_type=media_type,
+                                     headers={"ETag": etag})
+
+        next_cursor = _encode_cursor(list(rows[page_size - 1][-key_count:])) if len(rows) > page_size else None
+        body = json.dumps({
+            "status": "success",
+            "count": min(len(rows), page_size),
+            "total": total,
+            "next_cursor": next_cursor,
+            "data": [dict(zip(selected, row[:len(selected)])) for row in rows[:page_size]]
+        }, default=str).encode()
+        result_cache.put(version, request_key, body)
+        return Response(content=body, media_type="application/json", headers={"ETag": etag})
+    except SnapshotUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# --- /findings (detector output) ---
+FINDING_COLUMNS = ("detector", "resource_id", "service", "owner_team", "usage_date",
+                   "observed", "expected", "score", "impact")
+
+@app.get("/findings")
+def get_findings(
+    request: Request,
+    detector: List[str] = Query(None, description="Detector(s) to include, e.g. cost_spike"),
+    owner: List[str] = Query(None, description="Owner team(s) to include"),
+    since: str = Query(None, description="Only findings for days on or after this ISO date"),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Maximum rows"),
+):
+    """
+    Findings of every anomaly detector (gold_findings), largest dollar impact first.
+    Cached per warehouse version like /zombies.
+    """
+    where, params = [], []
+    if detector:
+        where.append(f"detector IN ({', '.join('?' for _ in detector)})")
+        params += detector
+    if owner:
+        where.append(f"owner_team IN ({', '.join('?' for _ in owner)})")
+        params += owner
+    if since:
+        try:
+            params.append(date.fromisoformat(since))
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid date: {since}")
+        where.append("usage_date >= ?")
+    filters = f"WHERE {' AND '.join(where)}" if where else ""
+
+    version, snapshot = reader_pool.source.current()
+    if snapshot is None:
+        return {"status": "empty", "message": "No data yet."}
+    request_key = "findings-" + hashlib.sha1(repr(sorted(request.query_params.multi_items())).encode()).hexdigest()[:16]
+    cached = result_cache.get(version, request_key)
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
+
+    try:
+        with reader_pool.connection(version) as con:
+            if not _gold_ready(con, "gold_findings"):
+                return {"status": "empty", "message": "Pipeline has not run yet."}
+            rows = con.execute(f"""
+                SELECT {', '.join(FINDING_COLUMNS)} FROM gold_findings {filters}
+                ORDER BY impact DESC, detector, resource_id, usage_date
+                LIMIT {int(limit)}
+            """, params).fetchall()
+            total = con.execute(f"SELECT COUNT(*) FROM gold_findings {filters}", params).fetchone()[0]
+        body = json.dumps({
+            "status": "success",
+            "count": len(rows),
+            "total": total,
+            "data": [dict(zip(FINDING_COLUMNS, row)) for row in rows]
+        }, default=str).encode()
+        result_cache.put(version, request_key, body)
+        return Response(content=body, media_type="application/json")
+    except SnapshotUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# --- /rollups (the team x service x month cube) ---
+ROLLUP_DIMENSIONS = ("owner_team", "service", "month")
+ROLLUP_MEASURES = ("total_cost", "wasted_cost", "untagged_cost", "line_items", "resources", "idle_resources")
+
+def build_rollup_query(by="owner_team", owner=None, service=None, month=None, sort="-total_cost", limit=None):
+    """
+    Translates /rollups parameters into a lookup on gold_cost_cube: the cube level grouped by
+    `by` plus every filtered dimension, so drill-downs (by=service&owner=X) are pre-aggregated
+    rows too. Shard rows of the same cell (federated reads) are summed. Returns (sql, params, fields).
+    """
+    dimensions = [d.strip() for d in by.split(",") if d.strip()] if by else []
+    unknown = [d for d in dimensions if d not in ROLLUP_DIMENSIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown dimensions: {unknown}")
+
+    where, params = [], []
+    filtered = []
+    if owner:
+        where.append(f"owner_team IN ({', '.join('?' for _ in owner)})")
+        params += owner
+        filtered.append("owner_team")
+    if service:
+        where.append(f"service IN ({', '.join('?' for _ in service)})")
+        params += service
+        filtered.append("service")
+    if month:
+        try:
+            params += [date.fromisoformat(f"{m}-01") for m in month]
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid month (YYYY-MM): {month}")
+        where.append(f"month IN ({', '.join('?' for _ in month)})")
+        filtered.append("month")
+    level = [d for d in ROLLUP_DIMENSIONS if d in dimensions or d in filtered]
+    where.insert(0, "level = ?")
+    params.insert(0, ",".join(level))
+
+    descending = sort.startswith("-")
+    sort_column = sort.lstrip("-+")
+    if sort_column not in ROLLUP_MEASURES + tuple(dimensions):
+        raise HTTPException(status_code=400, detail=f"Unknown sort column: {sort_column}")
+    fields = dimensions + list(ROLLUP_MEASURES)
+    ties = ", ".join(f"{d} ASC NULLS LAST" for d in dimensions if d != sort_column)
+    sql = f"""
+        SELECT {', '.join(dimensions + [f'SUM({m}) AS {m}' for m in ROLLUP_MEASURES])}
+        FROM gold_cost_cube
+        WHERE {' AND '.join(where)}
+        {'GROUP BY ' + ', '.join(dimensions) if dimensions else ''}
+        ORDER BY {sort_column} {'DESC' if descending else 'ASC'} NULLS LAST{', ' + ties if ties else ''}
+        {'LIMIT ' + str(int(limit)) if limit is not None else ''}
+    """
+    return sql, params, fields
+
+@app.get("/rollups")
+def get_rollups(
+    request: Request,
+    by: str = Query("owner_team", description="Comma-separated dimensions: owner_team, service, month ('' = grand total)"),
+    owner: List[str] = Query(None, description="Owner team(s) to drill into"),
+    service: List[str] = Query(None, description="AWS service(s) to drill into"),
+    month: List[str] = Query(None, description="Month(s) to drill into, YYYY-MM"),
+    sort: str = Query("-total_cost", description="Column to sort by; prefix '-' for descending"),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Maximum rows"),
+):
+    """
+    Cost, waste and resource counts at any drill-down level of owner_team x service x month.
+    Every level is pre-aggregated by the pipeline (gold_cost_cube), so a request is a lookup,
+    not a re-aggregation of detail rows. Cached per warehouse version like /zombies.
+    """
+    sql, params, fields = build_rollup_query(by, owner, service, month, sort, limit)
+
+    version, snapshot = reader_pool.source.current()
+    if snapshot is None:
         return {"status": "empty", "message": "No data yet."}
-        
+    request_key = "rollups-" + hashlib.sha1(repr(sorted(request.query_params.multi_items())).encode()).hexdigest()[:16]
+    cached = result_cache.get(version, request_key)
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
+
     try:
-        con = duckdb.connect(WAREHOUSE_PATH, read_only=True)
-        # Check tables safely
-        tables = [t[0] for t in con.execute("SHOW TABLES").fetchall()]
-        
-        if 'gold_zombie_report' not in tables:
-             con.close()
-             return {"status": "empty", "message": "Pipeline has not run yet."}
-
-        df = con.execute("SELECT * FROM gold_zombie_report").df()
-        con.close()
-        
-        return {
+        with reader_pool.connection(version) as con:
+            if not _gold_ready(con, "gold_cost_cube"):
+                return {"status": "empty", "message": "Pipeline has not run yet."}
+            rows = con.execute(sql, params).fetchall()
+        body = json.dumps({
             "status": "success",
-            "count": len(df),
-            "data": df.to_dict(orient="records")
-        }
+            "by": [f for f in fields if f in ROLLUP_DIMENSIONS],
+            "count": len(rows),
+            "data": [dict(zip(fields, row)) for row in rows]
+        }, default=str).encode()
+        result_cache.put(version, request_key, body)
+        return Response(content=body, media_type="application/json")
+    except SnapshotUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+# --- /metrics (Prometheus text format) ---
+STAGE_METRICS = {
+    "seconds": "Duration of the stage",
+    "rows": "Rows written by the stage",
+    "rows_scanned": "Rows scanned by the stage's statements",
+    "bytes_read": "Bytes read by the stage (file bytes for ingest)",
+    "spilled_bytes": "Peak temp-directory use; non-zero means DuckDB spilled to disk",
+    "peak_buffer_bytes": "Peak DuckDB buffer memory during the stage",
+}
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _label_values(**labels):
+    return ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels.items())
+
+def _prometheus(name, help_text, metric_type, samples):
+    """samples: [(labels dict, value)]"""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        lines.append(f"{name}{{{_label_values(**labels)}}} {value}" if labels else f"{name} {value}")
+    return lines
+
+def _warehouse_metrics(con):
+    """Stage metrics of the latest pipeline run and the latest ingest, from pipeline_metrics"""
+    exists = con.execute(
+        "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = 'pipeline_metrics'"
+    ).fetchone()[0]
+    if not exists:
+        return []
+    columns = list(STAGE_METRICS)
+    stages = con.execute(f"""
+        SELECT mode, layer, stage, {', '.join(columns)} FROM pipeline_metrics
+        WHERE run_id = (SELECT MAX(run_id) FROM pipeline_metrics)
+           OR batch_id = (SELECT MAX(batch_id) FROM pipeline_metrics)
+        ORDER BY recorded_at
+    """).fetchall()
+    runs, last_run_at = con.execute(
+        "SELECT COALESCE(MAX(run_id), 0), epoch(MAX(recorded_at)) FROM pipeline_metrics WHERE run_id IS NOT NULL"
+    ).fetchone()
+
+    lines = []
+    for i, column in enumerate(columns):
+        lines += _prometheus(
+            f"cbh_stage_{column}", f"{STAGE_METRICS[column]} (latest run)", "gauge",
+            [({"mode": r[0], "layer": r[1], "stage": r[2]}, r[3 + i]) for r in stages]
+        )
+    lines += _prometheus("cbh_pipeline_runs_total", "Pipeline runs recorded", "counter", [({}, runs)])
+    if last_run_at is not None:
+        lines += _prometheus("cbh_pipeline_last_run_timestamp_seconds", "When the latest pipeline run finished",
+                             "gauge", [({}, last_run_at)])
+    return lines
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Pipeline stage timings, row counts, bytes and spill, plus API cache and job queue state"""
+    version, snapshot = reader_pool.source.current()
+    warehouse = result_cache.get(version, "metrics")
+    available = 1
+    if warehouse is None:
+        warehouse = []
+        try:
+            if snapshot is not None:
+                with reader_pool.connection(version) as con:
+                    warehouse = _warehouse_metrics(con)
+                result_cache.put(version, "metrics", warehouse)
+        except SnapshotUnavailable:
+            # Superseded mid-request: still report the live figures below
+            available = 0
+
+    lines = list(warehouse)
+    if isinstance(version, int):
+        versions = [({}, version)]
+    else:  # Federated: one series per shard
+        versions = [({"shard": name}, v) for name, v in member_versions(version).items()]
+    lines += _prometheus("cbh_warehouse_version", "Gold version (bumped by each pipeline run)", "gauge", versions)
+    lines += _prometheus("cbh_warehouse_metrics_available", "0 when the Gold snapshot could not be read", "gauge", [({}, available)])
+    lines += _prometheus("cbh_result_cache_hits_total", "Responses served from the result cache", "counter",
+                         [({}, result_cache.hits)])
+    lines += _prometheus("cbh_result_cache_misses_total", "Responses computed from the warehouse", "counter",
+                         [({}, result_cache.misses)])
+    lines += _prometheus("cbh_jobs", "Upload jobs by status", "gauge",
+                         [({"status": status}, count) for status, count in sorted(job_queue.counts().items())])
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
@@ -3,11 +3,23 @@ import requests
 import pandas as pd
 import plotly.express as px
 import os
+import sys
+import json
+import time
+import tempfile
 import duckdb
+import yaml
+from contextlib import closing
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.shards import read_source
 
 # --- CONFIGURATION ---
 API_URL = os.getenv("API_URL", "http://127.0.0.1:8000")
 WAREHOUSE_PATH = os.path.join(os.path.dirname(__file__), '..', 'data/warehouse.duckdb')
+with open(os.path.join(os.path.dirname(__file__), '..', 'config.yaml'), 'r') as f:
+    CONFIG = yaml.safe_load(f)
+GOLD = read_source(WAREHOUSE_PATH, CONFIG)  # The shard federation when sharding is enabled
 
 st.set_page_config(page_title="Cloud Bill Hunter", page_icon="🛡️", layout="wide")
 
@@ -42,31 +54,149 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # --- HELPER: READ FROM WAREHOUSE ---
-def get_warehouse_data():
+# Every loader is cached per Gold source, so Streamlit reruns (each click) reuse results until a
+# pipeline run publishes a new snapshot version. Aggregation, ranking and paging run in DuckDB;
+# only the rows on screen ever reach pandas.
+CACHE_ENTRIES = 64
+PAGE_SIZES = [25, 100, 500]
+BREAKDOWN_TEAMS = 15  # Teams shown individually in the waste breakdown; the rest become "Other teams"
+
+def gold_source():
     """
-    Connects to the Gold Layer in Read-Only mode.
-    Allows dashboard to read data even if the Watcher is active.
+    Where Gold comes from: ("snapshot", version) for the latest published snapshot, else
+    ("session", rows JSON) for the last manual upload. None while there is no data at all.
     """
-    if not os.path.exists(WAREHOUSE_PATH):
-        return None
-    
-    try:
-        # read_only=True is CRITICAL to prevent locking conflicts
-        con = duckdb.connect(database=WAREHOUSE_PATH, read_only=True)
-        
-        # Check tables safely
-        tables = [t[0] for t in con.execute("SHOW TABLES").fetchall()]
-        
-        if 'gold_zombie_report' in tables:
-            df = con.execute("SELECT * FROM gold_zombie_report").df()
-            con.close()
-            return df
-        else:
-            con.close()
+    version, snapshot = GOLD.current()
+    if snapshot is not None:
+        return ("snapshot", version)
+    details = st.session_state.get('data', {}).get('details')
+    if details:
+        return ("session", json.dumps(details, sort_keys=True))
+    return None
+
+def open_gold(source):
+    """
+    Read-only connection to one snapshot version. Snapshots are immutable files, so the
+    dashboard keeps working while the Watcher writes. Session rows are served from memory.
+    """
+    kind, ref = source
+    if kind == "snapshot":
+        return GOLD.open(ref)
+    con = duckdb.connect()
+    con.register("gold_zombie_report", pd.DataFrame(json.loads(ref)))
+    return con
+
+def _has_table(con, table):
+    return table in {t[0] for t in con.execute("SHOW TABLES").fetchall()}
+
+@st.cache_data(max_entries=CACHE_ENTRIES, show_spinner=False)
+def load_summary(source):
+    """Zombie count and total waste, or None before the first report"""
+    with closing(open_gold(source)) as con:
+        if not _has_table(con, "gold_zombie_report"):
             return None
-    except Exception as e:
-        # Fail silently/gracefully so UI doesn't crash
-        return None
+        count, waste = con.execute(
+            "SELECT COUNT(*), COALESCE(SUM(total_wasted_cost), 0) FROM gold_zombie_report"
+        ).fetchone()
+        return {"zombie_count": count, "total_waste": float(waste)}
+
+@st.cache_data(max_entries=CACHE_ENTRIES, show_spinner=False)
+def load_kill_list(source, page, page_size):
+    """One page of the kill list, costliest first (a top-N sort, not a full one)"""
+    with closing(open_gold(source)) as con:
+        return con.execute("""
+            SELECT resource_id, service, owner_team, total_wasted_cost
+            FROM gold_zombie_report
+            ORDER BY total_wasted_cost DESC, resource_id
+            LIMIT ? OFFSET ?
+        """, [page_size, page * page_size]).df()
+
+@st.cache_data(max_entries=CACHE_ENTRIES, show_spinner=False)
+def load_breakdown(source, top_teams=BREAKDOWN_TEAMS):
+    """Waste per team and service; teams outside the costliest top_teams are folded together"""
+    with closing(open_gold(source)) as con:
+        return con.execute("""
+            WITH by_service AS (
+                SELECT
+                    COALESCE(owner_team, 'Unknown') as owner_team,
+                    COALESCE(service, 'Unknown') as service,
+                    SUM(total_wasted_cost) as wasted_cost,
+                    COUNT(*) as resources
+                FROM gold_zombie_report
+                GROUP BY ALL
+            ),
+            teams AS (
+                SELECT owner_team, row_number() OVER (ORDER BY SUM(wasted_cost) DESC, owner_team) as team_rank
+                FROM by_service
+                GROUP BY owner_team
+            )
+            SELECT
+                CASE WHEN t.team_rank <= ? THEN b.owner_team ELSE 'Other teams' END as owner_team,
+                b.service,
+                SUM(b.wasted_cost) as wasted_cost,
+                SUM(b.resources) as resources
+            FROM by_service b
+                JOIN teams t USING (owner_team)
+            GROUP BY ALL
+            ORDER BY wasted_cost DESC
+        """, [top_teams]).df()
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def export_report_csv(source):
+    """The full report as CSV bytes, written by DuckDB (built once per version, on demand)"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "report.csv")
+        with closing(open_gold(source)) as con:
+            con.execute(f"""
+                COPY (SELECT * FROM gold_zombie_report ORDER BY total_wasted_cost DESC, resource_id)
+                TO '{path}' (HEADER)
+            """)
+        with open(path, "rb") as f:
+            return f.read()
+
+@st.cache_data(max_entries=CACHE_ENTRIES, show_spinner=False)
+def load_detectors(source):
+    """Detectors with at least one finding (gold_findings)"""
+    with closing(open_gold(source)) as con:
+        if not _has_table(con, "gold_findings"):
+            return []
+        return [r[0] for r in con.execute("SELECT DISTINCT detector FROM gold_findings ORDER BY 1").fetchall()]
+
+def _detector_filter(detectors):
+    return f"WHERE detector IN ({', '.join('?' for _ in detectors)})" if detectors else "WHERE false"
+
+@st.cache_data(max_entries=CACHE_ENTRIES, show_spinner=False)
+def count_findings(source, detectors):
+    with closing(open_gold(source)) as con:
+        return con.execute(f"SELECT COUNT(*) FROM gold_findings {_detector_filter(detectors)}", list(detectors)).fetchone()[0]
+
+@st.cache_data(max_entries=CACHE_ENTRIES, show_spinner=False)
+def load_findings(source, detectors, page, page_size):
+    """One page of cost spikes, z-score outliers, untagged spend and unit price rises, by impact"""
+    with closing(open_gold(source)) as con:
+        return con.execute(f"""
+            SELECT * FROM gold_findings {_detector_filter(detectors)}
+            ORDER BY impact DESC, detector, resource_id, usage_date
+            LIMIT ? OFFSET ?
+        """, list(detectors) + [page_size, page * page_size]).df()
+
+def paginate(total, key):
+    """Page size and page number widgets; returns (page index, page size)"""
+    col_size, col_page = st.columns([1, 3])
+    page_size = col_size.selectbox("Rows per page", PAGE_SIZES, key=f"{key}_size")
+    pages = max(1, -(-total // page_size))
+    page = col_page.number_input(f"Page (of {pages:,})", min_value=1, max_value=pages, value=1, key=f"{key}_page")
+    return page - 1, page_size
+
+# --- HELPER: WAIT FOR AN UPLOAD JOB ---
+def wait_for_job(job_id, timeout_seconds=600):
+    """Polls GET /jobs/{id} until the writer worker has finished the upload"""
+    deadline = time.time() + timeout_seconds
+    while True:
+        job = requests.get(f"{API_URL}/jobs/{job_id}").json()
+        if job["status"] in ("done", "failed") or time.time() > deadline:
+            return job
+        time.sleep(1)
 
 # --- SIDEBAR NAVIGATION ---
 with st.sidebar:
@@ -88,18 +218,43 @@ if page == "Upload Data":
     st.markdown("Upload your AWS Cost & Usage Report (CUR) to trigger the anomaly detection engine.")
     
     uploaded_file = st.file_uploader("Drop CSV Here", type="csv")
+    quick_preview = st.checkbox("⚡ Quick preview (approximate figures from a sample while the full analysis runs)")
     
     if uploaded_file and st.button("🚀 Run Analysis"):
+        preview_slot = st.empty()
         with st.spinner("Processing in Microservice..."):
             try:
                 files = {"file": (uploaded_file.name, uploaded_file, "text/csv")}
-                response = requests.post(f"{API_URL}/analyze/upload", files=files)
+                response = requests.post(f"{API_URL}/analyze/upload", files=files, params={"preview": quick_preview})
                 
-                if response.status_code == 200:
-                    data = response.json()
-                    st.session_state['data'] = data # Save to session
-                    st.success(f"Success! Processed {uploaded_file.name}")
-                    st.balloons()
+                if response.status_code == 202:
+                    preview = response.json().get("preview")
+                    if preview:
+                        with preview_slot.container():
+                            st.warning(f"≈ APPROXIMATE: estimated from {preview['sample']['blocks']} of "
+                                       f"{preview['sample']['total_blocks']} blocks ({preview['confidence']:.0%} bounds). "
+                                       "Replaced by the exact result when the analysis finishes.")
+                            p1, p2, p3 = st.columns(3)
+                            p1.metric("≈ Total Spend", f"${preview['total_cost']['value']:,.0f}",
+                                      f"± ${(preview['total_cost']['high'] - preview['total_cost']['low']) / 2:,.0f}", delta_color="off")
+                            p2.metric("≈ Zombie Waste", f"${preview['total_wasted_cost']['value']:,.0f}",
+                                      f"± ${(preview['total_wasted_cost']['high'] - preview['total_wasted_cost']['low']) / 2:,.0f}", delta_color="off")
+                            p3.metric("≈ Zombies", f"{preview['zombies_found']['value']:,}")
+                    job = wait_for_job(response.json()["job_id"])
+                    if job["status"] == "done":
+                        if preview:
+                            with preview_slot.container():
+                                st.info("✅ Exact result")
+                                e1, e2 = st.columns(2)
+                                e1.metric("Zombie Waste", f"${job['result']['total_wasted_cost']:,.2f}")
+                                e2.metric("Zombies", f"{job['result']['zombies_found']:,}")
+                        zombies = requests.get(f"{API_URL}/zombies").json()
+                        st.session_state['data'] = {"details": zombies.get("data", [])} # Save to session
+                        st.success(f"Success! Processed {uploaded_file.name}")
+                        st.json(job["timings"])
+                        st.balloons()
+                    else:
+                        st.error(f"Job {job['job_id']} {job['status']}: {job.get('error')}")
                 else:
                     st.error(f"Error: {response.text}")
             except Exception as e:
@@ -113,39 +268,26 @@ elif page == "Dashboard":
     st.caption("Cloud cost anomalies detected from AWS billing and usage data")
 
     # --- DATA RESOLUTION STRATEGY ---
-    # 1. Try Warehouse (Event-Driven)
-    df_zombies = get_warehouse_data()
-    source_type = "Event-Driven (Warehouse)"
-
-    # 2. Fallback to Session State (Manual Upload)
-    if df_zombies is None or df_zombies.empty:
-        if 'data' in st.session_state:
-            df_zombies = pd.DataFrame(st.session_state['data']['details'])
-            source_type = "Manual Upload (Session)"
+    # 1. Warehouse snapshot (Event-Driven), 2. fallback to the last manual upload (Session)
+    source = gold_source()
+    summary = load_summary(source) if source else None
+    source_type = "Event-Driven (Warehouse)" if source and source[0] == "snapshot" else "Manual Upload (Session)"
 
     # 3. Empty State Handler
-    if df_zombies is None or df_zombies.empty:
+    if not summary or summary["zombie_count"] == 0:
         st.info("⏳ Waiting for data... Drop a file in `data/landing_zone` or use the Upload tab.")
         st.stop()
 
-    # --- DATA NORMALIZATION ---
-    # Handle API JSON vs SQL Column naming differences
-    cost_col = "total_wasted_cost" if "total_wasted_cost" in df_zombies.columns else "wasted_cost"
-    owner_col = "owner_team" if "owner_team" in df_zombies.columns else "owner"
-
-    # Ensure numeric types
-    df_zombies[cost_col] = pd.to_numeric(df_zombies[cost_col], errors="coerce").fillna(0)
-
     # --- CALCULATE METRICS ---
-    total_monthly_waste = df_zombies[cost_col].sum()
+    total_monthly_waste = summary["total_waste"]
     annualized_savings = total_monthly_waste * 12
-    zombie_count = len(df_zombies)
+    zombie_count = summary["zombie_count"]
 
     # --- KPI ROW ---
     col1, col2, col3, col4 = st.columns(4)
 
     with col1:
-        st.metric("Zombie Resources", zombie_count, delta="High Priority", delta_color="inverse")
+        st.metric("Zombie Resources", f"{zombie_count:,}", delta="High Priority", delta_color="inverse")
     with col2:
         st.metric("Wasted Spend (Mo)", f"${total_monthly_waste:,.2f}", delta="-100%", delta_color="inverse")
     with col3:
@@ -156,50 +298,73 @@ elif page == "Dashboard":
     st.markdown("---")
 
     # --- TABS FOR DETAIL ---
-    tab1, tab2 = st.tabs(["🔥 Actionable Kill List", "📉 Waste Distribution"])
+    tab1, tab2, tab3 = st.tabs(["🔥 Actionable Kill List", "📉 Waste Distribution", "🚨 Anomalies"])
 
     with tab1:
         st.subheader("Top Cost Offenders")
         st.caption("Ranked by highest monthly waste — fix these first")
 
-        df_ranked = df_zombies.sort_values(by=cost_col, ascending=False).reset_index(drop=True)
+        page_index, page_size = paginate(zombie_count, "kill_list")
+        df_page = load_kill_list(source, page_index, page_size)
+        st.caption(f"Rows {page_index * page_size + 1:,}–{page_index * page_size + len(df_page):,} of {zombie_count:,}")
 
         st.dataframe(
-            df_ranked,
+            df_page,
             width='stretch',
             column_config={
-                cost_col: st.column_config.NumberColumn("Monthly Waste ($)", format="$%.2f"),
-                owner_col: st.column_config.TextColumn("Owner / Team"),
+                "total_wasted_cost": st.column_config.NumberColumn("Monthly Waste ($)", format="$%.2f"),
+                "owner_team": st.column_config.TextColumn("Owner / Team"),
                 "service": "AWS Service",
                 "resource_id": "Resource ID",
             }
         )
 
-        # Download Utility
-        csv = df_ranked.to_csv(index=False).encode("utf-8")
+        # Download Utility (the CSV is only built when clicked, once per Gold version)
         st.download_button(
             "📥 Download Audit Report (CSV)",
-            data=csv,
+            data=lambda: export_report_csv(source),
             file_name="cloud_zombie_audit.csv",
             mime="text/csv",
         )
 
     with tab2:
         st.subheader("Where Is the Money Leaking?")
-        st.caption("Hierarchical breakdown by Team -> Service -> Resource")
-
-        if zombie_count > 0:
-            fig = px.sunburst(
-                df_ranked,
-                path=[owner_col, "service", 'resource_id'],
-                values=cost_col,
-                color=cost_col,
-                color_continuous_scale="RdBu_r",
-                title="Cost Leakage Hierarchy"
-            )
-            st.plotly_chart(fig, width='stretch')
+        st.caption(f"Breakdown by Team -> Service (top {BREAKDOWN_TEAMS} teams; the rest grouped as Other teams)")
+
+        df_breakdown = load_breakdown(source)
+        fig = px.sunburst(
+            df_breakdown,
+            path=["owner_team", "service"],
+            values="wasted_cost",
+            color="wasted_cost",
+            color_continuous_scale="RdBu_r",
+            hover_data=["resources"],
+            title="Cost Leakage Hierarchy"
+        )
+        st.plotly_chart(fig, width='stretch')
+
+    with tab3:
+        st.subheader("Spend Anomalies")
+        st.caption("Cost spikes, z-score outliers, untagged spend and unit price rises vs. each resource's recent days")
+
+        detectors = load_detectors(source)
+        if not detectors:
+            st.success("No anomalies detected!")
         else:
-            st.success("No anomalies to visualize!")
+            chosen = st.multiselect("Detectors", detectors, default=detectors)
+            page_index, page_size = paginate(count_findings(source, tuple(chosen)), "findings")
+            df_findings = load_findings(source, tuple(chosen), page_index, page_size)
+            st.dataframe(
+                df_findings,
+                width='stretch',
+                column_config={
+                    "impact": st.column_config.NumberColumn("Impact ($)", format="$%.2f"),
+                    "score": st.column_config.NumberColumn("Score", format="%.2f"),
+                    "usage_date": "Day",
+                    "owner_team": "Owner / Team",
+                    "resource_id": "Resource ID",
+                }
+            )
 
 # ==========================================
 # PAGE 3: API STATUS
@@ -223,10 +388,11 @@ elif page == "API Status":
             
     with col2:
         st.markdown("### Warehouse Status")
-        if os.path.exists(WAREHOUSE_PATH):
-            st.success(f"Found: {WAREHOUSE_PATH}")
+        version, snapshot = GOLD.current()
+        if snapshot is not None:
+            st.success(f"Gold snapshot v{version}: {snapshot}")
             try:
-                con = duckdb.connect(WAREHOUSE_PATH, read_only=True)
+                con = GOLD.open(version)
                 tables = con.execute("SHOW TABLES").fetchall()
                 st.write("Tables found:", [t[0] for t in tables])
                 con.close()
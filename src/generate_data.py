@@ -1,90 +1,192 @@
-import pandas as pd
-import numpy as np
-from faker import Faker
-import random
-from datetime import datetime, timedelta
+import argparse
 import os
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+import yaml
+
+ROOT_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
-# Initialize Faker and seed for reproducibility
-fake = Faker()
-Faker.seed(42)
-np.random.seed(42)
+# 1. Typical AWS Services and their pricing models (cost per unit of usage)
+SERVICES = {
+    'AmazonEC2': {'unit': 'Hrs', 'cost_range': (0.5, 4.0)},
+    'AmazonRDS': {'unit': 'Hrs', 'cost_range': (1.2, 8.0)},
+    'AmazonS3': {'unit': 'GB-Mo', 'cost_range': (0.023, 0.05)},
+    'AmazonLambda': {'unit': 'Requests', 'cost_range': (0.0000166667, 0.0002)}
+}
+OWNERS = ['engineering', 'data-science', 'marketing', 'unknown']
+ACCOUNTS = ['111111111111', '222222222222', '333333333333']
 
-def generate_billing_data(num_rows=5000):
-    print(f"🚀 Generating {num_rows} rows of synthetic AWS billing data...")
+# --- THE TRAP: a "Zombie Resource" that is always present ---
+# It exists but does nothing useful: cost (reservation/storage) with ZERO usage.
+ZOMBIE_ID = "i-000000-ZOMBIE-ASSET"
+ZOMBIE_DAILY_COST = 45.0
 
-    data = []
+def load_generation_config():
+    with open(os.path.join(ROOT_DIR, 'config.yaml'), 'r') as f:
+        return yaml.safe_load(f)['data_generation']
 
-    # 1. Define typical AWS Services and their pricing models
-    services = {
-        'AmazonEC2': {'unit': 'Hrs', 'cost_range': (0.5, 4.0)},
-        'AmazonRDS': {'unit': 'Hrs', 'cost_range': (1.2, 8.0)},
-        'AmazonS3': {'unit': 'GB-Mo', 'cost_range': (0.023, 0.05)},
-        'AmazonLambda': {'unit': 'Requests', 'cost_range': (0.0000166667, 0.0002)}
+def build_resource_pool(num_resources, zombie_probability, seed):
+    """
+    The fixed cast of resources every chunk draws from, as NumPy arrays indexed by resource.
+    Service, owner, account and zombie status belong to the resource, so they stay
+    consistent across chunks; zombie_probability is the share of zombie resources.
+    """
+    rng = np.random.default_rng([seed, 0xC0FFEE])
+    num_resources = max(int(num_resources), 1)
+
+    ids = np.char.add('i-', np.char.zfill(np.char.mod('%x', rng.integers(1, 2**48, num_resources)), 12))
+    pool = {
+        'resource_id': ids.astype(object),
+        'service': rng.integers(0, len(SERVICES), num_resources),
+        'owner': rng.integers(0, len(OWNERS), num_resources),
+        'account': rng.integers(0, len(ACCOUNTS), num_resources),
+        'is_zombie': rng.random(num_resources) < zombie_probability,
+        'zombie_cost': np.round(rng.uniform(5.0, 50.0, num_resources), 4),
     }
 
-    # 2. Create a list of "Active" Resource IDs to track over time
-    resource_ids = [fake.uuid4() for _ in range(50)]
-
-    # --- THE TRAP: Create a "Zombie Resource" ---
-    # This resource exists but does nothing useful.
-    zombie_id = "i-000000-ZOMBIE-ASSET"
-    resource_ids.append(zombie_id)
-    
-    # Generate dates for the last 90 days
-    end_date = datetime.now()
-    start_date = end_date - timedelta(days=90)
-    
-    for _ in range(num_rows):
-        date = fake.date_between(start_date=start_date, end_date=end_date)
-        service = random.choice(list(services.keys()))
-        resource_id = random.choice(resource_ids)
-        
-        # Default Logic
-        usage_amount = round(random.uniform(1.0, 24.0), 2)
-        cost_per_unit = random.uniform(*services[service]['cost_range'])
-        unblended_cost = round(usage_amount * cost_per_unit, 4)
-        owner_tag = random.choice(['engineering', 'data-science', 'marketing', 'unknown'])
-        
-        # --- INJECT ZOMBIE LOGIC ---
-        # If this is the Zombie ID, it has Cost (Reservation/Storage) but ZERO Usage (CPU/Requests)
-        if resource_id == zombie_id:
-            service = 'AmazonEC2' # It's an idle server
-            usage_amount = 0.0      # Zero CPU utilization or active hours logged as "usage"
-            unblended_cost = 45.0   # But it still costs money (e.g. unattached EBS volume or Reserved Instance)
-            owner_tag = 'legacy-team' # Harder to find who owns it
-
-        data.append({
-            'LineItem/UsageStartDate': date,
-            'LineItem/ResourceId': resource_id,
-            'LineItem/ProductCode': service,
-            'LineItem/UsageAmount': usage_amount,
-            'LineItem/UnblendedCost': unblended_cost,
-            'ResourceTags/user:Owner': owner_tag
-        })
-
-    # Create DataFrame
-    df = pd.DataFrame(data)
-    
-    # Sort by date for realism
-    df['LineItem/UsageStartDate'] = pd.to_datetime(df['LineItem/UsageStartDate'])
-    df = df.sort_values(by='LineItem/UsageStartDate')
-    
-
-    # --- FIX THE PATH LOGIC HERE ---
-    # Get the directory where THIS script is located (e.g., /app/src)
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    
-    # Construct the path to data/raw relative to this script
-    # It resolves to: /app/src/../data/raw/aws_billing_data.csv -> /app/data/raw/...
-    output_path = os.path.join(current_dir, '../data/raw/aws_billing_data.csv')
-    
-    # Normalize the path to remove the '..' (cleaner)
+    # Resource 0 is the showcase zombie: an idle EC2 server nobody remembers owning
+    pool['resource_id'][0] = ZOMBIE_ID
+    pool['service'][0] = list(SERVICES).index('AmazonEC2')
+    pool['owner'][0] = -1
+    pool['is_zombie'][0] = True
+    pool['zombie_cost'][0] = ZOMBIE_DAILY_COST
+    return pool
+
+def generate_chunk(chunk_index, first_row, num_rows, total_rows, pool, start_date, days_back, seed):
+    """
+    Builds rows [first_row, first_row + num_rows) as an Arrow table, fully vectorized.
+    The RNG is seeded from (seed, chunk_index) alone, so output does not depend on which
+    process ran the chunk. Dates advance with the global row number (file is date-sorted).
+    """
+    rng = np.random.default_rng([seed, chunk_index])
+    positions = np.arange(first_row, first_row + num_rows, dtype=np.int64)
+
+    day_offset = (positions * (days_back + 1)) // total_rows
+    dates = np.datetime64(start_date, 'D') + day_offset.astype('timedelta64[D]')
+
+    resource = rng.integers(0, len(pool['resource_id']), num_rows)
+    service = pool['service'][resource]
+    zombie = pool['is_zombie'][resource]
+
+    # Default Logic: usage x a per-service unit price
+    low = np.array([s['cost_range'][0] for s in SERVICES.values()])[service]
+    high = np.array([s['cost_range'][1] for s in SERVICES.values()])[service]
+    usage = np.round(rng.uniform(1.0, 24.0, num_rows), 2)
+    cost = np.round(usage * rng.uniform(low, high), 4)
+
+    # --- INJECT ZOMBIE LOGIC --- cost keeps accruing while usage stays at zero
+    usage = np.where(zombie, 0.0, usage)
+    cost = np.where(zombie, pool['zombie_cost'][resource], cost)
+
+    owner_index = pool['owner'][resource]
+    owners = np.array(OWNERS + ['legacy-team'], dtype=object)[owner_index]  # -1 -> legacy-team
+
+    return pa.table({
+        'LineItem/UsageStartDate': pa.array(dates, type=pa.date32()),
+        'LineItem/ResourceId': pa.array(pool['resource_id'][resource], type=pa.string()),
+        'LineItem/ProductCode': pa.array(np.array(list(SERVICES), dtype=object)[service], type=pa.string()),
+        'LineItem/UsageAmount': pa.array(usage),
+        'LineItem/UnblendedCost': pa.array(cost),
+        'ResourceTags/user:Owner': pa.array(owners, type=pa.string()),
+        'LineItem/UsageAccountId': pa.array(np.array(ACCOUNTS, dtype=object)[pool['account'][resource]], type=pa.string()),
+    })
+
+class _ChunkWriter:
+    """Appends Arrow chunks to one CSV or Parquet file"""
+    def __init__(self, path, fmt, schema):
+        if fmt == 'parquet':
+            self._writer = pq.ParquetWriter(path, schema)
+        elif fmt == 'csv':
+            self._writer = pa_csv.CSVWriter(path, schema)
+        else:
+            raise ValueError(f"Unsupported output format: {fmt}")
+
+    def write(self, table):
+        self._writer.write_table(table)
+
+    def close(self):
+        self._writer.close()
+
+def generate_billing_data(num_rows=None, output_path=None, fmt=None, chunk_rows=None, workers=None, seed=None,
+                          end_date=None):
+    """
+    Writes synthetic CUR rows in chunks, so memory stays bounded at any size.
+    Unset arguments come from config.yaml's data_generation section.
+    Chunks are built in parallel processes (workers=1 keeps it in-process) and written
+    in order; the same seed always yields the same file, whatever the worker count.
+    """
+    cfg = load_generation_config()
+    num_rows = int(num_rows or cfg['rows'])
+    if fmt is None and output_path and output_path.endswith('.parquet'):
+        fmt = 'parquet'
+    fmt = fmt or cfg.get('format', 'csv')
+    chunk_rows = int(chunk_rows or cfg.get('chunk_rows', 1_000_000))
+    workers = workers if workers is not None else cfg.get('workers', 0)
+    workers = int(workers or os.cpu_count() or 1)
+    seed = cfg.get('seed', 42) if seed is None else seed
+    days_back = cfg['days_back']
+
+    if output_path is None:
+        output_path = os.path.join(ROOT_DIR, 'data/raw', f"aws_billing_data.{fmt}")
     output_path = os.path.normpath(output_path)
-   # Save to CSV
-    df.to_csv(output_path, index=False)
-    print(f"✅ Success! Saved to: {output_path}")
-    print(f"👀 Hint: Look for resource '{zombie_id}' in the data.")
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+
+    # Generate dates for the last `days_back` days
+    end_date = end_date or datetime.now().date()
+    start_date = end_date - timedelta(days=days_back)
+
+    print(f"🚀 Generating {num_rows:,} rows of synthetic AWS billing data "
+          f"({chunk_rows:,}-row chunks, {workers} worker(s))...")
+    pool = build_resource_pool(cfg.get('resources', 50), cfg['zombie_probability'], seed)
+    chunks = [
+        (index, first, min(chunk_rows, num_rows - first), num_rows, pool, start_date, days_back, seed)
+        for index, first in enumerate(range(0, num_rows, chunk_rows))
+    ]
+
+    writer = None
+    written = 0
+    try:
+        if workers == 1:
+            for table in (generate_chunk(*args) for args in chunks):
+                writer = writer or _ChunkWriter(output_path, fmt, table.schema)
+                writer.write(table)
+                written += table.num_rows
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # At most 2 chunks per worker in flight, consumed in order: bounded memory
+                remaining = iter(chunks)
+                in_flight = deque(executor.submit(generate_chunk, *args)
+                                  for args in islice(remaining, 2 * workers))
+                while in_flight:
+                    table = in_flight.popleft().result()
+                    next_args = next(remaining, None)
+                    if next_args:
+                        in_flight.append(executor.submit(generate_chunk, *next_args))
+                    writer = writer or _ChunkWriter(output_path, fmt, table.schema)
+                    writer.write(table)
+                    written += table.num_rows
+    finally:
+        if writer:
+            writer.close()
+
+    print(f"✅ Success! Saved {written:,} rows to: {output_path}")
+    print(f"👀 Hint: Look for resource '{ZOMBIE_ID}' in the data.")
+    return output_path
 
 if __name__ == "__main__":
-    generate_billing_data()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Generate synthetic AWS CUR billing data")
+    parser.add_argument("--rows", type=int, help="Row count (default: data_generation.rows)")
+    parser.add_argument("--format", choices=["csv", "parquet"], help="Output format")
+    parser.add_argument("--output", help="Output file (default: data/raw/aws_billing_data.<format>)")
+    parser.add_argument("--chunk-rows", type=int, help="Rows generated per chunk")
+    parser.add_argument("--workers", type=int, help="Processes (default: all cores)")
+    parser.add_argument("--seed", type=int, help="Base seed; each chunk derives its own")
+    args = parser.parse_args()
+    generate_billing_data(args.rows, args.output, args.format, args.chunk_rows, args.workers, args.seed)
@@ -36,15 +36,28 @@ def simulate_cicd_pipeline():
                 f"{API_URL}/analyze/upload", 
                 files=files
             )
-            duration = time.time() - start_time
             
-        if response.status_code == 200:
-            data = response.json()
-            print(f"✅ Pipeline Success ({duration:.2f}s)")
+        if response.status_code != 202:
+            print(f"❌ Pipeline Failed: {response.text}")
+            return
+
+        # The upload is queued; the writer worker picks it up asynchronously
+        job_id = response.json()["job_id"]
+        print(f"🎫 Job queued: {job_id}")
+        while True:
+            job = requests.get(f"{API_URL}/jobs/{job_id}").json()
+            if job["status"] in ("done", "failed"):
+                break
+            time.sleep(1)
+        duration = time.time() - start_time
+
+        if job["status"] == "done":
+            data = job["result"]
+            print(f"✅ Pipeline Success ({duration:.2f}s) - stage timings: {job['timings']}")
             print(f"📊 Warehouse Updated. Zombies Found: {data['zombies_found']}")
             print(f"💰 Total Waste: ${data['total_wasted_cost']:,.2f}")
         else:
-            print(f"❌ Pipeline Failed: {response.text}")
+            print(f"❌ Pipeline Failed: {job['error']}")
     except Exception as e:
         print(f"❌ Connection Error: {e}")
 
@@ -57,17 +70,23 @@ def simulate_slack_bot():
     print("🤖 Bot asking API: 'Are there any zombies right now?'")
     
     try:
-        response = requests.get(f"{API_URL}/zombies")
+        # The bot only needs the count: ask for a single row
+        response = requests.get(f"{API_URL}/zombies", params={"limit": 1, "fields": "resource_id"})
         
         if response.status_code == 200:
             data = response.json()
             if data['status'] == 'success':
-                count = data['count']
+                count = data['total']
                 print(f"✅ Bot Received Data: {count} zombies active.")
                 
                 if count > 0:
                     print("🚨 Bot Action: Posting alert to #engineering-cost channel...")
                     print(f"   '⚠️ Alert: {count} idle resources detected!'")
+                    # Per-team waste is pre-aggregated by the pipeline: one cube lookup, no detail rows
+                    teams = requests.get(f"{API_URL}/rollups",
+                                         params={"by": "owner_team", "sort": "-wasted_cost", "limit": 3}).json()
+                    for team in teams.get("data", []):
+                        print(f"   '   {team['owner_team']}: ${team['wasted_cost']:,.2f} wasted of ${team['total_cost']:,.2f}'")
                 else:
                     print("💚 Bot Action: Posting 'All Systems Green'.")
             else:
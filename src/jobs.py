@@ -0,0 +1,174 @@
+import sqlite3
+import json
+import os
+import time
+import uuid
+import logging
+from contextlib import contextmanager
+from src.analyze_costs import PayloadTooLarge
+
+logger = logging.getLogger("JOBS")
+
+STALE_PART_SECONDS = 6 * 3600
+
+class JobQueue:
+    """
+    Durable upload queue shared by the API (producer) and the writer worker (consumer).
+    Job rows live in SQLite and payloads next to it on disk, so queued work survives
+    restarts of either process. Only the worker ever opens the warehouse for writing.
+    """
+    def __init__(self, jobs_dir):
+        self.jobs_dir = jobs_dir
+        self.payload_dir = os.path.join(jobs_dir, "payloads")
+        os.makedirs(self.payload_dir, exist_ok=True)
+        self.db_path = os.path.join(jobs_dir, "jobs.sqlite")
+
+        with self._connect() as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    source TEXT,
+                    encoding TEXT,
+                    payload_path TEXT,
+                    payload_bytes INTEGER,
+                    status TEXT,          -- queued | running | done | failed
+                    stage TEXT,           -- queued | ingesting | waiting_for_pipeline | transforming | done
+                    run_id TEXT,          -- jobs drained together share one pipeline run
+                    submitted_at REAL,
+                    started_at REAL,
+                    finished_at REAL,
+                    timings TEXT,         -- JSON {stage: seconds}
+                    result TEXT,          -- JSON summary once done
+                    error TEXT,
+                    preview TEXT          -- JSON approximate summary, until the exact result replaces it
+                )
+            """)
+            # Queues created before previews existed
+            if "preview" not in {r[1] for r in con.execute("PRAGMA table_info(jobs)")}:
+                con.execute("ALTER TABLE jobs ADD COLUMN preview TEXT")
+
+    @contextmanager
+    def _connect(self):
+        # Short-lived connections: safe across API threads and the worker process
+        con = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            yield con
+        finally:
+            con.close()
+
+    def submit(self, stream, source, encoding=None, max_bytes=None, chunk_bytes=1024 * 1024):
+        """
+        Copies an upload's raw (still compressed) bytes from a read(n) stream to the payload
+        spool in bounded chunks, then queues it.
+        The row is only inserted once the payload is complete, so a crash never queues half a file.
+        An upload without a name (source None) is named upload-<job_id>.csv.
+        """
+        job_id = uuid.uuid4().hex
+        source = source or f"upload-{job_id}.csv"
+        payload_path = self.payload_path(job_id)
+        partial_path = payload_path + ".part"
+        started = time.time()
+
+        size = 0
+        try:
+            with open(partial_path, "wb") as f:
+                for chunk in iter(lambda: stream.read(chunk_bytes), b""):
+                    size += len(chunk)
+                    if max_bytes and size > max_bytes:
+                        raise PayloadTooLarge(f"Upload exceeds {max_bytes} bytes")
+                    f.write(chunk)
+            os.replace(partial_path, payload_path)
+        except BaseException:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+
+        now = time.time()
+        with self._connect() as con:
+            con.execute(
+                "INSERT INTO jobs VALUES (?, ?, ?, ?, ?, 'queued', 'queued', NULL, ?, NULL, NULL, ?, NULL, NULL, NULL)",
+                [job_id, source, encoding, payload_path, size, now, json.dumps({"upload": round(now - started, 4)})]
+            )
+        logger.info(f"📨 Queued job {job_id} ({source}, {size} bytes)")
+        return job_id
+
+    def payload_path(self, job_id):
+        return os.path.join(self.payload_dir, f"{job_id}.payload")
+
+    def set_preview(self, job_id, preview):
+        """Attaches an approximate result, unless the exact one is already in (returns whether it was)"""
+        with self._connect() as con:
+            return con.execute(
+                "UPDATE jobs SET preview = ? WHERE job_id = ? AND status IN ('queued', 'running')",
+                [json.dumps(preview), job_id]
+            ).rowcount == 1
+
+    def get(self, job_id):
+        with self._connect() as con:
+            con.row_factory = sqlite3.Row
+            row = con.execute("SELECT * FROM jobs WHERE job_id = ?", [job_id]).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["timings"] = json.loads(job["timings"] or "{}")
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        job["preview"] = json.loads(job["preview"]) if job["preview"] else None
+        job.pop("payload_path")
+        return job
+
+    def counts(self):
+        """{status: number of jobs}, for monitoring"""
+        with self._connect() as con:
+            return dict(con.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def claim_all(self):
+        """Atomically moves every queued job to running under one run id (coalescing)"""
+        run_id = uuid.uuid4().hex
+        with self._connect() as con:
+            con.execute("BEGIN IMMEDIATE")
+            con.execute(
+                "UPDATE jobs SET status = 'running', run_id = ?, started_at = ? WHERE status = 'queued'",
+                [run_id, time.time()]
+            )
+            con.row_factory = sqlite3.Row
+            jobs = [dict(r) for r in con.execute(
+                "SELECT * FROM jobs WHERE run_id = ? ORDER BY submitted_at", [run_id]
+            ).fetchall()]
+            con.execute("COMMIT")
+        for job in jobs:
+            job["timings"] = json.loads(job["timings"] or "{}")
+            job["timings"]["queue_wait"] = round(job["started_at"] - job["submitted_at"], 4)
+        return run_id, jobs
+
+    def update(self, job_id, **fields):
+        if "timings" in fields:
+            fields["timings"] = json.dumps(fields["timings"])
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"])
+        assignments = ", ".join(f"{k} = ?" for k in fields)
+        with self._connect() as con:
+            con.execute(f"UPDATE jobs SET {assignments} WHERE job_id = ?", list(fields.values()) + [job_id])
+
+    def finish(self, job, status, result=None, error=None):
+        """Records the outcome and drops the spooled payload; an exact result replaces the preview"""
+        fields = {"preview": None} if status == "done" else {}
+        self.update(job["job_id"], status=status, stage=status, finished_at=time.time(),
+                    timings=job["timings"], result=result, error=error, **fields)
+        if job.get("payload_path") and os.path.exists(job["payload_path"]):
+            os.remove(job["payload_path"])
+
+    def recover(self):
+        """Re-queues jobs a crashed worker left running (ingest is idempotent, so replays are safe)"""
+        with self._connect() as con:
+            count = con.execute(
+                "UPDATE jobs SET status = 'queued', stage = 'queued', run_id = NULL WHERE status = 'running'"
+            ).rowcount
+        # Half-written uploads from a crashed API (live ones keep a fresh mtime)
+        for name in os.listdir(self.payload_dir):
+            path = os.path.join(self.payload_dir, name)
+            if name.endswith(".part") and time.time() - os.path.getmtime(path) > STALE_PART_SECONDS:
+                os.remove(path)
+        if count:
+            logger.info(f"♻️  Re-queued {count} interrupted job(s)")
+        return count
@@ -0,0 +1,154 @@
+import os
+import re
+import hashlib
+
+# Header lines a model may declare, e.g. "-- depends_on: silver_fact_usage"
+HEADER_PATTERN = re.compile(r"^--\s*(depends_on|materialized|primary_key)\s*:\s*(.*)$")
+# Relations a statement reads (CTE names that match no model are ignored)
+RELATION_PATTERN = re.compile(r"\b(?:FROM|JOIN)\s+(?:main\.)?([A-Za-z_][A-Za-z0-9_]*)", re.IGNORECASE)
+MATERIALIZATIONS = ("table", "append")
+
+class Model:
+    """
+    One node of the SQL model DAG.
+    materialized: 'table' rebuilds the table from the query (a primary_key makes it a keyed
+    table that incremental runs can merge into); 'append' inserts the query's rows into it.
+    """
+    def __init__(self, name, sql, depends_on=(), materialized="table", primary_key=(), declared=False):
+        if materialized not in MATERIALIZATIONS:
+            raise ValueError(f"Model {name}: unknown materialization '{materialized}'")
+        self.name = name
+        self.sql = sql
+        self.depends_on = tuple(depends_on)
+        self.materialized = materialized
+        self.primary_key = tuple(primary_key)
+        self.declared = declared  # dependencies came from the header rather than the SQL
+
+    @property
+    def layer(self):
+        return self.name.split("_", 1)[0]
+
+    def code_hash(self, extra=""):
+        """Hash of the SQL (plus anything else its result depends on, e.g. bound rules)"""
+        return hashlib.sha1((self.sql + extra).encode()).hexdigest()
+
+    def __repr__(self):
+        return f"Model({self.name!r}, depends_on={list(self.depends_on)})"
+
+def _split_list(value):
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+def parse_model(name, text):
+    """Reads the header declarations; the SQL is returned without its trailing semicolon"""
+    headers = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line.startswith("--"):
+            if line:
+                break
+            continue
+        match = HEADER_PATTERN.match(line)
+        if match:
+            headers[match.group(1)] = match.group(2).strip()
+    sql = text.strip().rstrip(";")
+    return Model(
+        name, sql,
+        depends_on=_split_list(headers.get("depends_on", "")),
+        materialized=headers.get("materialized", "table"),
+        primary_key=_split_list(headers.get("primary_key", "")),
+        declared="depends_on" in headers,
+    )
+
+def referenced_relations(sql):
+    """Every relation named after FROM / JOIN, comments stripped"""
+    code = re.sub(r"--[^\n]*", "", sql)
+    return {m.group(1).lower() for m in RELATION_PATTERN.finditer(code)}
+
+def build_graph(models):
+    """
+    Fills in inferred dependencies (models the SQL reads from) for models without a
+    depends_on header, and checks every declared one exists. Returns {name: Model}.
+    """
+    graph = {m.name: m for m in models}
+    for model in graph.values():
+        if model.declared:
+            unknown = [d for d in model.depends_on if d not in graph]
+            if unknown:
+                raise ValueError(f"Model {model.name} depends on unknown model(s) {unknown}")
+        else:
+            refs = referenced_relations(model.sql)
+            model.depends_on = tuple(sorted(n for n in graph if n in refs and n != model.name))
+    waves(graph)  # raises on cycles
+    return graph
+
+def load_models(models_dir, extra=()):
+    """Every .sql file in models_dir (plus engine-generated models in `extra`) as a graph"""
+    models = []
+    for filename in sorted(os.listdir(models_dir)):
+        if filename.endswith(".sql"):
+            with open(os.path.join(models_dir, filename), "r") as f:
+                models.append(parse_model(filename[:-4], f.read()))
+    return build_graph(models + list(extra))
+
+def waves(graph, names=None):
+    """
+    Topological levels of the given models (default: all): every model's dependencies
+    sit in earlier waves, so the models of one wave can run concurrently.
+    Within a wave Silver comes before Gold, then names sort alphabetically.
+    """
+    names = set(graph) if names is None else set(names)
+    depth = {}
+
+    def visit(name, path):
+        if name in depth:
+            return depth[name]
+        if name in path:
+            raise ValueError(f"Model dependency cycle: {' -> '.join(path + [name])}")
+        depth[name] = 1 + max((visit(d, path + [name]) for d in graph[name].depends_on), default=-1)
+        return depth[name]
+
+    for name in graph:
+        visit(name, [])
+    levels = {}
+    for name in names:
+        levels.setdefault(depth[name], []).append(name)
+    order = lambda n: (graph[n].layer != "silver", n)
+    return [sorted(levels[level], key=order) for level in sorted(levels)]
+
+def descendants(graph, name):
+    children = {n: [m for m in graph if n in graph[m].depends_on] for n in graph}
+    found, stack = set(), [name]
+    while stack:
+        for child in children[stack.pop()]:
+            if child not in found:
+                found.add(child)
+                stack.append(child)
+    return found
+
+def ancestors(graph, name):
+    found, stack = set(), [name]
+    while stack:
+        for parent in graph[stack.pop()].depends_on:
+            if parent not in found:
+                found.add(parent)
+                stack.append(parent)
+    return found
+
+def select_models(graph, selectors):
+    """
+    dbt-style selection: 'model' alone, 'model+' with everything downstream,
+    '+model' with everything upstream. Selectors are comma- or space-separated.
+    """
+    if isinstance(selectors, str):
+        selectors = selectors.replace(",", " ").split()
+    chosen = set()
+    for selector in selectors:
+        name = selector.strip("+")
+        if name not in graph:
+            raise ValueError(f"Unknown model: {name}")
+        chosen.add(name)
+        if selector.endswith("+"):
+            chosen |= descendants(graph, name)
+        if selector.startswith("+"):
+            chosen |= ancestors(graph, name)
+    return chosen
@@ -0,0 +1,313 @@
+import io
+import csv
+import math
+import time
+import random
+import logging
+from statistics import NormalDist
+
+import duckdb
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+from src.analyze_costs import (
+    ARROW_TYPES, GZIP_MAGIC, ZSTD_MAGIC, _ident, check_encoding, duckdb_settings, open_decompressed, profile_select
+)
+
+logger = logging.getLogger("PREVIEW")
+
+# --- BLOCK SAMPLING ---
+# An upload is cut into fixed-size byte blocks (a line belongs to the block it starts in) and a
+# uniform random sample of uploads.preview_blocks of them is parsed. Plain CSV is sampled by
+# seeking, so only the sampled bytes are read; gzip/zstd bodies have to be decompressed in full,
+# but only the sampled blocks are parsed (reservoir sampling, as the block count is not known upfront).
+
+def _is_compressed(path, encoding):
+    if encoding in ('gzip', 'x-gzip', 'zstd'):
+        return True
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    return not encoding and (head.startswith(GZIP_MAGIC) or head.startswith(ZSTD_MAGIC))
+
+def _seek_blocks(path, block_bytes, max_blocks, rng):
+    """Plain CSV: (header line, {block index: bytes}, total blocks, total bytes after the header)"""
+    with open(path, 'rb') as f:
+        header = f.readline()
+        start = f.tell()
+        f.seek(0, io.SEEK_END)
+        size = f.tell() - start
+        total = max(1, math.ceil(size / block_bytes))
+
+        blocks = {}
+        for index in sorted(rng.sample(range(total), min(max_blocks, total))):
+            begin = start + index * block_bytes
+            f.seek(begin - 1)
+            f.readline()  # finish the line the previous block owns (just its newline if it ends at `begin`)
+            if f.tell() >= begin + block_bytes:
+                blocks[index] = b""  # one line spans the whole block
+                continue
+            data = f.read(begin + block_bytes - f.tell())
+            if data and not data.endswith(b"\n"):
+                data += f.readline()  # a line starting in this block is part of it
+            blocks[index] = data
+    return header, blocks, total, size
+
+def _stream_blocks(path, encoding, block_bytes, max_blocks, rng):
+    """gzip/zstd: the same blocks, of the decompressed text, picked by reservoir sampling"""
+    with open(path, 'rb') as raw:
+        text = io.BufferedReader(open_decompressed(raw, encoding), buffer_size=block_bytes)
+        header = text.readline()
+        blocks, total, size = {}, 0, 0
+        while True:
+            data = text.read(block_bytes)
+            if not data:
+                break
+            if not data.endswith(b"\n"):
+                data += text.readline()
+            size += len(data)
+            if len(blocks) < max_blocks:
+                blocks[total] = data
+            else:
+                slot = rng.randrange(total + 1)
+                if slot < max_blocks:
+                    del blocks[sorted(blocks)[slot]]
+                    blocks[total] = data
+            total += 1
+    return header, blocks, max(total, 1), size
+
+def sample_blocks(path, encoding=None, block_bytes=262144, max_blocks=64, seed=None):
+    """
+    A uniform sample of an upload's blocks: (header, {block index: CSV bytes}, total blocks, total bytes).
+    Every block is sampled when there are at most max_blocks.
+    """
+    encoding = check_encoding(encoding)
+    rng = random.Random(seed)
+    if _is_compressed(path, encoding):
+        return _stream_blocks(path, encoding, block_bytes, max_blocks, rng)
+    return _seek_blocks(path, block_bytes, max_blocks, rng)
+
+def _sample_table(header, blocks, columns):
+    """The sampled rows as one Arrow table (profile columns, typed as ingest_stream types them) + _block"""
+    names = next(csv.reader([header.decode('utf-8-sig')]), [])
+    by_lower = {c.lower(): t for c, t in columns.items()}
+    wanted = [h for h in names if h.lower() in by_lower]
+    tables = []
+    for index, data in blocks.items():
+        if not data.strip():
+            continue
+        table = pa_csv.read_csv(
+            io.BytesIO(data),
+            read_options=pa_csv.ReadOptions(column_names=names),
+            convert_options=pa_csv.ConvertOptions(
+                include_columns=wanted,
+                column_types={h: ARROW_TYPES.get(by_lower[h.lower()], pa.string()) for h in wanted},
+                strings_can_be_null=True,
+            ),
+        )
+        tables.append(table.append_column('_block', pa.array([index] * table.num_rows, pa.int64())))
+    if not tables:
+        raise ValueError("Upload has no rows to preview")
+    return names, pa.concat_tables(tables)
+
+# --- FULL PASS ---
+RESOURCE_COLUMN = 'LineItem/ResourceId'
+USAGE_COLUMN = 'LineItem/UsageAmount'
+COST_COLUMN = 'LineItem/UnblendedCost'
+
+def _full_pass(path, encoding, names, block_bytes):
+    """
+    Every row of the upload, projected to (resource id, usage amount, cost), as a streaming Arrow reader.
+    The whole body is tokenized but only these columns are converted, and nothing is kept.
+    """
+    present = {h.lower(): h for h in names}
+    missing = [c for c in (RESOURCE_COLUMN, USAGE_COLUMN, COST_COLUMN) if c.lower() not in present]
+    if missing:
+        raise ValueError(f"Preview needs the {', '.join(missing)} column(s)")
+    resource, usage, cost = (present[c.lower()] for c in (RESOURCE_COLUMN, USAGE_COLUMN, COST_COLUMN))
+    raw = open(path, 'rb')
+    text = io.BufferedReader(open_decompressed(raw, encoding), buffer_size=block_bytes) \
+        if _is_compressed(path, encoding) else raw
+    return pa_csv.open_csv(
+        text,
+        read_options=pa_csv.ReadOptions(column_names=names, skip_rows=1, block_size=block_bytes),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=[resource, usage, cost],
+            column_types={resource: pa.string(), usage: pa.float64(), cost: pa.float64()},
+            strings_can_be_null=True,
+        ),
+    ), (resource, usage, cost), raw
+
+# --- ESTIMATES ---
+def _estimate(block_values, block_bytes, total_bytes, total_blocks, z):
+    """
+    Total of a per-block measure from a simple random sample of blocks (blocks as clusters), as a
+    ratio to bytes: total_bytes x (sampled total / sampled bytes), so short blocks (the last one, or
+    lines crossing a boundary) do not skew it. Bounds are +/- z standard errors of the ratio
+    estimator, with the finite population correction.
+    """
+    m = len(block_values)
+    ratio = sum(block_values) / max(sum(block_bytes), 1)
+    residuals = [v - ratio * x for v, x in zip(block_values, block_bytes)]
+    variance = sum(r * r for r in residuals) / (m - 1) if m > 1 else 0.0
+    margin = z * total_blocks * math.sqrt(max(0.0, 1 - m / total_blocks) * variance / m)
+    value = ratio * total_bytes
+    return {"value": round(value, 2), "low": round(max(0.0, value - margin), 2), "high": round(value + margin, 2),
+            "approximate": True}
+
+def _distinct_estimate(seen, singletons, fraction, cap):
+    """
+    Distinct values of the whole upload from those in a sample holding `fraction` of it (GEE:
+    each value seen once stands for sqrt(1/fraction) values). Bounds: every value seen exists;
+    at most each one seen once stands for 1/fraction of them, and never more than `cap`.
+    """
+    value = math.sqrt(1 / fraction) * singletons + (seen - singletons)
+    high = max(seen, min(singletons / fraction + (seen - singletons), cap))
+    return {"value": round(min(value, high)), "low": seen, "high": round(high), "approximate": True}
+
+def preview_upload(path, config, encoding=None, seed=None):
+    """
+    Fast, approximate answer for a spooled upload from a block sample alone, without touching
+    the warehouse: its time depends on the sample, not on the size of the upload.
+    Line items, total cost and zombie waste are ratio estimates with confidence bounds; resources
+    are a GEE distinct estimate. Zombie candidates are resources billed with no usage in the
+    sample; as their usage may sit in unsampled blocks, the zombie count and waste can only be
+    bounded from above, and their low bound is 0 until every block was read. refine_preview()
+    settles them. Every approximate number is an object flagged "approximate": true.
+    """
+    upload_cfg = config['uploads']
+    confidence = float(upload_cfg.get('preview_confidence', 0.95))
+    started = time.perf_counter()
+
+    header, blocks, total_blocks, total_bytes = sample_blocks(
+        path, encoding, upload_cfg.get('preview_block_bytes', 262144), upload_cfg.get('preview_blocks', 64), seed
+    )
+    names, sample = _sample_table(header, blocks, config['ingest']['columns'])
+    complete = len(blocks) == total_blocks
+
+    con = duckdb.connect(config=duckdb_settings(config))
+    try:
+        con.execute("SET VARIABLE min_cost_threshold = ?", [float(config['business_rules'].get('min_cost_threshold', 0.01))])
+        con.register('_preview_sample', sample)
+        con.execute(f"CREATE TEMP TABLE billing AS SELECT {profile_select(names, config['ingest']['columns'])}, _block FROM _preview_sample")
+        con.execute(f"""
+            CREATE TEMP TABLE sample_resources AS
+            SELECT
+                {_ident(RESOURCE_COLUMN)} as resource_id,
+                COUNT(*) as lines,
+                {_ident(RESOURCE_COLUMN)} IS NOT NULL
+                    AND SUM({_ident(COST_COLUMN)}) >= getvariable('min_cost_threshold')
+                    AND COUNT(*) FILTER (WHERE {_ident(USAGE_COLUMN)} <> 0) = 0 as candidate
+            FROM billing
+            GROUP BY 1
+        """)
+        per_block = con.execute(f"""
+            SELECT
+                b._block,
+                COUNT(*) as line_items,
+                COALESCE(SUM(b.{_ident(COST_COLUMN)}), 0) as cost,
+                COALESCE(SUM(b.{_ident(COST_COLUMN)}) FILTER (WHERE r.candidate), 0) as waste
+            FROM billing b
+                JOIN sample_resources r ON r.resource_id IS NOT DISTINCT FROM b.{_ident(RESOURCE_COLUMN)}
+            GROUP BY b._block
+        """).fetchall()
+        # Sampled blocks without rows (e.g. a line spanning the block) count as zeros
+        measures = {index: (0, 0.0, 0.0) for index in blocks}
+        measures.update({row[0]: row[1:] for row in per_block})
+        seen, singletons, candidates, candidate_singletons = con.execute("""
+            SELECT
+                COUNT(*),
+                COUNT(*) FILTER (WHERE lines = 1),
+                COUNT(*) FILTER (WHERE candidate),
+                COUNT(*) FILTER (WHERE candidate AND lines = 1)
+            FROM sample_resources WHERE resource_id IS NOT NULL
+        """).fetchone()
+        rows = con.execute("SELECT COUNT(*) FROM billing").fetchone()[0]
+    finally:
+        con.close()
+
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    sizes = [len(blocks[index]) for index in measures]
+    estimate = lambda i: _estimate([m[i] for m in measures.values()], sizes, total_bytes, total_blocks, z)
+    fraction = 1.0 if complete else min(1.0, max(sum(sizes), 1) / max(total_bytes, 1))
+    line_items = estimate(0)
+    resources = _distinct_estimate(seen, singletons, fraction, line_items["high"])
+    # Resources used in the sample are known not to be zombies
+    zombies = _distinct_estimate(candidates, candidate_singletons, fraction, resources["high"] - (seen - candidates))
+    waste = estimate(2)
+    if not complete:
+        zombies["low"], waste["low"] = 0, 0.0
+    preview = {
+        "approximate": True,
+        "confidence": confidence,
+        "sample": {
+            "blocks": len(blocks),
+            "total_blocks": total_blocks,
+            "rows": rows,
+            "seconds": round(time.perf_counter() - started, 4),
+        },
+        "line_items": line_items,
+        "total_cost": estimate(1),
+        "total_wasted_cost": dict(waste, method="cost of resources with no usage in the sample (leans high)"),
+        "resources": dict(resources, method="GEE distinct estimate from the sample"),
+        "zombies_found": dict(zombies, method="resources billed with no usage in the sample (leans high)"),
+    }
+    logger.info(f"⚡ Preview from {len(blocks)}/{total_blocks} block(s) in {preview['sample']['seconds']:.2f}s")
+    return preview
+
+def refine_preview(path, config, preview, encoding=None):
+    """
+    The preview with figures from one projected pass over the whole upload (resource id, usage
+    and cost only): line items, total cost, resources, and zombies as resources billed and never
+    used anywhere in the upload, with their waste. These are exact for the upload on its own
+    ("approximate": false); Gold's result (the warehouse, idle streaks) still replaces them.
+    Its time grows with the upload, so it runs in the background, not on the request path.
+    """
+    encoding = check_encoding(encoding)
+    started = time.perf_counter()
+    with open(path, 'rb') as f:
+        text = io.BufferedReader(open_decompressed(f, encoding)) if _is_compressed(path, encoding) else f
+        names = next(csv.reader([text.readline().decode('utf-8-sig')]), [])
+
+    reader, (resource, usage, cost), raw = _full_pass(path, encoding, names, config['uploads']['chunk_bytes'])
+    try:
+        con = duckdb.connect(config=duckdb_settings(config))
+        try:
+            con.execute("SET VARIABLE min_cost_threshold = ?", [float(config['business_rules'].get('min_cost_threshold', 0.01))])
+            con.register('_upload_rows', reader)
+            line_items, total_cost, resources, zombies, waste = con.execute(f"""
+                WITH per_resource AS (
+                    SELECT
+                        {_ident(resource)} as resource_id,
+                        COUNT(*) as lines,
+                        COALESCE(SUM({_ident(cost)}), 0) as cost,
+                        {_ident(resource)} IS NOT NULL
+                            AND SUM({_ident(cost)}) >= getvariable('min_cost_threshold')
+                            AND COUNT(*) FILTER (WHERE {_ident(usage)} <> 0) = 0 as zombie
+                    FROM _upload_rows
+                    GROUP BY 1
+                )
+                SELECT
+                    SUM(lines),
+                    SUM(cost),
+                    COUNT(resource_id),
+                    COUNT(*) FILTER (WHERE zombie),
+                    COALESCE(SUM(cost) FILTER (WHERE zombie), 0)
+                FROM per_resource
+            """).fetchone()
+        finally:
+            con.close()
+    finally:
+        raw.close()
+
+    exact = lambda value, **extra: dict({"value": value, "low": value, "high": value, "approximate": False}, **extra)
+    refined = dict(preview)
+    refined.update(
+        line_items=exact(line_items or 0),
+        total_cost=exact(round(total_cost or 0.0, 2)),
+        total_wasted_cost=exact(round(waste, 2), method="cost of resources never used anywhere in the upload"),
+        resources=exact(resources, method="distinct resource ids over the whole upload"),
+        zombies_found=exact(zombies, method="resources billed and never used anywhere in the upload"),
+        full_pass={"rows": line_items or 0, "seconds": round(time.perf_counter() - started, 4)},
+    )
+    logger.info(f"⚡ Preview refined from a full pass over {line_items or 0} row(s) in {refined['full_pass']['seconds']:.2f}s")
+    return refined
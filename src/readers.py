@@ -0,0 +1,152 @@
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import duckdb
+
+from src.analyze_costs import current_snapshot, snapshot_path
+
+logger = logging.getLogger("READERS")
+
+REAPER_INTERVAL_SECONDS = 0.1
+
+class SnapshotUnavailable(Exception):
+    """The requested Gold snapshot was superseded and collected; the request should be retried"""
+
+class SnapshotSource:
+    """
+    What readers open: the warehouse's published Gold snapshots.
+    current() -> (version, snapshot or None); open(version) -> a read-only connection.
+    (src/shards.FederatedSource has the same interface for sharded warehouses.)
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def current(self):
+        return current_snapshot(self.db_path)
+
+    def snapshot(self, version):
+        path = snapshot_path(self.db_path, version)
+        if not os.path.exists(path):
+            raise SnapshotUnavailable(f"Gold snapshot v{version} is no longer available")
+        return path
+
+    def open(self, version, settings=None):
+        path = self.snapshot(version)
+        try:
+            return duckdb.connect(path, read_only=True, config=settings or {})
+        except (duckdb.IOException, duckdb.ConnectionException) as e:
+            raise SnapshotUnavailable(str(e))
+
+class ReaderPool:
+    """
+    Long-lived read-only DuckDB connections for the API, opened on the published Gold
+    snapshots instead of the warehouse. Snapshots are immutable, so readers never wait for
+    (or block) the writer. Connections are pooled per version; idle ones are closed once a
+    newer version is published or after idle_seconds. A background reaper enforces this.
+    """
+    def __init__(self, source, max_size=4, idle_seconds=30, settings=None):
+        self.source = source  # SnapshotSource or FederatedSource
+        self.settings = settings or {}  # DuckDB resource profile (see duckdb_settings)
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        self._idle = []  # (connection, version, last_used)
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    @contextmanager
+    def connection(self, version=None):
+        """A reader on the given snapshot version (default: the latest published)"""
+        self._start_reaper()
+        if version is None:
+            version = self.source.current()[0]
+        con = None
+        with self._lock:
+            for i, (candidate, candidate_version, _) in enumerate(self._idle):
+                if candidate_version == version:
+                    con = candidate
+                    del self._idle[i]
+                    break
+        if con is None:
+            con = self.source.open(version, self.settings)
+
+        try:
+            yield con
+        finally:
+            with self._lock:
+                current = version == self.source.current()[0]
+                if current and len(self._idle) < self.max_size:
+                    self._idle.append((con, version, time.monotonic()))
+                    con = None
+            if con is not None:
+                con.close()
+
+    def reap(self):
+        """Closes idle readers on superseded snapshots or unused for idle_seconds"""
+        version = self.source.current()[0]
+        now = time.monotonic()
+        with self._lock:
+            keep = []
+            for con, con_version, last_used in self._idle:
+                if con_version != version or now - last_used > self.idle_seconds:
+                    con.close()
+                else:
+                    keep.append((con, con_version, last_used))
+            self._idle = keep
+
+    def close(self):
+        with self._lock:
+            for con, _, _ in self._idle:
+                con.close()
+            self._idle = []
+
+    def _start_reaper(self):
+        if self._reaper is not None:
+            return
+        with self._lock:
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap_forever, name="reader-reaper", daemon=True)
+                self._reaper.start()
+
+    def _reap_forever(self):
+        while True:
+            time.sleep(REAPER_INTERVAL_SECONDS)
+            try:
+                self.reap()
+            except Exception as e:
+                logger.error(f"Reader reaper failed: {e}")
+
+class ResultCache:
+    """
+    In-process LRU of serialized responses, keyed by (warehouse version, request key).
+    A pipeline run bumps the version, so stale entries simply stop matching.
+    """
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, version, key):
+        with self._lock:
+            value = self._entries.get((version, key))
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((version, key))
+            self.hits += 1
+            return value
+
+    def put(self, version, key, value):
+        with self._lock:
+            # Entries for older versions can never be served again
+            for stale in [k for k in self._entries if k[0] != version]:
+                del self._entries[stale]
+            self._entries[(version, key)] = value
+            self._entries.move_to_end((version, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
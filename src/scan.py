@@ -0,0 +1,106 @@
+import os
+import sys
+import glob
+import time
+import logging
+import argparse
+
+import duckdb
+import yaml
+
+# Runs as `python -m src.scan` or `python src/scan.py`
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.analyze_costs import PROJECT_ROOT, _sql_str, duckdb_settings, profile_select, projected_csv_select, read_csv_header
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - [SCAN] - %(message)s')
+logger = logging.getLogger("SCAN")
+
+DETECT_SQL = os.path.join(PROJECT_ROOT, 'src', 'sql', 'detect_zombies.sql')
+CSV_SUFFIXES = ('.csv', '.csv.gz')
+PARQUET_SUFFIXES = ('.parquet',)
+EXPORT_FORMATS = {'.csv': "FORMAT CSV, HEADER", '.parquet': "FORMAT PARQUET"}
+
+def expand_sources(patterns):
+    """Files matched by the given paths and globs ('**' recurses), de-duplicated and sorted"""
+    files = set()
+    for pattern in patterns:
+        files |= {os.path.normpath(m).replace('\\', '/') for m in glob.glob(pattern, recursive=True) if os.path.isfile(m)}
+    if not files:
+        raise FileNotFoundError(f"No files match: {' '.join(patterns)}")
+    unsupported = sorted(f for f in files if not f.lower().endswith(CSV_SUFFIXES + PARQUET_SUFFIXES))
+    if unsupported:
+        raise ValueError(f"Not CSV, CSV.gz or Parquet: {', '.join(unsupported)}")
+    return sorted(files)
+
+def billing_sql(con, files, columns):
+    """
+    One typed SELECT over every file, shaped like bronze by the ingest profile.
+    CSVs are grouped by header so each group is a single multi-file read_csv; Parquet files
+    are one read_parquet (matched by column name). DuckDB scans the files of a group in parallel.
+    """
+    selects = []
+    groups = {}
+    for path in files:
+        if path.lower().endswith(CSV_SUFFIXES):
+            groups.setdefault(tuple(read_csv_header(path)), []).append(path)
+    for header, paths in groups.items():
+        selects.append(projected_csv_select(paths, list(header), columns))
+
+    parquet = [p for p in files if p.lower().endswith(PARQUET_SUFFIXES)]
+    if parquet:
+        source = f"read_parquet([{', '.join(_sql_str(p) for p in parquet)}], union_by_name=true)"
+        header = [r[0] for r in con.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()]
+        selects.append(f"SELECT {profile_select(header, columns)} FROM {source}")
+    return "\nUNION ALL\n".join(selects)
+
+def open_scan(patterns, config):
+    """
+    An in-memory DuckDB (with the resources profile) where `billing` is a view over the files.
+    Nothing is loaded: every query against the view reads the files in place.
+    Returns (connection, files).
+    """
+    files = expand_sources(patterns)
+    con = duckdb.connect(config=duckdb_settings(config))
+    con.execute(f"CREATE VIEW billing AS {billing_sql(con, files, config['ingest']['columns'])}")
+    return con, files
+
+def detect_zombies(con):
+    """sql/detect_zombies.sql against the bound `billing` view, as a lazy relation"""
+    with open(DETECT_SQL, 'r') as f:
+        return con.sql(f.read().strip().rstrip(';'))
+
+def export(con, relation, path):
+    """Writes the result to .csv or .parquet (by extension); returns the row count"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in EXPORT_FORMATS:
+        raise ValueError(f"Export to .csv or .parquet, not '{extension}'")
+    return con.execute(f"COPY ({relation.sql_query()}) TO {_sql_str(path)} ({EXPORT_FORMATS[extension]})").fetchone()[0]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run zombie detection straight over CUR files (no warehouse)")
+    parser.add_argument("files", nargs="+", help="CSV, CSV.gz or Parquet files or globs, e.g. 'bills/**/*.csv.gz'")
+    parser.add_argument("--output", help="Export the result to a .csv or .parquet file instead of printing it")
+    parser.add_argument("--limit", type=int, default=20, help="Rows to print (default 20)")
+    parser.add_argument("--config", default=os.path.join(PROJECT_ROOT, 'config.yaml'), help="Config with the ingest and resources profiles")
+    args = parser.parse_args(argv)
+
+    with open(args.config, 'r') as f:
+        config = yaml.safe_load(f)
+
+    started = time.perf_counter()
+    con, files = open_scan(args.files, config)
+    try:
+        logger.info(f"🔎 Scanning {len(files)} file(s) in place...")
+        result = detect_zombies(con)
+        if args.output:
+            rows = export(con, result, args.output)
+            logger.info(f"💾 Exported {rows} zombie(s) to {args.output}")
+        else:
+            result.show(max_rows=args.limit)
+        logger.info(f"⏱️  Answer in {time.perf_counter() - started:.2f}s")
+    finally:
+        con.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+import os
+import re
+import sys
+import copy
+import glob
+import time
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import duckdb
+import yaml
+
+# Runs as `python -m src.shards` or `python src/shards.py`
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.analyze_costs import (
+    PROJECT_ROOT, CloudBillHunter, _ident, _sql_str, current_snapshot, projected_csv_select, read_csv_header
+)
+from src.readers import SnapshotSource, SnapshotUnavailable
+
+logger = logging.getLogger("SHARDS")
+
+# --- SHARD LAYOUT ---
+# With sharding.enabled, each value of sharding.key_column (a linked account, or a payer) gets its
+# own warehouse: <sharding.dir>/<shard>/warehouse.duckdb, with its own writer lock, bronze storage,
+# snapshots and version. The main warehouse (uploads) stays a member named "main".
+MAIN_MEMBER = "main"
+UNASSIGNED_SHARD = "unassigned"  # Rows without a key value
+SHARD_DB_NAME = "warehouse.duckdb"
+
+def sharding_config(config):
+    return config.get('sharding') or {}
+
+def shard_dir(db_path, config):
+    return os.path.abspath(sharding_config(config).get('dir') or f"{db_path}.shards")
+
+def shard_name(value):
+    """Key value -> directory-safe shard name (None -> 'unassigned')"""
+    if value is None or str(value).strip() == "":
+        return UNASSIGNED_SHARD
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', str(value).strip())
+
+def shard_db_path(db_path, shard, config):
+    return os.path.join(shard_dir(db_path, config), shard, SHARD_DB_NAME)
+
+def list_shards(db_path, config):
+    """Shards that have a warehouse on disk"""
+    paths = glob.glob(os.path.join(shard_dir(db_path, config), '*', SHARD_DB_NAME))
+    return sorted(os.path.basename(os.path.dirname(p)) for p in paths)
+
+# --- ROUTING ---
+def _key_sql(column):
+    """The shard key of a row: blank and missing values both mean 'unassigned'"""
+    return f"NULLIF(TRIM({_ident(column)}), '')"
+
+def route_files(paths, config, on_error=None):
+    """
+    {shard: {path: [key values]}}: which shards each file has rows for.
+    Only the key column is read (a projected scan); a file spanning accounts goes to each of them.
+    A file that cannot be read raises, or is passed to on_error(path, exception) and skipped.
+    """
+    column = sharding_config(config).get('key_column', 'LineItem/UsageAccountId')
+    columns = config['ingest']['columns']
+    if column not in columns:
+        raise ValueError(f"sharding.key_column '{column}' is not in the ingest profile")
+
+    routes = {}
+    con = duckdb.connect()
+    try:
+        for path in paths:
+            try:
+                read_sql = projected_csv_select(path, read_csv_header(path), {column: columns[column]})
+                values = [r[0] for r in con.execute(f"SELECT DISTINCT {_key_sql(column)} FROM ({read_sql})").fetchall()]
+            except Exception as e:
+                if on_error is None:
+                    raise
+                on_error(path, e)
+                continue
+            for value in values:
+                routes.setdefault(shard_name(value), {}).setdefault(path, []).append(value)
+    finally:
+        con.close()
+    return routes
+
+def shard_predicate(column, values):
+    """The ingest filter keeping the rows of the given key values (None = no key)"""
+    terms = []
+    named = [v for v in values if v is not None]
+    if named:
+        terms.append(f"{_key_sql(column)} IN ({', '.join(_sql_str(v) for v in named)})")
+    if len(named) < len(values):
+        terms.append(f"{_key_sql(column)} IS NULL")
+    return " OR ".join(terms)
+
+def shard_engine_config(config, shard, threads):
+    """
+    The config a shard's engine runs with: the shard's share of the host's cores and
+    sharding.shard_memory_limit, and its own spill directory (and configured bronze dirs).
+    """
+    shard_config = copy.deepcopy(config)
+    resources = shard_config.setdefault('resources', {})
+    resources['threads'] = threads
+    if resources.get('temp_directory'):
+        resources['temp_directory'] = os.path.join(resources['temp_directory'], shard)
+    if sharding_config(config).get('shard_memory_limit'):
+        resources['memory_limit'] = sharding_config(config)['shard_memory_limit']
+    storage = shard_config.setdefault('storage', {})
+    for key in ('parquet_dir', 'archive_dir'):
+        if storage.get(key):
+            storage[key] = os.path.join(storage[key], shard)
+    return shard_config
+
+# --- PARALLEL SHARD PIPELINES ---
+def _run_shard(db_path, shard, files, config):
+    """
+    One process per shard: ingest this shard's rows of each file, then one pipeline run.
+    Returns a summary dict; failures are reported, not raised, so other shards still finish.
+    """
+    logging.basicConfig(level=logging.INFO, format=f'%(asctime)s - [SHARD {shard}] - %(message)s')
+    column = sharding_config(config).get('key_column', 'LineItem/UsageAccountId')
+    path = shard_db_path(db_path, shard, config)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    started = time.perf_counter()
+    summary = {"shard": shard, "db_path": path, "files": list(files), "batches": [], "failed": [], "run": None, "error": None}
+    engine = None
+    try:
+        engine = CloudBillHunter(db_path=path, config=config)
+        for file_path, values in files.items():
+            try:
+                batch_id = engine.ingest_data(file_path, where=shard_predicate(column, values))
+                summary["batches"].append(batch_id)
+            except Exception as e:
+                logger.error(f"❌ Ingest failed for {file_path}: {e}")
+                summary["failed"].append(file_path)
+        if len(summary["failed"]) < len(files):
+            run = engine.run_pipeline()
+            if run:
+                summary["run"] = {k: v for k, v in run.items() if k != "stages"}
+    except Exception as e:
+        logger.error(f"❌ Shard pipeline failed: {e}")
+        summary["error"] = str(e)
+    finally:
+        if engine:
+            engine.close()
+    summary["seconds"] = round(time.perf_counter() - started, 3)
+    return summary
+
+def run_shards(paths, db_path, config, workers=None, on_error=None):
+    """
+    Routes the files to shards and runs each shard's ingest + pipeline in its own process,
+    at most `workers` at a time (default sharding.workers; 0 = all cores). Shards have separate
+    files and locks, so throughput scales with cores. Returns the per-shard summaries.
+    """
+    routes = route_files(paths, config, on_error)
+    if not routes:
+        return []
+    workers = workers if workers is not None else sharding_config(config).get('workers', 0)
+    workers = min(int(workers or os.cpu_count() or 1), len(routes))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    logger.info(f"🧩 {len(paths)} file(s) -> {len(routes)} shard(s), {workers} worker(s) x {threads} thread(s)")
+
+    jobs = [(db_path, shard, files, shard_engine_config(config, shard, threads)) for shard, files in sorted(routes.items())]
+    if workers == 1:
+        return [_run_shard(*job) for job in jobs]
+
+    # spawn: a forked child would inherit DuckDB's threads and locks mid-state
+    summaries = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(_run_shard, *job) for job in jobs]
+        for future in as_completed(futures):
+            summaries.append(future.result())
+    return sorted(summaries, key=lambda s: s["shard"])
+
+# --- FEDERATED READS ---
+def member_versions(version):
+    """'main:3,123456789012:2' -> {'main': 3, '123456789012': 2}"""
+    members = {}
+    for part in filter(None, str(version).split(',')):
+        name, _, number = part.rpartition(':')
+        members[name] = int(number)
+    return members
+
+class FederatedSource:
+    """
+    The read side of a sharded warehouse, with SnapshotSource's interface.
+    Its version joins the members' versions ('main:3,<shard>:2'), so it changes whenever any
+    shard publishes. open() ATTACHes each member's snapshot read-only into an in-memory database
+    and exposes every Gold table as a view over all members, with a `shard` column.
+    """
+    def __init__(self, db_path, config):
+        self.db_path = db_path
+        self.config = config
+
+    def _member_path(self, name):
+        return self.db_path if name == MAIN_MEMBER else shard_db_path(self.db_path, name, self.config)
+
+    def current(self):
+        """(version, {member: snapshot}); the snapshots are None before any member has published"""
+        snapshots = {}
+        for name in [MAIN_MEMBER] + list_shards(self.db_path, self.config):
+            version, snapshot = current_snapshot(self._member_path(name))
+            if snapshot is not None:
+                snapshots[name] = (version, snapshot)
+        version = ",".join(f"{name}:{v}" for name, (v, _) in snapshots.items())
+        return version, ({name: s for name, (_, s) in snapshots.items()} or None)
+
+    def open(self, version, settings=None):
+        con = duckdb.connect(config=settings or {})
+        try:
+            tables = {}
+            for i, (name, member_version) in enumerate(member_versions(version).items()):
+                path = SnapshotSource(self._member_path(name)).snapshot(member_version)
+                alias = f"shard_{i}"
+                con.execute(f"ATTACH {_sql_str(path)} AS {alias} (READ_ONLY)")
+                for (table,) in con.execute(
+                    "SELECT table_name FROM duckdb_tables() WHERE database_name = ?", [alias]
+                ).fetchall():
+                    tables.setdefault(table, []).append(f"SELECT *, {_sql_str(name)} AS shard FROM {alias}.{_ident(table)}")
+            for table, selects in tables.items():
+                con.execute(f"CREATE VIEW {_ident(table)} AS {' UNION ALL BY NAME '.join(selects)}")
+            return con
+        except (duckdb.IOException, duckdb.ConnectionException) as e:
+            con.close()
+            raise SnapshotUnavailable(str(e))
+        except Exception:
+            con.close()
+            raise
+
+def read_source(db_path, config):
+    """What the API and dashboard read: the federation when sharding is enabled, else the warehouse's snapshots"""
+    if sharding_config(config).get('enabled'):
+        return FederatedSource(db_path, config)
+    return SnapshotSource(db_path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ingest CUR files into per-account shards and run each shard's pipeline in parallel")
+    parser.add_argument("files", nargs="+", help="CSV or CSV.gz bills")
+    parser.add_argument("--workers", type=int, help="Shard processes (default: sharding.workers; 0 = all cores)")
+    parser.add_argument("--db", default=os.path.join(PROJECT_ROOT, 'data', 'warehouse.duckdb'), help="Main warehouse (shards live next to it)")
+    parser.add_argument("--config", default=os.path.join(PROJECT_ROOT, 'config.yaml'))
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - [SHARDS] - %(message)s')
+    with open(args.config, 'r') as f:
+        config = yaml.safe_load(f)
+
+    started = time.perf_counter()
+    summaries = run_shards(args.files, args.db, config, args.workers)
+    for s in summaries:
+        status = "❌ " + s["error"] if s["error"] else f"✅ {len(s['batches'])} batch(es)"
+        logger.info(f"  {s['shard']}: {status} in {s['seconds']:.2f}s")
+    logger.info(f"⏱️  {len(summaries)} shard(s) in {time.perf_counter() - started:.2f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+-- A day costing at least `ratio` times its trailing average, and `min_increase` more in absolute terms
+SELECT
+    resource_key,
+    usage_date,
+    cost as observed,
+    baseline_cost as expected,
+    cost / baseline_cost as score,
+    cost - baseline_cost as impact
+FROM detector_features
+WHERE history_days >= getvariable('detector_min_history_days')
+    AND baseline_cost > 0
+    AND cost >= getvariable('cost_spike_ratio') * baseline_cost
+    AND cost - baseline_cost >= getvariable('cost_spike_min_increase')
@@ -0,0 +1,13 @@
+-- A day's cost at least `z` standard deviations above its trailing average (noisy resources need more)
+SELECT
+    resource_key,
+    usage_date,
+    cost as observed,
+    baseline_cost as expected,
+    (cost - baseline_cost) / stddev_cost as score,
+    cost - baseline_cost as impact
+FROM detector_features
+WHERE history_days >= getvariable('detector_min_history_days')
+    AND stddev_cost > 0
+    AND (cost - baseline_cost) / stddev_cost >= getvariable('cost_zscore_z')
+    AND cost - baseline_cost >= getvariable('cost_zscore_min_increase')
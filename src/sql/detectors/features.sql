@@ -0,0 +1,18 @@
+-- The one shared pass every detector reads (as detector_features): each resource/day with
+-- its baseline over the detectors.window_days before it (the day itself excluded)
+SELECT
+    resource_key,
+    usage_date,
+    cost,
+    usage_amount,
+    untagged_cost,
+    cost / NULLIF(usage_amount, 0) as unit_price,
+    COUNT(*) OVER prior_days as history_days,
+    AVG(cost) OVER prior_days as baseline_cost,
+    STDDEV_SAMP(cost) OVER prior_days as stddev_cost,
+    AVG(cost / NULLIF(usage_amount, 0)) OVER prior_days as baseline_unit_price
+FROM silver_daily_usage
+WINDOW prior_days AS (
+    PARTITION BY resource_key ORDER BY usage_date
+    RANGE BETWEEN getvariable('detector_window_days') PRECEDING AND 1 PRECEDING
+)
@@ -0,0 +1,13 @@
+-- Cost per usage unit at least `ratio` times its trailing average (a pricing or SKU change);
+-- impact is what the same usage would have cost at the old price
+SELECT
+    resource_key,
+    usage_date,
+    unit_price as observed,
+    baseline_unit_price as expected,
+    unit_price / baseline_unit_price as score,
+    (unit_price - baseline_unit_price) * usage_amount as impact
+FROM detector_features
+WHERE history_days >= getvariable('detector_min_history_days')
+    AND baseline_unit_price > 0
+    AND unit_price >= getvariable('unit_price_rise_ratio') * baseline_unit_price
@@ -0,0 +1,10 @@
+-- Spend on line items carrying no owner tag: nobody is accountable for it (score = untagged share)
+SELECT
+    resource_key,
+    usage_date,
+    untagged_cost as observed,
+    CAST(NULL AS DOUBLE) as expected,
+    untagged_cost / NULLIF(cost, 0) as score,
+    untagged_cost as impact
+FROM detector_features
+WHERE untagged_cost >= getvariable('untagged_spend_min_cost')
@@ -0,0 +1,66 @@
+-- Team x service x month cost cube: every drill-down level of the three dimensions (the eight
+-- grouping sets of a CUBE), pre-aggregated. `level` lists the dimensions a row is grouped by
+-- ('owner_team,service', 'month', '' for the grand total), so a rolled-up dimension (NULL) is
+-- never confused with a NULL value. Each day counts toward the owner and service its resource
+-- had that day (the silver_dim_resource version covering it).
+-- waste: cost billed on days with zero usage (at least min_cost_threshold), as the zombie report counts it.
+-- Grouping sets are expanded with a join and aggregated by plain GROUP BYs: DuckDB's GROUPING SETS
+-- (and its COUNT(DISTINCT)) do not spill to disk, these do.
+WITH cells AS (
+    SELECT
+        d.owner_team,
+        d.service,
+        CAST(date_trunc('month', u.usage_date) AS DATE) as month,
+        u.resource_key,
+        SUM(u.cost) as cost,
+        SUM(CASE WHEN u.usage_amount = 0 AND u.cost >= getvariable('min_cost_threshold') THEN u.cost ELSE 0 END) as waste,
+        SUM(u.untagged_cost) as untagged_cost,
+        SUM(u.line_items) as line_items
+    FROM silver_daily_usage u
+        JOIN silver_dim_resource d ON d.resource_key = u.resource_key
+            -- Undated rows belong to the first version, as they sort first in the dimension
+            AND COALESCE(u.usage_date, DATE '-infinity') >= COALESCE(d.valid_from, DATE '-infinity')
+            AND (d.valid_to IS NULL OR COALESCE(u.usage_date, DATE '-infinity') < d.valid_to)
+    GROUP BY ALL
+),
+grouping_sets(level, by_owner, by_service, by_month) AS (
+    VALUES
+        ('owner_team,service,month', true, true, true),
+        ('owner_team,service', true, true, false),
+        ('owner_team,month', true, false, true),
+        ('service,month', false, true, true),
+        ('owner_team', true, false, false),
+        ('service', false, true, false),
+        ('month', false, false, true),
+        ('', false, false, false)
+),
+resources AS (
+    -- One row per resource in each group of each grouping set, so resources are counted once
+    SELECT
+        g.level,
+        CASE WHEN g.by_owner THEN c.owner_team END as owner_team,
+        CASE WHEN g.by_service THEN c.service END as service,
+        CASE WHEN g.by_month THEN c.month END as month,
+        c.resource_key,
+        SUM(c.cost) as cost,
+        SUM(c.waste) as waste,
+        SUM(c.untagged_cost) as untagged_cost,
+        SUM(c.line_items) as line_items
+    FROM cells c
+        CROSS JOIN grouping_sets g
+    GROUP BY ALL
+)
+SELECT
+    level,
+    owner_team,
+    service,
+    month,
+    SUM(cost) as total_cost,
+    SUM(waste) as wasted_cost,
+    SUM(untagged_cost) as untagged_cost,
+    SUM(line_items) as line_items,
+    COUNT(*) as resources,
+    COUNT(*) FILTER (WHERE waste > 0) as idle_resources
+FROM resources
+GROUP BY level, owner_team, service, month
+ORDER BY level, total_cost DESC
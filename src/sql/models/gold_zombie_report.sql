@@ -1,12 +1,38 @@
+-- A zombie is billed without being used: either never used at all, or idle-but-billed
+-- (cost >= min_cost_threshold, zero usage) for zombie_threshold_days consecutive days
+-- running up to the latest billed day (as_of_date). Consecutive idle days share
+-- usage_date - row_number(), so one windowed scan finds every streak.
+WITH idle_days AS (
+    SELECT
+        resource_key,
+        usage_date,
+        cost,
+        usage_date - CAST(row_number() OVER (PARTITION BY resource_key ORDER BY usage_date) AS INTEGER) as streak
+    FROM silver_daily_usage
+    WHERE usage_amount = 0
+        AND cost >= getvariable('min_cost_threshold')
+),
+current_streaks AS (
+    SELECT
+        resource_key,
+        MIN(usage_date) as idle_since,
+        COUNT(*) as idle_days,
+        SUM(cost) as idle_cost
+    FROM idle_days
+    GROUP BY resource_key, streak
+    HAVING MAX(usage_date) = getvariable('as_of_date')
+)
 SELECT
     d.resource_id,
     d.service,
     d.owner_team,
-    SUM(f.cost) as total_wasted_cost
-FROM silver_fact_usage f
-    JOIN silver_dim_resource d ON f.resource_id = d.resource_id
-GROUP BY 1, 2, 3
-HAVING 
-    SUM(f.cost) > 0
-    AND SUM(f.usage_amount) = 0
-ORDER BY total_wasted_cost DESC;
\ No newline at end of file
+    CASE WHEN t.total_usage = 0 THEN t.total_cost ELSE s.idle_cost END as total_wasted_cost,
+    s.idle_since,
+    COALESCE(s.idle_days, 0) as idle_days
+FROM silver_resource_totals t
+    JOIN silver_dim_resource d ON d.resource_key = t.resource_key AND d.is_current
+    LEFT JOIN current_streaks s ON s.resource_key = t.resource_key
+WHERE
+    (t.total_usage = 0 AND t.total_cost >= getvariable('min_cost_threshold'))
+    OR s.idle_days >= getvariable('zombie_threshold_days')
+ORDER BY total_wasted_cost DESC
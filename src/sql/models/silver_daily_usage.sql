@@ -0,0 +1,11 @@
+-- Resource/day rollup of the fact table: everything downstream works at this grain or coarser
+-- primary_key: resource_key, usage_date
+SELECT
+    resource_key,
+    usage_date,
+    SUM(cost) as cost,
+    SUM(usage_amount) as usage_amount,
+    COUNT(*) as line_items,
+    COALESCE(SUM(cost) FILTER (WHERE untagged), 0) as untagged_cost
+FROM silver_fact_usage
+GROUP BY 1, 2;
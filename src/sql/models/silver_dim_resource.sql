@@ -1,5 +1,60 @@
-SELECT DISTINCT
-    "LineItem/ResourceId" as resource_id,
-    "LineItem/ProductCode" as service,
-    COALESCE("ResourceTags/user:Owner", 'Unknown') as owner_team
-FROM bronze_billing;
\ No newline at end of file
+-- SCD-2 resource dimension: one row per (resource, attribute version), is_current marks the live one.
+-- A day's attributes come from its costliest line item (tagged lines decide the owner);
+-- a new version starts whenever the service or owner differs from the previous day's.
+-- Everything groups and sorts on the integer resource_key (so it spills under a memory cap);
+-- resource_id is joined back on at the end.
+WITH line_items AS (
+    SELECT
+        k.resource_key,
+        CAST(b."LineItem/UsageStartDate" AS DATE) as usage_date,
+        b."LineItem/ProductCode" as service,
+        b."ResourceTags/user:Owner" as owner,
+        CAST(b."LineItem/UnblendedCost" AS DOUBLE) as cost
+    FROM bronze_billing b
+        JOIN silver_resource_keys k ON k.resource_id = b."LineItem/ResourceId"
+),
+days AS (
+    SELECT
+        resource_key,
+        usage_date,
+        -- max over a (cost, attribute) struct: arg_max with ties to the greater name, but spillable
+        max({'cost': COALESCE(cost, 0), 'service': service}).service as service,
+        COALESCE((max({'cost': COALESCE(cost, 0), 'owner': owner}) FILTER (WHERE owner IS NOT NULL)).owner, 'Unknown') as owner_team
+    FROM line_items
+    GROUP BY ALL
+),
+changes AS (
+    -- Scalar lags: a lag over a (service, owner) struct does not spill to disk
+    SELECT
+        *,
+        service IS DISTINCT FROM lag(service) OVER previous_day
+            OR owner_team IS DISTINCT FROM lag(owner_team) OVER previous_day as is_change
+    FROM days
+    WINDOW previous_day AS (PARTITION BY resource_key ORDER BY usage_date NULLS FIRST)
+),
+versions AS (
+    SELECT
+        *,
+        SUM(is_change::INTEGER) OVER (PARTITION BY resource_key ORDER BY usage_date NULLS FIRST) as version
+    FROM changes
+),
+spans AS (
+    SELECT
+        resource_key,
+        service,
+        owner_team,
+        MIN(usage_date) as valid_from,
+        version
+    FROM versions
+    GROUP BY resource_key, service, owner_team, version
+)
+SELECT
+    s.resource_key,
+    k.resource_id,
+    s.service,
+    s.owner_team,
+    s.valid_from,
+    lead(s.valid_from) OVER (PARTITION BY s.resource_key ORDER BY s.version) as valid_to,
+    s.version = MAX(s.version) OVER (PARTITION BY s.resource_key) as is_current
+FROM spans s
+    JOIN silver_resource_keys k ON k.resource_key = s.resource_key;
@@ -1,7 +1,9 @@
 SELECT
-    "LineItem/ResourceId" as resource_id,
-    CAST("LineItem/UsageStartDate" AS DATE) as usage_date,
-    CAST("LineItem/UnblendedCost" AS DOUBLE) as cost,
-    CAST("LineItem/UsageAmount" AS DOUBLE) as usage_amount
-FROM bronze_billing
-WHERE "LineItem/ResourceId" IS NOT NULL;
\ No newline at end of file
+    k.resource_key,
+    CAST(b."LineItem/UsageStartDate" AS DATE) as usage_date,
+    CAST(b."LineItem/UnblendedCost" AS DOUBLE) as cost,
+    CAST(b."LineItem/UsageAmount" AS DOUBLE) as usage_amount,
+    b."ResourceTags/user:Owner" IS NULL as untagged,
+    b._batch_id as batch_id
+FROM bronze_billing b
+    JOIN silver_resource_keys k ON k.resource_id = b."LineItem/ResourceId";
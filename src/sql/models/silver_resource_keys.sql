@@ -0,0 +1,11 @@
+-- Resource ids that have no surrogate key yet, numbered from resource_key_seq
+-- materialized: append
+SELECT
+    CAST(nextval('resource_key_seq') AS INTEGER) as resource_key,
+    resource_id
+FROM (
+    SELECT DISTINCT "LineItem/ResourceId" as resource_id
+    FROM bronze_billing
+    WHERE "LineItem/ResourceId" IS NOT NULL
+        AND "LineItem/ResourceId" NOT IN (SELECT resource_id FROM silver_resource_keys)
+);
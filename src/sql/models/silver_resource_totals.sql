@@ -0,0 +1,8 @@
+-- Lifetime cost and usage per resource, re-summed from its daily rows
+-- primary_key: resource_key
+SELECT
+    resource_key,
+    SUM(cost) as total_cost,
+    SUM(usage_amount) as total_usage
+FROM silver_daily_usage
+GROUP BY 1;
@@ -1,66 +1,328 @@
 import time
 import os
+import json
+import sys
+import shutil
+import threading
 import logging
+import yaml
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
-from analyze_costs import CloudBillHunter
+
+# Runs as `python src/watcher.py`; make the `src` package importable like the API does
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.analyze_costs import PROJECT_ROOT, CloudBillHunter
+from src.shards import list_shards, run_shards, shard_db_path
 
 # Setup Logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - [WATCHER] - %(message)s')
 
-LANDING_ZONE = "data/landing_zone"
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config.yaml'), 'r') as f:
+    CONFIG = yaml.safe_load(f)
+WATCHER_CONFIG = CONFIG['watcher']
+WAREHOUSE_PATH = os.path.join(PROJECT_ROOT, 'data', 'warehouse.duckdb')
+
+LANDING_ZONE = WATCHER_CONFIG['landing_zone']
+BILL_SUFFIXES = (".csv", ".csv.gz")
+
+def is_bill(path):
+    return os.path.basename(path).lower().endswith(BILL_SUFFIXES) and not os.path.basename(path).startswith(".")
+
+class LandingZoneBatcher:
+    """
+    Turns a stream of file events into settled batches.
+    A file is ready once its size has stopped changing for settle_seconds (the export
+    finished writing it). A batch is released after debounce_seconds without new
+    arrivals, or once its oldest ready file has waited max_batch_wait_seconds.
+    """
+    def __init__(self, settle_seconds=2, debounce_seconds=5, max_batch_wait_seconds=60, clock=time.monotonic):
+        self.settle_seconds = settle_seconds
+        self.debounce_seconds = debounce_seconds
+        self.max_batch_wait_seconds = max_batch_wait_seconds
+        self.clock = clock
+        self._files = {}  # path -> {"size", "changed_at", "ready_at"}
+        self._last_arrival = None
+        self._started = clock()
+        self._lock = threading.Lock()
+
+    def add(self, path):
+        """Called from the watchdog thread on create/modify/move events (and on startup scans)"""
+        if not is_bill(path):
+            return
+        now = self.clock()
+        with self._lock:
+            self._files.setdefault(path, {"size": -1, "changed_at": now, "ready_at": None})
+            self._last_arrival = now
+
+    def pending(self):
+        with self._lock:
+            return sorted(self._files)
+
+    def quiet_for(self):
+        """Seconds since the last arrival (or startup); 0 while any file is still pending"""
+        with self._lock:
+            if self._files:
+                return 0
+            return self.clock() - (self._last_arrival if self._last_arrival is not None else self._started)
+
+    def poll(self):
+        """Re-checks file sizes; returns the paths to process now (possibly empty)"""
+        now = self.clock()
+        with self._lock:
+            for path, state in list(self._files.items()):
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    # Moved away or deleted before it settled
+                    del self._files[path]
+                    continue
+                if size != state["size"]:
+                    state.update(size=size, changed_at=now, ready_at=None)
+                    self._last_arrival = now
+                elif state["ready_at"] is None and now - state["changed_at"] >= self.settle_seconds:
+                    state["ready_at"] = now
+
+            ready = [p for p, s in self._files.items() if s["ready_at"] is not None]
+            if not ready:
+                return []
+
+            quiet = now - self._last_arrival >= self.debounce_seconds
+            overdue = now - min(self._files[p]["ready_at"] for p in ready) >= self.max_batch_wait_seconds
+            if not (quiet or overdue):
+                return []
+
+            for path in ready:
+                del self._files[path]
+            return sorted(ready)
+
+class CompactionSchedule:
+    """
+    When the watcher may run bronze compaction: once the landing zone has been quiet for
+    idle_seconds, and at most once per interval_seconds. idle_seconds=None disables it.
+    """
+    def __init__(self, idle_seconds=None, interval_seconds=86400, clock=time.monotonic):
+        self.idle_seconds = idle_seconds
+        self.interval_seconds = interval_seconds
+        self.clock = clock
+        self._last_run = None
+
+    def due(self, quiet_for):
+        if self.idle_seconds is None or quiet_for < self.idle_seconds:
+            return False
+        now = self.clock()
+        if self._last_run is not None and now - self._last_run < self.interval_seconds:
+            return False
+        self._last_run = now
+        return True
 
 class BillingFileHandler(FileSystemEventHandler):
     """
-    The 'Trigger': Reacts whenever a file is created in the folder.
+    The 'Trigger': Reacts whenever a file lands in (or grows in) the folder.
+    It only records the event; the main loop does the work, off the watchdog thread.
     """
+    def __init__(self, batcher, landing_zone=LANDING_ZONE):
+        self.batcher = batcher
+        self.landing_zone = os.path.abspath(landing_zone)
+
+    def _track(self, path):
+        # Only files directly in the landing zone (not our processed/ and failed/ archives)
+        if os.path.dirname(os.path.abspath(path)) == self.landing_zone:
+            self.batcher.add(path)
+
     def on_created(self, event):
-        if event.is_directory:
-            return
-        
-        filename = event.src_path
-        if filename.endswith(".csv"):
-            logging.info(f"⚡ Detected new file drop: {filename}")
-            
-            # --- TRIGGER THE PIPELINE ---
-            engine = None
+        if not event.is_directory:
+            self._track(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self._track(event.src_path)
+
+    def on_moved(self, event):
+        # Exporters often write to a temp name and rename when done
+        if not event.is_directory:
+            self._track(event.dest_path)
+
+def log_event(event, **fields):
+    """One JSON object per line, so log shippers can alert on pipeline slowdowns"""
+    logging.info(f"📈 {json.dumps({'event': event, **fields}, default=str)}")
+
+def log_stage_events(engine, **context):
+    """Emits a pipeline_stage event per stage just run, and pipeline_stage_slow past the threshold"""
+    slow_seconds = engine.config.get('observability', {}).get('slow_stage_seconds')
+    for stage in engine.stage_metrics:
+        log_event("pipeline_stage", **context, **stage)
+        if slow_seconds is not None and stage["seconds"] >= slow_seconds:
+            logging.warning(f"🐢 {json.dumps({'event': 'pipeline_stage_slow', 'threshold_seconds': slow_seconds, **context, **stage}, default=str)}")
+
+def _archive(path, folder):
+    """Moves a handled file out of the landing zone so a restart never picks it up again"""
+    target_dir = os.path.join(os.path.dirname(path), folder)
+    os.makedirs(target_dir, exist_ok=True)
+    shutil.move(path, os.path.join(target_dir, os.path.basename(path)))
+
+def _requeue(paths, batcher):
+    """Hands files a failed run left in the landing zone back to the batcher, for its next batch"""
+    retry = [p for p in paths if os.path.exists(p)]
+    if batcher is not None:
+        for path in retry:
+            batcher.add(path)
+    if retry:
+        logging.info(f"🔁 {len(retry)} file(s) will be retried with the next batch")
+    return retry
+
+def process_batch(paths, engine_factory=CloudBillHunter, batcher=None):
+    """
+    One ingest-plus-pipeline run for a whole batch of settled files.
+    Files move to processed/ only after the pipeline commits; a crash before that means
+    they are re-ingested on restart, which the load manifest turns into no-ops.
+    If the pipeline (or opening the warehouse) fails, the files go back to the batcher.
+    """
+    logging.info(f"⚡ Processing batch of {len(paths)} file(s)")
+    engine = None
+    try:
+        # Initialize the Engine
+        engine = engine_factory()
+
+        # 1. Medallion: Bronze (Ingest) - a bad file fails alone
+        ingested = []
+        for path in paths:
             try:
-                # Initialize the Engine
-                engine = CloudBillHunter()
-                
-                # 1. Medallion: Bronze (Ingest)
-                engine.ingest_data(filename)
-                
-                # 2. Medallion: Silver & Gold (Transform)
-                engine.run_pipeline()
-                
-                logging.info(f"✅ Pipeline complete for {filename}")
-                
+                batch_id = engine.ingest_data(path)
+                ingested.append(path)
+                if batch_id is not None:
+                    log_stage_events(engine, file=os.path.basename(path), batch_id=batch_id)
             except Exception as e:
-                logging.error(f"❌ Pipeline failed: {str(e)}")
-            finally:
-                # CRITICAL: Manually close the connection now
-                if engine:
-                    engine.close()
+                logging.error(f"❌ Ingest failed for {path}: {str(e)}")
+                _archive(path, "failed")
+
+        # 2. Medallion: Silver & Gold (Transform) - once for the batch
+        if ingested:
+            run = engine.run_pipeline()
+            if run:
+                log_stage_events(engine, run_id=run["run_id"], mode=run["mode"])
+                log_event("pipeline_run", files=len(ingested),
+                          **{k: v for k, v in run.items() if k != "stages"})
+            for path in ingested:
+                _archive(path, "processed")
+        logging.info(f"✅ Pipeline complete for {len(ingested)} file(s)")
+        return ingested
+
+    except Exception as e:
+        logging.error(f"❌ Pipeline failed: {str(e)}")
+        _requeue(paths, batcher)
+        return []
+    finally:
+        # CRITICAL: Manually close the connection now
+        if engine:
+            engine.close()
+
+def process_sharded_batch(paths, db_path=WAREHOUSE_PATH, config=CONFIG, workers=None, batcher=None):
+    """
+    process_batch for sharded warehouses: each account's rows go to its shard, and the shard
+    pipelines run in parallel processes. A file is archived to processed/ once every shard it
+    feeds has committed; unreadable files and failed shard ingests go to failed/, while files of
+    a shard whose pipeline failed go back to the batcher for the next batch (shards that already
+    loaded them skip them as duplicates).
+    """
+    logging.info(f"⚡ Processing sharded batch of {len(paths)} file(s)")
+    failed = set()
+
+    def unroutable(path, e):
+        logging.error(f"❌ Routing failed for {path}: {str(e)}")
+        failed.add(path)
+
+    summaries = run_shards(paths, db_path, config, workers, on_error=unroutable)
+    retry = set()
+    for summary in summaries:
+        failed.update(summary["failed"])
+        if summary["error"]:
+            retry.update(summary["files"])
+        elif summary["run"]:
+            log_event("pipeline_run", shard=summary["shard"], files=len(summary["files"]), **summary["run"])
+
+    for path in failed:
+        _archive(path, "failed")
+    processed = [p for p in paths if p not in failed and p not in retry]
+    for path in processed:
+        _archive(path, "processed")
+    _requeue(sorted(retry - failed), batcher)
+    logging.info(f"✅ Sharded pipelines complete for {len(processed)} file(s) across {len(summaries)} shard(s)")
+    return processed
+
+def compact_warehouses(db_path=WAREHOUSE_PATH, config=CONFIG):
+    """
+    Idle-time maintenance: compacts bronze in the warehouse and, when sharded, in every shard.
+    Readers keep serving snapshots throughout; a failure is logged and retried next time.
+    Parquet bronze (storage.bronze_backend: parquet) is written per batch and partition, so there
+    is nothing to compact: it is skipped.
+    """
+    if (config.get('storage') or {}).get('bronze_backend', 'duckdb') == 'parquet':
+        logging.info("🧽 Bronze is stored as Parquet: nothing to compact")
+        return {}
+    paths = [db_path]
+    if (config.get('sharding') or {}).get('enabled'):
+        paths += [shard_db_path(db_path, shard, config) for shard in list_shards(db_path, config)]
+    reports = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        engine = None
+        try:
+            engine = CloudBillHunter(db_path=path, config=config)
+            reports[path] = engine.compact_bronze()
+            log_event("bronze_compaction", warehouse=path, **reports[path])
+        except Exception as e:
+            logging.error(f"❌ Compaction failed for {path}: {str(e)}")
+        finally:
+            if engine:
+                engine.close()
+    return reports
+
+def resume_scan(batcher, landing_zone=LANDING_ZONE):
+    """Queues every bill still sitting in the landing zone (left over from before a restart)"""
+    leftovers = [os.path.join(landing_zone, name) for name in sorted(os.listdir(landing_zone))]
+    leftovers = [p for p in leftovers if os.path.isfile(p) and is_bill(p)]
+    for path in leftovers:
+        batcher.add(path)
+    if leftovers:
+        logging.info(f"♻️  Resuming {len(leftovers)} unprocessed file(s) from {landing_zone}")
+    return leftovers
 
 def start_watcher():
     # Ensure the folder exists
     if not os.path.exists(LANDING_ZONE):
         os.makedirs(LANDING_ZONE)
 
-    event_handler = BillingFileHandler()
+    batcher = LandingZoneBatcher(
+        settle_seconds=WATCHER_CONFIG['settle_seconds'],
+        debounce_seconds=WATCHER_CONFIG['debounce_seconds'],
+        max_batch_wait_seconds=WATCHER_CONFIG['max_batch_wait_seconds'],
+    )
+    event_handler = BillingFileHandler(batcher)
     observer = Observer()
     observer.schedule(event_handler, LANDING_ZONE, recursive=False)
-    
+
     logging.info(f"👀 Watching directory: {LANDING_ZONE} for new bills...")
     observer.start()
-    
+    resume_scan(batcher)
+
+    process = process_sharded_batch if (CONFIG.get('sharding') or {}).get('enabled') else process_batch
+    compaction = CompactionSchedule(
+        idle_seconds=WATCHER_CONFIG.get('compact_when_idle_seconds'),
+        interval_seconds=WATCHER_CONFIG.get('compact_interval_hours', 24) * 3600,
+    )
     try:
         while True:
-            time.sleep(1)
+            batch = batcher.poll()
+            if batch:
+                process(batch, batcher=batcher)
+            elif compaction.due(batcher.quiet_for()):
+                compact_warehouses()
+            time.sleep(WATCHER_CONFIG['poll_seconds'])
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
 
 if __name__ == "__main__":
-    start_watcher()
\ No newline at end of file
+    start_watcher()
@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+import logging
+
+# Runs as `python -m src.worker` (Docker) or `python src/worker.py`
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.analyze_costs import CloudBillHunter
+from src.jobs import JobQueue
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - [WORKER] - %(message)s')
+logger = logging.getLogger("WORKER")
+
+WAREHOUSE_PATH = os.getenv("WAREHOUSE_PATH", "data/warehouse.duckdb")
+JOBS_DIR = os.getenv("JOBS_DIR", "data/jobs")
+POLL_INTERVAL_SECONDS = 1.0
+
+def drain_queue(queue, warehouse_path=WAREHOUSE_PATH):
+    """
+    The single writer: claims every queued upload, ingests each into Bronze,
+    then runs ONE pipeline for the whole group. Returns the number of jobs handled.
+    """
+    run_id, jobs = queue.claim_all()
+    if not jobs:
+        return 0
+    logger.info(f"🛠️  Run {run_id}: coalescing {len(jobs)} job(s) into one pipeline run")
+
+    try:
+        engine = CloudBillHunter(db_path=warehouse_path)
+    except Exception:
+        # Warehouse unavailable (e.g. locked): hand the jobs back untouched
+        for job in jobs:
+            queue.update(job["job_id"], status="queued", stage="queued", run_id=None)
+        raise
+
+    try:
+        # --- 1. INGEST (per job: one bad file fails only its own job) ---
+        ingested = []
+        for job in jobs:
+            queue.update(job["job_id"], stage="ingesting")
+            start = time.perf_counter()
+            try:
+                with open(job["payload_path"], "rb") as f:
+                    job["batch_id"] = engine.ingest_stream(f, job["source"], encoding=job["encoding"])
+            except Exception as e:
+                job["timings"]["ingest"] = round(time.perf_counter() - start, 4)
+                logger.error(f"❌ Job {job['job_id']} ingest failed: {e}")
+                queue.finish(job, "failed", error=str(e))
+                continue
+            job["timings"]["ingest"] = round(time.perf_counter() - start, 4)
+            queue.update(job["job_id"], stage="waiting_for_pipeline", timings=job["timings"])
+            ingested.append(job)
+
+        if not ingested:
+            return len(jobs)
+
+        # --- 2. TRANSFORM (once for the whole group) ---
+        for job in ingested:
+            queue.update(job["job_id"], stage="transforming")
+        start = time.perf_counter()
+        try:
+            engine.run_pipeline()
+        except Exception as e:
+            logger.error(f"❌ Run {run_id} pipeline failed: {e}")
+            for job in ingested:
+                job["timings"]["pipeline"] = round(time.perf_counter() - start, 4)
+                queue.finish(job, "failed", error=str(e))
+            return len(jobs)
+        pipeline_seconds = round(time.perf_counter() - start, 4)
+
+        # --- 3. REPORT ---
+        start = time.perf_counter()
+        zombies_found, total_waste = engine.con.execute(
+            "SELECT COUNT(*), COALESCE(SUM(total_wasted_cost), 0) FROM gold_zombie_report"
+        ).fetchone()
+        report_seconds = round(time.perf_counter() - start, 4)
+
+        for job in ingested:
+            job["timings"].update(pipeline=pipeline_seconds, report=report_seconds)
+            queue.finish(job, "done", result={
+                "approximate": False,
+                "batch_id": job["batch_id"],
+                "duplicate": job["batch_id"] is None,
+                "coalesced_jobs": len(ingested),
+                "zombies_found": zombies_found,
+                "total_wasted_cost": total_waste,
+            })
+        logger.info(f"✅ Run {run_id} complete: {len(ingested)} job(s), {zombies_found} zombies")
+        return len(jobs)
+    finally:
+        # Release the write lock between runs
+        engine.close()
+
+def run_worker(queue=None, poll_interval=POLL_INTERVAL_SECONDS):
+    queue = queue or JobQueue(JOBS_DIR)
+    queue.recover()
+    logger.info(f"👷 Writer worker draining {queue.jobs_dir} into {WAREHOUSE_PATH}...")
+
+    try:
+        while True:
+            try:
+                if drain_queue(queue) == 0:
+                    time.sleep(poll_interval)
+            except Exception as e:
+                logger.error(f"❌ Drain failed: {e}")
+                time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        logger.info("🛑 Worker stopped.")
+
+if __name__ == "__main__":
+    run_worker()
@@ -3,16 +3,20 @@ from fastapi.testclient import TestClient
 import os
 import sys
 import io
+import shutil
 
 # 1. SETUP: Override the Warehouse Path BEFORE importing the app
 # This ensures the API uses a test DB, not production
 TEST_DB = "test_warehouse.duckdb"
+TEST_JOBS = "test_jobs"
 os.environ["WAREHOUSE_PATH"] = TEST_DB
+os.environ["JOBS_DIR"] = TEST_JOBS
 
 # Ensure we can import from src
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from src.api import app
+from src.api import app, job_queue
+from src.worker import drain_queue
 
 client = TestClient(app)
 
@@ -20,11 +24,11 @@ client = TestClient(app)
 def cleanup():
     """Runs after all tests to delete the test database"""
     yield
-    if os.path.exists(TEST_DB):
-        os.remove(TEST_DB)
-    # Cleanup uploads if any
-    if os.path.exists("data/uploads/test_bill.csv"):
-        os.remove("data/uploads/test_bill.csv")
+    for path in (TEST_DB, TEST_DB + ".version"):
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.rmtree(TEST_DB + ".snapshots", ignore_errors=True)
+    shutil.rmtree(TEST_JOBS, ignore_errors=True)
 
 def test_health_check():
     response = client.get("/")
@@ -34,8 +38,9 @@ def test_health_check():
 def test_upload_and_query_flow():
     """
     FULL END-TO-END TEST:
-    1. Upload CSV -> API Ingests -> Writes to Test DB
-    2. Query GET /zombies -> API Reads -> Returns JSON
+    1. Upload CSV -> API queues a job
+    2. Writer drains the queue -> Writes to Test DB -> Job reports the result
+    3. Query GET /zombies -> API Reads -> Returns JSON
     """
     
     # --- 1. UPLOAD ---
@@ -49,12 +54,19 @@ i-api-zombie,2023-01-01,AmazonEC2,0.0,99.99,ApiTeam
         files={"file": ("test_bill.csv", file_obj, "text/csv")}
     )
     
-    assert response.status_code == 200
-    data = response.json()
-    assert data["zombies_found"] == 1
-    assert data["total_wasted_cost"] == 99.99
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+    assert client.get(f"/jobs/{job_id}").json()["status"] == "queued"
+
+    # --- 2. WRITER ---
+    assert drain_queue(job_queue, TEST_DB) == 1
+    job = client.get(f"/jobs/{job_id}").json()
+    assert job["status"] == "done"
+    assert job["result"]["zombies_found"] == 1
+    assert job["result"]["total_wasted_cost"] == 99.99
+    assert {"upload", "queue_wait", "ingest", "pipeline", "report"} <= set(job["timings"])
 
-    # --- 2. QUERY (Persistence Check) ---
+    # --- 3. QUERY (Persistence Check) ---
     # Does the GET endpoint see the data we just uploaded?
     response_q = client.get("/zombies")
     assert response_q.status_code == 200
@@ -62,4 +74,257 @@ i-api-zombie,2023-01-01,AmazonEC2,0.0,99.99,ApiTeam
     
     assert data_q["status"] == "success"
     assert data_q["count"] == 1
-    assert data_q["data"][0]["resource_id"] == "i-api-zombie"
\ No newline at end of file
+    assert data_q["data"][0]["resource_id"] == "i-api-zombie"
+
+def test_compressed_raw_body_upload():
+    """
+    Raw request bodies are accepted; gzip via Content-Encoding, zstd detected from
+    the magic bytes of a multipart file. Both queued uploads share one pipeline run.
+    """
+    import gzip
+    import zstandard
+
+    header = "LineItem/ResourceId,LineItem/UsageStartDate,LineItem/ProductCode,LineItem/UsageAmount,LineItem/UnblendedCost,ResourceTags/user:Owner\n"
+
+    response = client.post(
+        "/analyze/upload",
+        content=gzip.compress((header + "i-gzip-zombie,2023-01-01,AmazonEBS,0.0,12.5,StorageTeam\n").encode()),
+        headers={"Content-Type": "text/csv", "Content-Encoding": "gzip", "X-Filename": "../../etc/gz_bill.csv"},
+    )
+    assert response.status_code == 202
+    gzip_job = response.json()["job_id"]
+    assert client.get(f"/jobs/{gzip_job}").json()["source"] == "gz_bill.csv"
+
+    zstd_body = zstandard.ZstdCompressor().compress((header + "i-zstd-zombie,2023-01-01,AmazonRDS,0.0,3.0,DataTeam\n").encode())
+    response = client.post("/analyze/upload", files={"file": ("zstd_bill.csv.zst", io.BytesIO(zstd_body), "application/zstd")})
+    assert response.status_code == 202
+    zstd_job = response.json()["job_id"]
+
+    assert drain_queue(job_queue, TEST_DB) == 2
+    jobs = [client.get(f"/jobs/{j}").json() for j in (gzip_job, zstd_job)]
+    assert [j["status"] for j in jobs] == ["done", "done"]
+    assert jobs[0]["run_id"] == jobs[1]["run_id"]
+    assert jobs[0]["result"]["coalesced_jobs"] == 2
+
+    zombies = {z["resource_id"] for z in client.get("/zombies").json()["data"]}
+    assert {"i-gzip-zombie", "i-zstd-zombie"} <= zombies
+    assert os.listdir(os.path.join(TEST_JOBS, "payloads")) == []
+
+    response = client.post("/analyze/upload", content=b"abc", headers={"Content-Encoding": "br"})
+    assert response.status_code == 415
+
+
+def test_unnamed_uploads_never_replace_each_other():
+    """Uploads without a filename get job-unique names, so one month's two bills are both kept"""
+    header = "LineItem/ResourceId,LineItem/UsageStartDate,LineItem/ProductCode,LineItem/UsageAmount,LineItem/UnblendedCost,ResourceTags/user:Owner\n"
+    jobs = [client.post("/analyze/upload", content=(header + f"i-anon-{n},2024-03-01,AmazonEC2,0.0,7.0,AnonTeam\n").encode()).json()["job_id"]
+            for n in range(2)]
+    assert drain_queue(job_queue, TEST_DB) == 2
+
+    sources = [client.get(f"/jobs/{job_id}").json()["source"] for job_id in jobs]
+    assert sources == [f"upload-{job_id}.csv" for job_id in jobs]
+    zombies = client.get("/zombies", params={"owner": "AnonTeam"}).json()["data"]
+    assert sorted(z["resource_id"] for z in zombies) == ["i-anon-0", "i-anon-1"]
+
+def test_jobs_survive_restarts():
+    """Queued and interrupted jobs live on disk: a fresh API/worker picks them up"""
+    from src.jobs import JobQueue
+
+    csv_content = b"""LineItem/ResourceId,LineItem/UsageStartDate,LineItem/ProductCode,LineItem/UsageAmount,LineItem/UnblendedCost,ResourceTags/user:Owner
+i-restart-zombie,2023-01-01,AmazonEC2,0.0,5.0,OpsTeam
+"""
+    job_id = client.post("/analyze/upload", content=csv_content, headers={"X-Filename": "restart.csv"}).json()["job_id"]
+
+    # Worker claims the job, then "crashes" before finishing it
+    _, claimed = JobQueue(TEST_JOBS).claim_all()
+    assert [j["job_id"] for j in claimed] == [job_id]
+
+    restarted = JobQueue(TEST_JOBS)
+    assert restarted.recover() == 1
+    assert restarted.get(job_id)["status"] == "queued"
+    assert drain_queue(restarted, TEST_DB) == 1
+    assert client.get(f"/jobs/{job_id}").json()["status"] == "done"
+
+def test_zombies_pagination_filters_and_streams():
+    """Keyset pages, filters and projection are pushed down; NDJSON/Arrow stream the same rows"""
+    import json
+    import pyarrow as pa
+
+    header = "LineItem/ResourceId,LineItem/UsageStartDate,LineItem/ProductCode,LineItem/UsageAmount,LineItem/UnblendedCost,ResourceTags/user:Owner\n"
+    rows = "".join(f"i-page-{n},2023-01-01,{'AmazonEC2' if n % 2 else 'AmazonRDS'},0.0,{n + 1}.0,PageTeam\n" for n in range(7))
+    client.post("/analyze/upload", content=(header + rows).encode(), headers={"X-Filename": "pages.csv"})
+    drain_queue(job_queue, TEST_DB)
+
+    # Walk every page of 3, cheapest first, only two fields
+    seen, cursor = [], None
+    while True:
+        params = {"owner": "PageTeam", "sort": "total_wasted_cost", "fields": "resource_id,total_wasted_cost", "limit": 3}
+        if cursor:
+            params["cursor"] = cursor
+        page = client.get("/zombies", params=params).json()
+        assert page["total"] == 7
+        assert all(set(r) == {"resource_id", "total_wasted_cost"} for r in page["data"])
+        seen += page["data"]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert [r["total_wasted_cost"] for r in seen] == [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0]
+
+    filtered = client.get("/zombies", params={"owner": "PageTeam", "service": "AmazonRDS", "min_cost": 3}).json()
+    assert [r["resource_id"] for r in filtered["data"]] == ["i-page-6", "i-page-4", "i-page-2"]
+
+    ndjson = client.get("/zombies", params={"owner": "PageTeam", "format": "ndjson", "fields": "resource_id"})
+    assert ndjson.headers["content-type"].startswith("application/x-ndjson")
+    assert [json.loads(line) for line in ndjson.text.splitlines()][0] == {"resource_id": "i-page-6"}
+
+    arrow = client.get("/zombies", params={"owner": "PageTeam", "format": "arrow", "limit": 5})
+    table = pa.ipc.open_stream(arrow.content).read_all()
+    assert table.num_rows == 5
+    assert table.column_names == ["resource_id", "service", "owner_team", "total_wasted_cost"]
+
+    assert client.get("/zombies", params={"fields": "password"}).status_code == 400
+
+def test_zombies_cache_and_etags_follow_warehouse_version():
+    """Repeat polls are served from memory and 304 until a pipeline run bumps the version"""
+    from src.api import result_cache
+
+    first = client.get("/zombies", params={"fields": "resource_id"})
+    etag = first.headers["etag"]
+    hits = result_cache.hits
+    assert client.get("/zombies", params={"fields": "resource_id"}).json() == first.json()
+    assert result_cache.hits == hits + 1
+
+    assert client.get("/zombies", params={"fields": "resource_id"}, headers={"If-None-Match": etag}).status_code == 304
+
+    header = "LineItem/ResourceId,LineItem/UsageStartDate,LineItem/ProductCode,LineItem/UsageAmount,LineItem/UnblendedCost,ResourceTags/user:Owner\n"
+    client.post("/analyze/upload", content=(header + "i-etag-zombie,2023-01-01,AmazonEC2,0.0,1.0,EtagTeam\n").encode(),
+                headers={"X-Filename": "etag.csv"})
+    drain_queue(job_queue, TEST_DB)
+
+    fresh = client.get("/zombies", params={"fields": "resource_id"}, headers={"If-None-Match": etag})
+    assert fresh.status_code == 200
+    assert fresh.headers["etag"] != etag
+    assert fresh.json()["total"] == first.json()["total"] + 1
+
+def test_metrics_endpoint_reports_stages():
+    """/metrics exposes the latest run's per-stage figures in Prometheus text format"""
+    csv_content = b"""LineItem/ResourceId,LineItem/UsageStartDate,LineItem/ProductCode,LineItem/UsageAmount,LineItem/UnblendedCost,ResourceTags/user:Owner
+i-metrics-zombie,2023-01-01,AmazonEC2,0.0,4.0,OpsTeam
+"""
+    assert client.post("/analyze/upload", content=csv_content, headers={"X-Filename": "metrics.csv"}).status_code == 202
+    drain_queue(job_queue, TEST_DB)
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    lines = response.text.splitlines()
+    assert "# TYPE cbh_stage_seconds gauge" in lines
+    for layer, stage in (("bronze", "ingest"), ("silver", "silver_fact_usage"), ("gold", "gold_zombie_report")):
+        assert any(l.startswith("cbh_stage_rows{") and f'layer="{layer}",stage="{stage}"' in l for l in lines), stage
+    assert any(l.startswith("cbh_jobs{status=\"done\"}") for l in lines)
+    assert "cbh_warehouse_metrics_available 1" in lines
+
+def test_findings_endpoint_filters_detector_output():
+    """/findings serves gold_findings, filtered by detector, owner and date"""
+    header = "LineItem/ResourceId,LineItem/UsageStartDate,LineItem/ProductCode,LineItem/UsageAmount,LineItem/UnblendedCost,ResourceTags/user:Owner\n"
+    rows = "".join(f"i-finding,2023-01-0{d},AmazonEC2,1.0,1.0,FindTeam\n" for d in range(1, 10))
+    rows += "i-finding,2023-01-10,AmazonEC2,1.0,1.0,FindTeam\ni-finding,2023-01-10,AWSDataTransfer,2.0,2.0,\n"
+    client.post("/analyze/upload", content=(header + rows).encode(), headers={"X-Filename": "findings.csv"})
+    drain_queue(job_queue, TEST_DB)
+
+    response = client.get("/findings", params={"detector": "untagged_spend"})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["total"] == 1
+    assert body["data"][0]["resource_id"] == "i-finding"
+    assert body["data"][0]["usage_date"] == "2023-01-10"
+    assert body["data"][0]["impact"] == 2.0
+
+    assert client.get("/findings", params={"since": "2023-02-01"}).json()["total"] == 0
+    assert client.get("/findings", params={"since": "not-a-date"}).status_code == 400
+
+def test_rollups_serve_any_drill_down_level_from_the_cube():
+    """/rollups looks levels up in gold_cost_cube; filters on other dimensions drill down"""
+    header = "LineItem/ResourceId,LineItem/UsageStartDate,LineItem/ProductCode,LineItem/UsageAmount,LineItem/UnblendedCost,ResourceTags/user:Owner\n"
+    rows = ("i-cube-ec2,2023-03-01,AmazonEC2,0.0,10.0,CubeTeam\n"
+            "i-cube-ec2,2023-04-01,AmazonEC2,1.0,30.0,CubeTeam\n"
+            "i-cube-rds,2023-04-02,AmazonRDS,2.0,5.0,CubeTeam\n")
+    client.post("/analyze/upload", content=(header + rows).encode(), headers={"X-Filename": "cube.csv"})
+    drain_queue(job_queue, TEST_DB)
+
+    teams = client.get("/rollups", params={"by": "owner_team"}).json()
+    assert teams["by"] == ["owner_team"]
+    cube_team = next(r for r in teams["data"] if r["owner_team"] == "CubeTeam")
+    assert (cube_team["total_cost"], cube_team["wasted_cost"], cube_team["resources"]) == (45.0, 10.0, 2)
+
+    drill = client.get("/rollups", params={"by": "service,month", "owner": "CubeTeam", "sort": "month"}).json()
+    assert [(r["service"], r["month"], r["total_cost"]) for r in drill["data"]] == [
+        ("AmazonEC2", "2023-03-01", 10.0), ("AmazonEC2", "2023-04-01", 30.0), ("AmazonRDS", "2023-04-01", 5.0)]
+
+    april = client.get("/rollups", params={"by": "", "owner": "CubeTeam", "month": "2023-04"}).json()
+    assert april["data"] == [{"total_cost": 35.0, "wasted_cost": 0.0, "untagged_cost": 0.0,
+                              "line_items": 2, "resources": 2, "idle_resources": 0}]
+
+    assert client.get("/rollups", params={"by": "region"}).status_code == 400
+    assert client.get("/rollups", params={"month": "April"}).status_code == 400
+
+def test_upload_preview_is_approximate_until_the_exact_result_replaces_it(tmp_path):
+    """
+    ?preview=true answers from a block sample (flagged, with bounds); a background full pass
+    refines it, and the worker's exact result replaces it
+    """
+    import gzip
+    import copy
+    from src.api import CONFIG
+    from src.preview import preview_upload, refine_preview
+
+    header = "LineItem/ResourceId,LineItem/UsageStartDate,LineItem/ProductCode,LineItem/UsageAmount,LineItem/UnblendedCost,ResourceTags/user:Owner\n"
+    # 1 in 4 resources is never used, another 1 in 4 only in its first row (at the top of the file,
+    # outside most samples: it must not pass for a zombie once the whole file is read); each line costs 1.00 + a little
+    used = lambda i: i % 4 in (2, 3) or (i % 4 == 1 and i < 400)
+    rows = "".join(f"i-preview-{i % 400},2023-05-{1 + i % 28:02d},AmazonEC2,{1.0 if used(i) else 0.0},{1 + (i % 7) / 100},PreviewTeam\n"
+                   for i in range(20000))
+    total_cost = sum(1 + (i % 7) / 100 for i in range(20000))
+    wasted_cost = sum(1 + (i % 7) / 100 for i in range(20000) if i % 4 == 0)
+
+    # Small uploads fit in preview_blocks: every block is read, so the estimates are exact
+    response = client.post("/analyze/upload", params={"preview": True}, content=(header + rows).encode(),
+                           headers={"X-Filename": "preview.csv"})
+    preview = response.json()["preview"]
+    assert preview["approximate"] and preview["sample"]["blocks"] == preview["sample"]["total_blocks"]
+    assert preview["line_items"] == {"value": 20000, "low": 20000, "high": 20000, "approximate": True}
+    assert preview["total_cost"]["value"] == pytest.approx(total_cost)
+    assert preview["total_wasted_cost"]["value"] == pytest.approx(wasted_cost)
+    assert (preview["zombies_found"]["low"], preview["zombies_found"]["value"], preview["zombies_found"]["high"]) == (100, 100, 100)
+    assert (preview["resources"]["low"], preview["resources"]["value"], preview["resources"]["high"]) == (400, 400, 400)
+
+    # The background full pass has refined the job's preview by the time it is polled
+    job_id = response.json()["job_id"]
+    refined = client.get(f"/jobs/{job_id}").json()["preview"]
+    assert refined["sample"] == preview["sample"] and refined["full_pass"]["rows"] == 20000
+    assert refined["zombies_found"]["value"] == 100 and refined["zombies_found"]["approximate"] is False
+    drain_queue(job_queue, TEST_DB)
+    job = client.get(f"/jobs/{job_id}").json()
+    assert job["preview"] is None
+    # The exact result covers the whole warehouse (earlier tests' zombies too)
+    assert job["result"]["approximate"] is False and job["result"]["total_wasted_cost"] >= wasted_cost - 1e-6
+
+    # Larger ones are sampled: the truth lies within the bounds, for plain and gzip bodies alike
+    config = copy.deepcopy(CONFIG)
+    config["uploads"].update(preview_block_bytes=16384, preview_blocks=12)
+    (tmp_path / "bill.csv").write_text(header + rows)
+    (tmp_path / "bill.csv.gz").write_bytes(gzip.compress((header + rows).encode()))
+    for name in ("bill.csv", "bill.csv.gz"):
+        sampled = preview_upload(str(tmp_path / name), config, seed=7)
+        assert sampled["sample"]["blocks"] == 12 < sampled["sample"]["total_blocks"]
+        assert sampled["sample"]["rows"] < 20000
+        # Usage outside the sample is unknown: zombies and waste are only bounded from above
+        assert sampled["zombies_found"]["low"] == 0 and sampled["total_wasted_cost"]["low"] == 0
+        for key, truth in (("line_items", 20000), ("total_cost", total_cost), ("total_wasted_cost", wasted_cost),
+                           ("resources", 400), ("zombies_found", 100)):
+            assert sampled[key]["approximate"] and sampled[key]["low"] <= truth <= sampled[key]["high"], key
+
+        refined = refine_preview(str(tmp_path / name), config, sampled)
+        assert refined["zombies_found"]["value"] == 100 and refined["resources"]["value"] == 400
+        assert refined["line_items"]["value"] == 20000
+        assert refined["total_wasted_cost"]["value"] == pytest.approx(wasted_cost)
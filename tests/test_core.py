@@ -4,11 +4,15 @@ import pandas as pd
 import os
 import sys
 import tempfile
+import io
+import gzip
+import yaml
+from datetime import date, timedelta
 
 # Ensure we can import from src
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from src.analyze_costs import CloudBillHunter
+from src.analyze_costs import CloudBillHunter, current_snapshot, snapshot_dir
 
 @pytest.fixture
 def temp_csv():
@@ -56,4 +60,778 @@ def test_medallion_pipeline(temp_csv):
         assert 'i-good' not in result['resource_id'].values
         
     finally:
-        engine.close()
\ No newline at end of file
+        engine.close()
+
+def _write_csv(tmp_path, name, rows):
+    header = "LineItem/ResourceId,LineItem/UsageStartDate,LineItem/ProductCode,LineItem/UsageAmount,LineItem/UnblendedCost,ResourceTags/user:Owner"
+    path = tmp_path / name
+    path.write_text("\n".join([header] + rows) + "\n")
+    return str(path)
+
+def _snapshot(engine, table, order_by):
+    return engine.con.execute(f"SELECT * FROM {table} ORDER BY {order_by}").fetchall()
+
+def test_incremental_refresh_matches_full_rebuild(tmp_path):
+    """
+    Incremental runs must converge on exactly what a full rebuild produces,
+    including a zombie that wakes up and an owner tag that changes.
+    """
+    day1 = _write_csv(tmp_path, "day1.csv", [
+        "i-zombie,2023-01-01,AmazonEC2,0.0,50.0,LegacyTeam",
+        "i-wakes,2023-01-01,AmazonEC2,0.0,20.0,DevTeam",
+        "i-good,2023-01-01,AmazonEC2,10.0,10.0,DevTeam",
+    ])
+    day2 = _write_csv(tmp_path, "day2.csv", [
+        "i-zombie,2023-01-02,AmazonEC2,0.0,50.0,PlatformTeam",
+        "i-wakes,2023-01-02,AmazonEC2,3.0,20.0,DevTeam",
+        "i-new-zombie,2023-01-02,AmazonRDS,0.0,7.5,",
+    ])
+
+    engine = CloudBillHunter(db_path=':memory:')
+    try:
+        engine.ingest_data(day1)
+        engine.run_pipeline()
+        engine.ingest_data(day2)
+        engine.run_pipeline()
+
+        # Nothing left pending after an incremental run
+        pending = engine.con.execute("SELECT COUNT(*) FROM bronze_batches WHERE processed_at IS NULL").fetchone()[0]
+        assert pending == 0
+
+        incremental = {
+            'silver_fact_usage': _snapshot(engine, 'silver_fact_usage', 'ALL'),
+            'silver_dim_resource': _snapshot(engine, 'silver_dim_resource', 'ALL'),
+            'silver_daily_usage': _snapshot(engine, 'silver_daily_usage', 'ALL'),
+            'silver_resource_totals': _snapshot(engine, 'silver_resource_totals', 'ALL'),
+            'gold_zombie_report': _snapshot(engine, 'gold_zombie_report', 'ALL'),
+            'gold_cost_cube': _snapshot(engine, 'gold_cost_cube', 'ALL'),
+        }
+
+        engine.run_pipeline(full_refresh=True)
+        for table, rows in incremental.items():
+            assert _snapshot(engine, table, 'ALL') == rows, table
+
+        zombies = {r[0] for r in incremental['gold_zombie_report']}
+        assert zombies == {'i-zombie', 'i-new-zombie'}
+        # The cube credits each day to the owner the resource had that day
+        assert engine.con.execute(
+            "SELECT owner_team, total_cost, wasted_cost FROM gold_cost_cube WHERE level = 'owner_team' ORDER BY owner_team"
+        ).fetchall() == [('DevTeam', 50.0, 20.0), ('LegacyTeam', 50.0, 50.0), ('PlatformTeam', 50.0, 50.0), ('Unknown', 7.5, 7.5)]
+    finally:
+        engine.close()
+
+def test_ingest_is_idempotent_and_restatements_replace(tmp_path):
+    """
+    Re-dropping the same file is a manifest hit (no new rows);
+    a reissued billing period under the same name replaces its older batch.
+    """
+    v1 = _write_csv(tmp_path, "cur-2023-01.csv", [
+        "i-zombie,2023-01-01,AmazonEC2,0.0,50.0,LegacyTeam",
+        "i-wakes,2023-01-01,AmazonEC2,0.0,20.0,DevTeam",
+    ])
+    other = _write_csv(tmp_path, "cur-2023-02.csv", [
+        "i-zombie,2023-02-01,AmazonEC2,0.0,50.0,LegacyTeam",
+    ])
+
+    engine = CloudBillHunter(db_path=':memory:')
+    try:
+        assert engine.ingest_data(v1) is not None
+        assert engine.ingest_data(other) is not None
+        engine.run_pipeline()
+
+        # Same bytes again: skipped before parsing, bronze unchanged
+        assert engine.ingest_data(v1) is None
+        assert engine.con.execute("SELECT COUNT(*) FROM bronze_billing").fetchone()[0] == 3
+
+        size, rows = engine.con.execute(
+            "SELECT file_size, row_count FROM bronze_batches WHERE source = 'cur-2023-01.csv'"
+        ).fetchone()
+        assert size == os.path.getsize(v1) and rows == 2
+
+        # AWS restates January (dropped again at the same path): i-wakes shows usage and the owner tag changed
+        v2 = _write_csv(tmp_path, "cur-2023-01.csv", [
+            "i-zombie,2023-01-01,AmazonEC2,0.0,40.0,PlatformTeam",
+            "i-wakes,2023-01-01,AmazonEC2,5.0,20.0,DevTeam",
+        ])
+        assert engine.ingest_data(v2) is not None
+        engine.run_pipeline()
+
+        assert engine.con.execute("SELECT COUNT(*) FROM bronze_billing").fetchone()[0] == 3
+        incremental = {
+            t: _snapshot(engine, t, 'ALL')
+            for t in ('silver_fact_usage', 'silver_dim_resource', 'silver_daily_usage', 'silver_resource_totals', 'gold_zombie_report')
+        }
+        # One current dimension row per resource: February's owner, no fan-out of the cost
+        assert incremental['gold_zombie_report'] == [('i-zombie', 'AmazonEC2', 'LegacyTeam', 90.0, date(2023, 2, 1), 1)]
+
+        engine.run_pipeline(full_refresh=True)
+        for table, rows in incremental.items():
+            assert _snapshot(engine, table, 'ALL') == rows, table
+    finally:
+        engine.close()
+
+def test_same_name_is_not_a_restatement_of_another_source(tmp_path):
+    """Files sharing only a basename and month (other folders, other accounts) are all kept"""
+    header = "LineItem/ResourceId,LineItem/UsageStartDate,LineItem/ProductCode,LineItem/UsageAmount,LineItem/UnblendedCost,ResourceTags/user:Owner,LineItem/UsageAccountId"
+    for folder, resource in (("team-a", "i-a"), ("team-b", "i-b")):
+        (tmp_path / folder).mkdir()
+        (tmp_path / folder / "upload.csv").write_text(f"{header}\n{resource},2024-03-01,AmazonEC2,0.0,10.0,Team,111\n")
+
+    engine = CloudBillHunter(db_path=':memory:')
+    try:
+        for folder in ("team-a", "team-b"):
+            engine.ingest_data(str(tmp_path / folder / "upload.csv"))
+        # Same path, another account's bill for the month: not a restatement either
+        (tmp_path / "team-a" / "upload.csv").write_text(f"{header}\ni-c,2024-03-01,AmazonEC2,0.0,10.0,Team,222\n")
+        engine.ingest_data(str(tmp_path / "team-a" / "upload.csv"))
+        # Uploads are keyed on their name the same way
+        engine.ingest_stream(io.BytesIO(f"{header}\ni-d,2024-03-01,AmazonEC2,0.0,10.0,Team,111\n".encode()), "upload.csv")
+        engine.run_pipeline()
+
+        assert engine.con.execute("SELECT COUNT(*) FROM bronze_batches WHERE replaced_by IS NOT NULL").fetchone()[0] == 0
+        zombies = engine.con.execute("SELECT resource_id FROM gold_zombie_report ORDER BY 1").fetchall()
+        assert zombies == [('i-a',), ('i-b',), ('i-c',), ('i-d',)]
+    finally:
+        engine.close()
+
+def test_ingest_projects_and_types_wide_cur(tmp_path):
+    """
+    Real CUR exports carry 100+ columns with lower-case prefixes; bronze keeps only
+    the profile columns with their declared types, and absent columns load as NULL.
+    """
+    path = tmp_path / "wide.csv"
+    path.write_text(
+        "identity/LineItemId,lineItem/UsageStartDate,lineItem/ResourceId,lineItem/ProductCode,"
+        "lineItem/UsageAmount,lineItem/UnblendedCost,pricing/term\n"
+        "abc,2023-03-01T05:00:00Z,i-wide,AmazonEC2,0,3.5,OnDemand\n"
+    )
+
+    engine = CloudBillHunter(db_path=':memory:')
+    try:
+        engine.ingest_data(str(path))
+        schema = engine.con.execute("SELECT column_name, column_type FROM (DESCRIBE bronze_billing)").fetchall()
+        expected = list(engine.ingest_columns.items()) + [('_batch_id', 'BIGINT')]
+        assert schema == expected
+
+        row = engine.con.execute("SELECT * FROM bronze_billing").fetchone()
+        assert row[1:6] == ('i-wide', 'AmazonEC2', 0.0, 3.5, None)
+
+        engine.run_pipeline()
+        result = engine.con.execute("SELECT resource_id, owner_team FROM gold_zombie_report").fetchall()
+        assert result == [('i-wide', 'Unknown')]
+    finally:
+        engine.close()
+
+def test_ingest_stream_enforces_size_cap():
+    """Streamed uploads are capped on decompressed bytes and leave no partial batch behind"""
+    import gzip
+    from src.analyze_costs import PayloadTooLarge
+
+    rows = "".join(f"i-{n},2023-01-01,AmazonEC2,0.0,1.0,Team\n" for n in range(5000))
+    body = gzip.compress(("LineItem/ResourceId,LineItem/UsageStartDate,LineItem/ProductCode,"
+                          "LineItem/UsageAmount,LineItem/UnblendedCost,ResourceTags/user:Owner\n" + rows).encode())
+
+    engine = CloudBillHunter(db_path=':memory:')
+    try:
+        engine.config['uploads']['max_bytes'] = 50_000
+        with pytest.raises(PayloadTooLarge):
+            engine.ingest_stream(io.BytesIO(body), "big.csv.gz")
+        assert engine.con.execute("SELECT COUNT(*) FROM bronze_batches").fetchone()[0] == 0
+
+        engine.config['uploads']['max_bytes'] = 10_000_000
+        engine.config['uploads']['chunk_bytes'] = 4096
+        assert engine.ingest_stream(io.BytesIO(body), "big.csv.gz") is not None
+        assert engine.con.execute("SELECT COUNT(*) FROM bronze_billing").fetchone()[0] == 5000
+    finally:
+        engine.close()
+
+def test_parquet_bronze_partitions_and_prunes(tmp_path):
+    """
+    With storage.bronze_backend=parquet, bronze is a billing_month/account_id partition tree:
+    Gold matches the table backend, restatements drop superseded files, and a windowed
+    zombie scan never opens partitions outside the window.
+    """
+    header = "LineItem/ResourceId,LineItem/UsageStartDate,LineItem/ProductCode,LineItem/UsageAmount,LineItem/UnblendedCost,ResourceTags/user:Owner,LineItem/UsageAccountId"
+    files = {}
+    for month, rows in {
+        "01": ["i-old,2023-01-05,AmazonEC2,0.0,30.0,LegacyTeam,111"],
+        "02": ["i-old,2023-02-05,AmazonEC2,0.0,30.0,LegacyTeam,111", "i-mid,2023-02-05,AmazonRDS,0.0,5.0,DevTeam,222"],
+        "03": ["i-new,2023-03-05,AmazonEC2,0.0,12.0,DevTeam,222", "i-mid,2023-03-05,AmazonRDS,1.0,5.0,DevTeam,222"],
+    }.items():
+        path = tmp_path / f"cur-2023-{month}.csv"
+        path.write_text("\n".join([header] + rows) + "\n")
+        files[month] = str(path)
+
+    table_engine = CloudBillHunter(db_path=':memory:')
+    engine = CloudBillHunter(db_path=str(tmp_path / "warehouse.duckdb"))
+    engine.config['storage'] = {'bronze_backend': 'parquet'}
+    try:
+        for path in files.values():
+            table_engine.ingest_data(path)
+            engine.ingest_data(path)
+        table_engine.run_pipeline()
+        engine.run_pipeline()
+
+        bronze = tmp_path / "bronze"
+        assert sorted(p.relative_to(bronze).as_posix() for p in bronze.rglob("*.parquet")) == [
+            "billing_month=2023-01/account_id=111/batch_1_0.parquet",
+            "billing_month=2023-02/account_id=111/batch_2_0.parquet",
+            "billing_month=2023-02/account_id=222/batch_2_0.parquet",
+            "billing_month=2023-03/account_id=222/batch_3_0.parquet",
+        ]
+        assert _snapshot(engine, 'gold_zombie_report', 'ALL') == _snapshot(table_engine, 'gold_zombie_report', 'ALL')
+
+        # Restating January swaps its file; the old batch's partition file is gone
+        with open(files["01"], "w") as f:
+            f.write(header + "\ni-old,2023-01-05,AmazonEC2,0.0,25.0,LegacyTeam,111\n")
+        engine.ingest_data(files["01"])
+        engine.run_pipeline()
+        assert not (bronze / "billing_month=2023-01/account_id=111/batch_1_0.parquet").exists()
+        assert engine.con.execute(
+            "SELECT total_wasted_cost FROM gold_zombie_report WHERE resource_id = 'i-old'"
+        ).fetchone()[0] == 55.0
+
+        # A corrupt February file cannot matter to a March-onward scan: its partition is pruned
+        for path in (bronze / "billing_month=2023-02").rglob("*.parquet"):
+            path.write_bytes(b"not parquet")
+        recent = engine.zombie_report(since="2023-03-01").fetchall()
+        assert [r[0] for r in recent] == ['i-new']
+
+        assert engine.archive_bronze_months("2023-03") == ["2023-01", "2023-02"]
+        assert (tmp_path / "bronze_archive" / "billing_month=2023-01").is_dir()
+        assert engine.con.execute("SELECT COUNT(*) FROM bronze_billing").fetchone()[0] == 2
+    finally:
+        table_engine.close()
+        engine.close()
+
+def test_generator_is_deterministic_and_honours_zombie_probability(tmp_path, monkeypatch):
+    """Chunked generation gives the same file for any worker count, and its zombies are what Gold finds"""
+    from src import generate_data
+
+    config = generate_data.load_generation_config()
+    config.update(resources=200, zombie_probability=0.1)
+    monkeypatch.setattr(generate_data, 'load_generation_config', lambda: config)
+
+    single = generate_data.generate_billing_data(20_000, str(tmp_path / "one.csv"), chunk_rows=3_000, workers=1, seed=7)
+    parallel = generate_data.generate_billing_data(20_000, str(tmp_path / "many.csv"), chunk_rows=3_000, workers=3, seed=7)
+    with open(single, 'rb') as a, open(parallel, 'rb') as b:
+        assert a.read() == b.read()
+
+    pool = generate_data.build_resource_pool(200, 0.1, seed=7)
+    expected = set(pool['resource_id'][pool['is_zombie']])
+    assert generate_data.ZOMBIE_ID in expected and 10 <= len(expected) <= 35
+
+    engine = CloudBillHunter(db_path=':memory:')
+    try:
+        engine.ingest_data(single)
+        engine.run_pipeline()
+        assert engine.con.execute("SELECT COUNT(*) FROM bronze_billing").fetchone()[0] == 20_000
+        found = {r[0] for r in engine.con.execute("SELECT resource_id FROM gold_zombie_report").fetchall()}
+        assert found == expected
+    finally:
+        engine.close()
+
+def test_pipeline_records_stage_metrics(tmp_path):
+    """Each stage reports time, rows and scan figures; slow stages can keep their EXPLAIN ANALYZE profile"""
+    day1 = _write_csv(tmp_path, "day1.csv", ["i-zombie,2023-01-01,AmazonEC2,0.0,50.0,LegacyTeam",
+                                             "i-good,2023-01-01,AmazonEC2,10.0,10.0,DevTeam"])
+    day2 = _write_csv(tmp_path, "day2.csv", ["i-zombie,2023-01-02,AmazonEC2,0.0,50.0,LegacyTeam"])
+
+    engine = CloudBillHunter(db_path=':memory:')
+    engine.config['observability'] = {'slow_stage_seconds': 0, 'explain_slow_stages': True,
+                                      'profiles_dir': str(tmp_path / "profiles")}
+    try:
+        engine.ingest_data(day1)
+        assert [(s['layer'], s['stage'], s['rows']) for s in engine.stage_metrics] == [('bronze', 'ingest', 2)]
+
+        run = engine.run_pipeline()
+        assert run['mode'] == 'full'
+        assert [(s['stage'], s['rows']) for s in run['stages']] == [
+            ('silver_resource_keys', 2), ('silver_dim_resource', 2), ('silver_fact_usage', 2),
+            ('silver_daily_usage', 2), ('silver_resource_totals', 2), ('gold_cost_cube', 12),
+            ('gold_findings', 0), ('gold_zombie_report', 1)
+        ]
+        assert all(s['rows_scanned'] > 0 and s['spilled_bytes'] == 0 for s in run['stages'])
+
+        engine.ingest_data(day2)
+        run = engine.run_pipeline()
+        assert run['mode'] == 'incremental'
+        assert [s['rows'] for s in run['stages'][:2]] == [0, 1]
+        assert engine.run_pipeline() is None
+
+        recorded = engine.con.execute(
+            "SELECT mode, COUNT(*) FROM pipeline_metrics GROUP BY mode ORDER BY mode"
+        ).fetchall()
+        assert recorded == [('full', 8), ('incremental', 8), ('ingest', 2)]
+        profiles = os.listdir(tmp_path / "profiles")
+        assert any(p.endswith("-gold-gold_zombie_report.json") for p in profiles)
+    finally:
+        engine.close()
+
+def test_dimension_keeps_history_without_fan_out(tmp_path):
+    """
+    A re-tagged resource billed under two product codes keeps one current dimension row
+    (SCD-2 history for the owner change) and joins facts on its integer key without fan-out.
+    """
+    day1 = _write_csv(tmp_path, "day1.csv", [
+        "i-multi,2023-01-01,AmazonEC2,0.0,30.0,LegacyTeam",
+        "i-multi,2023-01-01,AWSDataTransfer,0.0,2.0,",
+    ])
+    day2 = _write_csv(tmp_path, "day2.csv", [
+        "i-multi,2023-01-02,AmazonEC2,0.0,30.0,LegacyTeam",
+        "i-multi,2023-01-03,AmazonEC2,0.0,30.0,PlatformTeam",
+        "i-multi,2023-01-03,AWSDataTransfer,0.0,2.0,",
+    ])
+
+    engine = CloudBillHunter(db_path=':memory:')
+    try:
+        engine.ingest_data(day1)
+        engine.run_pipeline()
+        engine.ingest_data(day2)
+        engine.run_pipeline()
+
+        history = engine.con.execute("""
+            SELECT service, owner_team, valid_from::VARCHAR, valid_to::VARCHAR, is_current
+            FROM silver_dim_resource ORDER BY valid_from
+        """).fetchall()
+        assert history == [
+            ('AmazonEC2', 'LegacyTeam', '2023-01-01', '2023-01-03', False),
+            ('AmazonEC2', 'PlatformTeam', '2023-01-03', None, True),
+        ]
+        key_types = engine.con.execute("""
+            SELECT DISTINCT data_type FROM information_schema.columns
+            WHERE column_name = 'resource_key' AND table_name LIKE 'silver_%'
+        """).fetchall()
+        assert key_types == [('INTEGER',)]
+
+        assert _snapshot(engine, 'gold_zombie_report', 'ALL') == [('i-multi', 'AmazonEC2', 'PlatformTeam', 94.0, date(2023, 1, 1), 3)]
+        incremental = {t: _snapshot(engine, t, 'ALL') for t in ('silver_dim_resource', 'gold_zombie_report')}
+        engine.run_pipeline(full_refresh=True)
+        for table, rows in incremental.items():
+            assert _snapshot(engine, table, 'ALL') == rows, table
+    finally:
+        engine.close()
+
+def test_idle_streaks_need_consecutive_billed_idle_days(tmp_path):
+    """
+    Resources that were used but then sat idle-but-billed for zombie_threshold_days (7)
+    consecutive days up to the latest billed day are zombies; gaps, partially used days,
+    sub-threshold costs and streaks that already ended are not.
+    """
+    def days(resource, first, last, usage, cost):
+        return [f"{resource},{date(2023, 1, 1) + timedelta(days=d)},AmazonEC2,{usage},{cost},OpsTeam"
+                for d in range(first - 1, last)]
+
+    day1_to_9 = (
+        days("i-streak", 1, 3, 5.0, 2.0) + days("i-streak", 4, 9, 0.0, 2.0)      # idle from the 4th
+        + days("i-short", 1, 4, 5.0, 2.0) + days("i-short", 5, 9, 0.0, 2.0)      # only 6 idle days
+        + days("i-gap", 1, 1, 5.0, 2.0) + days("i-gap", 2, 5, 0.0, 2.0)          # not billed on the 6th
+        + days("i-gap", 7, 9, 0.0, 2.0)
+        + days("i-partial", 1, 1, 5.0, 2.0) + days("i-partial", 2, 9, 0.0, 2.0)  # used again on the 6th
+        + days("i-partial", 6, 6, 1.0, 0.5)
+        + days("i-cheap", 1, 1, 5.0, 2.0) + days("i-cheap", 2, 9, 0.0, 0.001)    # below min_cost_threshold
+        + days("i-past", 1, 8, 0.0, 2.0) + days("i-past", 9, 9, 5.0, 2.0)        # woke up on the 9th
+        + days("i-gone", 1, 1, 5.0, 2.0) + days("i-gone", 2, 9, 0.0, 2.0)        # terminated after the 9th
+    )
+    day10 = [row for name in ("i-streak", "i-short", "i-gap", "i-partial", "i-cheap", "i-past")
+             for row in days(name, 10, 10, 5.0 if name == "i-past" else 0.0, 0.001 if name == "i-cheap" else 2.0)]
+
+    engine = CloudBillHunter(db_path=':memory:')
+    try:
+        engine.ingest_data(_write_csv(tmp_path, "jan1-9.csv", day1_to_9))
+        engine.run_pipeline()
+        gold = "SELECT resource_id, total_wasted_cost, idle_since::VARCHAR, idle_days FROM gold_zombie_report ORDER BY ALL"
+        assert engine.con.execute(gold).fetchall() == [('i-gone', 16.0, '2023-01-02', 8)]
+
+        engine.ingest_data(_write_csv(tmp_path, "jan10.csv", day10))
+        assert engine.run_pipeline()['mode'] == 'incremental'
+        assert engine.con.execute(gold).fetchall() == [('i-streak', 14.0, '2023-01-04', 7)]
+        incremental = _snapshot(engine, 'gold_zombie_report', 'ALL')
+        engine.run_pipeline(full_refresh=True)
+        assert _snapshot(engine, 'gold_zombie_report', 'ALL') == incremental
+
+        # The threshold is read from config.yaml's business_rules
+        engine.config['business_rules']['zombie_threshold_days'] = 6
+        engine.run_pipeline(full_refresh=True)
+        assert [r[0] for r in engine.con.execute(gold).fetchall()] == ['i-short', 'i-streak']
+    finally:
+        engine.close()
+
+def test_detectors_share_one_pass_and_write_unified_findings(tmp_path):
+    """
+    Cost spikes, z-score outliers, unit price rises and untagged spend all land in gold_findings,
+    each against a 9-day history; incremental runs match a full rebuild.
+    """
+    def history(resource, costs, usages, day=1):
+        return [f"{resource},{date(2023, 1, day) + timedelta(days=i)},AmazonEC2,{u},{c},OpsTeam"
+                for i, (c, u) in enumerate(zip(costs, usages))]
+
+    noisy = [20.0, 22.0] * 4 + [20.0]
+    days_1_to_9 = (
+        history("i-spike", [10.0] * 9, [10.0] * 9)
+        + history("i-noisy", noisy, noisy)
+        + history("i-price", [10.0] * 9, [10.0] * 9)
+        + history("i-steady", [10.0] * 9, [10.0] * 9)
+    )
+    day10 = (
+        history("i-spike", [50.0], [50.0], day=10)            # 5x its average: spike
+        + history("i-noisy", [35.0], [35.0], day=10)          # ~13 sigma, but under 3x: z-score only
+        + history("i-price", [15.0], [10.0], day=10)          # same usage, 1.5x the unit price
+        + history("i-steady", [10.0], [10.0], day=10)
+        + ["i-steady,2023-01-10,AWSDataTransfer,5.0,5.0,"]    # an untagged line item
+    )
+
+    engine = CloudBillHunter(db_path=':memory:')
+    try:
+        engine.ingest_data(_write_csv(tmp_path, "jan1-9.csv", days_1_to_9))
+        engine.run_pipeline()
+        assert engine.con.execute("SELECT COUNT(*) FROM gold_findings").fetchone()[0] == 0
+
+        engine.ingest_data(_write_csv(tmp_path, "jan10.csv", day10))
+        assert engine.run_pipeline()['mode'] == 'incremental'
+        findings = engine.con.execute("""
+            SELECT detector, resource_id, usage_date::VARCHAR, round(score, 2), round(impact, 2)
+            FROM gold_findings ORDER BY detector
+        """).fetchall()
+        assert findings == [
+            ('cost_spike', 'i-spike', '2023-01-10', 5.0, 40.0),
+            ('cost_zscore', 'i-noisy', '2023-01-10', 13.39, 14.11),
+            ('unit_price_rise', 'i-price', '2023-01-10', 1.5, 5.0),
+            ('untagged_spend', 'i-steady', '2023-01-10', 0.33, 5.0),
+        ]
+        incremental = _snapshot(engine, 'gold_findings', 'ALL')
+        engine.run_pipeline(full_refresh=True)
+        assert _snapshot(engine, 'gold_findings', 'ALL') == incremental
+
+        # Detectors are switched and tuned from config.yaml
+        engine.config['detectors']['rules']['untagged_spend']['enabled'] = False
+        engine.config['detectors']['rules']['cost_spike']['ratio'] = 6.0
+        engine.run_pipeline(full_refresh=True)
+        assert engine.con.execute("SELECT DISTINCT detector FROM gold_findings ORDER BY 1").fetchall() == [
+            ('cost_zscore',), ('unit_price_rise',)
+        ]
+    finally:
+        engine.close()
+
+def test_model_dag_infers_dependencies_and_selects():
+    """Dependencies come from the SQL or a depends_on header; 'model+' selects it and everything downstream"""
+    from src.model_dag import Model, build_graph, parse_model, select_models, waves
+
+    graph = build_graph([
+        parse_model("silver_a", "-- materialized: append\nSELECT * FROM bronze_billing"),
+        parse_model("silver_b", "-- primary_key: k, d\nWITH x AS (SELECT * FROM silver_a) SELECT * FROM x JOIN silver_c USING (k)"),
+        parse_model("silver_c", "SELECT * FROM main.silver_a -- FROM gold_d is only a comment"),
+        parse_model("gold_d", "-- depends_on: silver_b\nSELECT * FROM somewhere_else"),
+    ])
+    assert graph["silver_a"].materialized == "append"
+    assert graph["silver_b"].primary_key == ("k", "d")
+    assert graph["silver_b"].depends_on == ("silver_a", "silver_c")
+    assert graph["silver_c"].depends_on == ("silver_a",)
+    assert graph["gold_d"].depends_on == ("silver_b",)
+    assert waves(graph) == [["silver_a"], ["silver_c"], ["silver_b"], ["gold_d"]]
+    assert select_models(graph, "silver_c+") == {"silver_c", "silver_b", "gold_d"}
+    assert select_models(graph, "+silver_c, gold_d") == {"silver_a", "silver_c", "gold_d"}
+
+    with pytest.raises(ValueError, match="cycle"):
+        build_graph([Model("x", "SELECT * FROM y"), Model("y", "SELECT * FROM x")])
+
+def test_models_skip_when_unchanged_and_rebuild_downstream_of_a_change(tmp_path):
+    """Only models whose SQL, bound rules or inputs changed rebuild; run_models builds a selection concurrently"""
+    engine = CloudBillHunter(db_path=str(tmp_path / "dag.duckdb"))
+    try:
+        engine.ingest_data(_write_csv(tmp_path, "day1.csv", [
+            "i-zombie,2023-01-01,AmazonEC2,0.0,50.0,LegacyTeam",
+            "i-good,2023-01-01,AmazonEC2,10.0,10.0,DevTeam",
+        ]))
+        assert engine.run_pipeline()['mode'] == 'full'
+        assert engine.run_pipeline() is None
+        assert engine.run_models() == []
+
+        # A rule change only touches the models that bind it
+        engine.config['business_rules']['min_cost_threshold'] = 60.0
+        run = engine.run_pipeline()
+        assert run['mode'] == 'partial'
+        assert [s['stage'] for s in run['stages']] == ['gold_cost_cube', 'gold_findings', 'gold_zombie_report']
+        assert engine.con.execute("SELECT COUNT(*) FROM gold_zombie_report").fetchone()[0] == 0
+        engine.config['business_rules']['min_cost_threshold'] = 0.01
+
+        before = {t: _snapshot(engine, t, 'ALL') for t in ('silver_daily_usage', 'silver_resource_totals')}
+        built = engine.run_models(select="silver_daily_usage+", workers=2, force=True)
+        assert built == ['silver_daily_usage', 'silver_resource_totals', 'gold_cost_cube', 'gold_findings', 'gold_zombie_report']
+        for table, rows in before.items():
+            assert _snapshot(engine, table, 'ALL') == rows
+        assert _snapshot(engine, 'gold_zombie_report', 'resource_id')[0][0] == 'i-zombie'
+
+        engine.ingest_data(_write_csv(tmp_path, "day2.csv", ["i-good,2023-01-02,AmazonEC2,10.0,10.0,DevTeam"]))
+        with pytest.raises(ValueError, match="run_pipeline"):
+            engine.run_models(select="gold_zombie_report")
+        assert engine.run_pipeline()['mode'] == 'incremental'
+    finally:
+        engine.close()
+
+def test_gold_snapshots_are_readable_while_the_writer_holds_the_warehouse(tmp_path):
+    """Each run publishes an immutable Gold snapshot and swaps the version pointer; old ones are collected"""
+    db_path = str(tmp_path / "snap.duckdb")
+    engine = CloudBillHunter(db_path=db_path)
+    engine.config['snapshots'] = {'keep': 1}
+    try:
+        assert current_snapshot(db_path) == (0, None)
+        engine.ingest_data(_write_csv(tmp_path, "day1.csv", ["i-zombie,2023-01-01,AmazonEC2,0.0,50.0,LegacyTeam"]))
+        engine.run_pipeline()
+        version, path = current_snapshot(db_path)
+        assert version == 1
+
+        # The engine still holds the warehouse's write lock; the snapshot opens regardless
+        reader = duckdb.connect(path, read_only=True)
+        try:
+            assert {t[0] for t in reader.execute("SHOW TABLES").fetchall()} == {
+                'gold_cost_cube', 'gold_findings', 'gold_zombie_report', 'pipeline_metrics'}
+            assert reader.execute("SELECT resource_id FROM gold_zombie_report").fetchall() == [('i-zombie',)]
+
+            engine.ingest_data(_write_csv(tmp_path, "day2.csv", ["i-second,2023-01-02,AmazonEC2,0.0,5.0,OpsTeam"]))
+            engine.run_pipeline()
+            # An open reader keeps its (now collected) version
+            assert reader.execute("SELECT COUNT(*) FROM gold_zombie_report").fetchone()[0] == 1
+        finally:
+            reader.close()
+
+        version, path = current_snapshot(db_path)
+        assert version == 2
+        assert os.listdir(snapshot_dir(db_path)) == ['gold_v2.duckdb']
+        with duckdb.connect(path, read_only=True) as reader:
+            assert reader.execute("SELECT COUNT(*) FROM gold_zombie_report").fetchone()[0] == 2
+    finally:
+        engine.close()
+
+def test_a_run_committed_but_not_published_is_republished(tmp_path):
+    """A crash between commit and publish is healed on the next start (or no-op run), not by the next bill"""
+    db_path = str(tmp_path / "crash.duckdb")
+    engine = CloudBillHunter(db_path=db_path)
+    try:
+        engine.ingest_data(_write_csv(tmp_path, "day1.csv", ["i-zombie,2023-01-01,AmazonEC2,0.0,50.0,LegacyTeam"]))
+        engine.run_pipeline()
+        engine.ingest_data(_write_csv(tmp_path, "day2.csv", ["i-second,2023-01-02,AmazonEC2,0.0,5.0,OpsTeam"]))
+        publish = engine._publish_snapshot
+        engine._publish_snapshot = lambda graph: (_ for _ in ()).throw(SystemExit("killed after commit"))
+        with pytest.raises(SystemExit):
+            engine.run_pipeline()
+        assert current_snapshot(db_path)[0] == 1
+
+        # Same process: a run with nothing to do publishes the missing version
+        engine._publish_snapshot = publish
+        assert engine.run_pipeline() is None
+        assert current_snapshot(db_path)[0] == 2
+    finally:
+        engine.close()
+
+    # A restart after the same crash publishes on open, and only once
+    engine = CloudBillHunter(db_path=db_path)
+    engine.ingest_data(_write_csv(tmp_path, "day3.csv", ["i-third,2023-01-03,AmazonEC2,0.0,5.0,OpsTeam"]))
+    engine._publish_snapshot = lambda graph: (_ for _ in ()).throw(SystemExit("killed after commit"))
+    with pytest.raises(SystemExit):
+        engine.run_pipeline()
+    engine.close()
+    for _ in range(2):
+        CloudBillHunter(db_path=db_path).close()
+    version, path = current_snapshot(db_path)
+    assert version == 3
+    with duckdb.connect(path, read_only=True) as reader:
+        assert reader.execute("SELECT COUNT(*) FROM gold_zombie_report").fetchone()[0] == 3
+
+def test_scan_runs_detect_zombies_in_place_over_csv_gz_and_parquet(tmp_path):
+    """src/scan.py binds `billing` as a view over a glob of mixed files; nothing is loaded or persisted"""
+    from src import scan
+    bills = tmp_path / "bills"
+    bills.mkdir()
+    _write_csv(bills, "jan.csv", ["i-zombie,2023-01-01,AmazonEC2,0.0,50.0,LegacyTeam",
+                                  "i-good,2023-01-01,AmazonEC2,10.0,10.0,DevTeam"])
+    with gzip.open(bills / "feb.csv.gz", "wt") as f:
+        # Header in another case and order, with a column outside the ingest profile
+        f.write("lineitem/unblendedcost,LineItem/ResourceId,Extra,LineItem/UsageAmount,LineItem/UsageStartDate,"
+                "LineItem/ProductCode,ResourceTags/user:Owner\n20.0,i-zombie,x,0.0,2023-02-01,AmazonEC2,LegacyTeam\n")
+    duckdb.sql(f"""
+        COPY (SELECT 'i-parquet' as "LineItem/ResourceId", TIMESTAMP '2023-03-01' as "LineItem/UsageStartDate",
+                     'AmazonS3' as "LineItem/ProductCode", 0.0 as "LineItem/UsageAmount", 5.0 as "LineItem/UnblendedCost")
+        TO '{bills / "nested.parquet"}'
+    """)
+    with open(os.path.join(os.path.dirname(__file__), '..', 'config.yaml')) as f:
+        config = yaml.safe_load(f)
+
+    con, files = scan.open_scan([str(bills / "*.csv*"), str(tmp_path / "**" / "*.parquet")], config)
+    try:
+        assert len(files) == 3
+        assert scan.detect_zombies(con).fetchall() == [
+            ('i-zombie', 'AmazonEC2', 'LegacyTeam', 70.0, 0.0),
+            ('i-parquet', 'AmazonS3', None, 5.0, 0.0),
+        ]
+        assert con.execute("SELECT table_type FROM information_schema.tables WHERE table_name = 'billing'").fetchall() == [('VIEW',)]
+        assert scan.export(con, scan.detect_zombies(con), str(tmp_path / "zombies.parquet")) == 2
+    finally:
+        con.close()
+    assert sorted(os.listdir(tmp_path)) == ['bills', 'zombies.parquet']
+
+    with pytest.raises(FileNotFoundError):
+        scan.open_scan([str(tmp_path / "missing" / "*.csv")], config)
+
+def test_shards_run_in_parallel_and_federate_for_reads(tmp_path):
+    """Each account gets its own warehouse, built by its own process; reads ATTACH them all"""
+    from src.shards import read_source, run_shards
+    with open(os.path.join(os.path.dirname(__file__), '..', 'config.yaml')) as f:
+        config = yaml.safe_load(f)
+    config['sharding'] = {'enabled': True, 'key_column': 'LineItem/UsageAccountId', 'workers': 2}
+    config['resources']['temp_directory'] = str(tmp_path / "spill")
+    bill = tmp_path / "bill.csv"
+    bill.write_text(
+        "LineItem/ResourceId,LineItem/UsageStartDate,LineItem/ProductCode,LineItem/UsageAmount,"
+        "LineItem/UnblendedCost,ResourceTags/user:Owner,LineItem/UsageAccountId\n"
+        "i-zombie-a,2023-01-01,AmazonEC2,0.0,50.0,LegacyTeam,111111111111\n"
+        "i-good-a,2023-01-01,AmazonEC2,10.0,10.0,DevTeam,111111111111\n"
+        "i-zombie-b,2023-01-01,AmazonRDS,0.0,20.0,DataTeam,222222222222\n"
+        "i-orphan,2023-01-01,AmazonS3,0.0,5.0,,\n"
+    )
+    db_path = str(tmp_path / "main.duckdb")
+
+    summaries = run_shards([str(bill)], db_path, config)
+    assert [(s["shard"], s["error"], len(s["batches"])) for s in summaries] == [
+        ('111111111111', None, 1), ('222222222222', None, 1), ('unassigned', None, 1)]
+    assert os.path.exists(tmp_path / "main.duckdb.shards" / "111111111111" / "warehouse.duckdb")
+    # A redelivered bill is a no-op in every shard
+    assert [s["batches"] for s in run_shards([str(bill)], db_path, config, workers=1)] == [[None]] * 3
+
+    source = read_source(db_path, config)
+    version, snapshots = source.current()
+    assert version == "111111111111:1,222222222222:1,unassigned:1"
+    con = source.open(version)
+    try:
+        assert con.execute("SELECT shard, resource_id FROM gold_zombie_report ORDER BY resource_id").fetchall() == [
+            ('unassigned', 'i-orphan'), ('111111111111', 'i-zombie-a'), ('222222222222', 'i-zombie-b')]
+        assert con.execute("SELECT COUNT(DISTINCT shard) FROM pipeline_metrics").fetchone()[0] == 3
+    finally:
+        con.close()
+
+def test_compaction_dedupes_sorts_and_shrinks_bronze(tmp_path):
+    """Overlapping uploads are deduplicated; the sorted rewrite prunes a one-day scan and shrinks the file"""
+    def write_bill(name, start, stop):
+        # Days interleave (i % 10), so in arrival order every row group spans every day
+        path = str(tmp_path / name)
+        duckdb.sql(f"""
+            COPY (
+                SELECT 'i-' || (i % 5000) as "LineItem/ResourceId",
+                       DATE '2023-01-01' + CAST(i % 10 AS INTEGER) as "LineItem/UsageStartDate",
+                       'AmazonEC2' as "LineItem/ProductCode",
+                       CASE WHEN i % 5000 < 50 THEN 0.0 ELSE 1.0 END as "LineItem/UsageAmount",
+                       round(1 + (i % 89) / 10.0, 2) as "LineItem/UnblendedCost",
+                       'team-' || (i % 5000 % 7) as "ResourceTags/user:Owner"
+                FROM range({start}, {stop}) t(i)
+            ) TO '{path}' (HEADER)
+        """)
+        return path
+
+    db_path = str(tmp_path / "compact.duckdb")
+    engine = CloudBillHunter(db_path=db_path)
+    try:
+        engine.ingest_data(write_bill("full.csv", 0, 250000))
+        engine.ingest_data(write_bill("overlap.csv", 200000, 260000))  # 50k rows again, 10k new
+        engine.run_pipeline()
+
+        report = engine.compact_bronze()
+        assert (report["rows_before"], report["rows_after"], report["duplicates_removed"]) == (310000, 260000, 50000)
+        assert report["bytes_after"] < report["bytes_before"]
+        assert report["probe_rows_scanned_after"] < report["probe_rows_scanned_before"]
+        assert report["refreshed"]
+        assert engine.con.execute("SELECT COUNT(*) FROM silver_fact_usage").fetchone()[0] == 260000
+        assert current_snapshot(db_path)[0] == 2
+        zombies = "SELECT resource_id, round(total_wasted_cost, 6) FROM gold_zombie_report ORDER BY resource_id"
+        clean = CloudBillHunter(db_path=':memory:')
+        try:
+            clean.ingest_data(write_bill("deduplicated.csv", 0, 260000))
+            clean.run_pipeline()
+            assert engine.con.execute(zombies).fetchall() == clean.con.execute(zombies).fetchall()
+        finally:
+            clean.close()
+        engine.con.execute("SET threads = 1")  # scan in storage order
+        assert engine.con.execute("""
+            SELECT bool_and(ordered) FROM (
+                SELECT "LineItem/UsageStartDate" >= lag("LineItem/UsageStartDate") OVER () as ordered FROM bronze_billing
+            )
+        """).fetchone()[0]
+
+        # Already compact: nothing to drop, no rebuild
+        assert engine.compact_bronze()["refreshed"] is False
+    finally:
+        engine.close()
+
+def test_restating_the_kept_batch_restores_copies_compaction_dropped(tmp_path):
+    """A line item two sources share survives the kept source's restatement without it"""
+    for folder in ("x", "y"):
+        (tmp_path / folder).mkdir()
+    a = _write_csv(tmp_path, "x/a.csv", [
+        "i-a,2023-01-01,AmazonEC2,0.0,10.0,DevTeam",
+        "i-shared,2023-01-01,AmazonEC2,0.0,30.0,DevTeam",
+    ])
+    b = _write_csv(tmp_path, "y/b.csv", [
+        "i-shared,2023-01-01,AmazonEC2,0.0,30.0,DevTeam",
+        "i-b,2023-01-01,AmazonEC2,0.0,20.0,DevTeam",
+    ])
+    row_counts = "SELECT source, row_count FROM bronze_batches WHERE replaced_by IS NULL ORDER BY batch_id"
+
+    engine = CloudBillHunter(db_path=str(tmp_path / "restate.duckdb"))
+    try:
+        engine.ingest_data(a)
+        engine.ingest_data(b)
+        engine.run_pipeline()
+        assert engine.compact_bronze()["duplicates_removed"] == 1
+        assert engine.con.execute(row_counts).fetchall() == [('a.csv', 2), ('b.csv', 1)]
+
+        # a.csv is restated without the shared row: b.csv still bills it
+        _write_csv(tmp_path, "x/a.csv", ["i-a,2023-01-01,AmazonEC2,0.0,12.0,DevTeam"])
+        engine.ingest_data(a)
+        assert engine.con.execute(row_counts).fetchall() == [('b.csv', 2), ('a.csv', 1)]
+        engine.run_pipeline()
+        assert engine.last_run["mode"] == "full"
+        assert engine.con.execute("SELECT COUNT(*) FROM bronze_dropped_copies").fetchone()[0] == 0
+
+        zombies = "SELECT resource_id, total_wasted_cost FROM gold_zombie_report ORDER BY resource_id"
+        assert engine.con.execute(zombies).fetchall() == [('i-a', 12.0), ('i-b', 20.0), ('i-shared', 30.0)]
+        assert engine.compact_bronze()["duplicates_removed"] == 0
+    finally:
+        engine.close()
+
+def test_resource_profile_spills_a_file_larger_than_the_memory_cap(tmp_path):
+    """With config.yaml's resources capped below the input size, the pipeline completes by spilling"""
+    with open(os.path.join(os.path.dirname(__file__), '..', 'config.yaml')) as f:
+        config = yaml.safe_load(f)
+    config['resources'] = {
+        'memory_limit': '80MB', 'threads': 1,
+        'temp_directory': str(tmp_path / "spill"), 'preserve_insertion_order': False,
+    }
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(yaml.safe_dump(config))
+
+    # 900k line items over 100k ARN-named resources (~90 MB); every 20th resource never has usage
+    csv_path = str(tmp_path / "big.csv")
+    duckdb.sql(f"""
+        COPY (
+            SELECT 'arn:aws:ec2:us-east-1:123456789012:instance/i-' || lpad(CAST(i % 100000 AS VARCHAR), 17, '0')
+                       as "LineItem/ResourceId",
+                   DATE '2023-01-01' + CAST(i // 100000 AS INTEGER) as "LineItem/UsageStartDate",
+                   ['AmazonEC2', 'AmazonRDS', 'AmazonS3'][1 + i % 3] as "LineItem/ProductCode",
+                   CASE WHEN i % 20 = 0 THEN 0.0 ELSE (i % 7) * 1.5 END as "LineItem/UsageAmount",
+                   round(1 + (i % 97) / 10.0, 2) as "LineItem/UnblendedCost",
+                   'team-' || (i % 500) as "ResourceTags/user:Owner"
+            FROM range(900000) t(i)
+        ) TO '{csv_path}' (HEADER)
+    """)
+    assert os.path.getsize(csv_path) > 80 * 1024 * 1024
+
+    engine = CloudBillHunter(config_path=str(config_path), db_path=str(tmp_path / "capped.duckdb"))
+    try:
+        assert engine.con.execute("SELECT current_setting('threads')").fetchone()[0] == 1
+        engine.ingest_data(csv_path)
+        run = engine.run_pipeline()
+        assert run['mode'] == 'full'
+        assert max(s['spilled_bytes'] for s in run['stages']) > 0
+        assert engine.con.execute("SELECT COUNT(*) FROM silver_fact_usage").fetchone()[0] == 900000
+        assert engine.con.execute("SELECT COUNT(*) FROM gold_zombie_report").fetchone()[0] == 5000
+    finally:
+        engine.close()
@@ -0,0 +1,164 @@
+import os
+import sys
+
+# Ensure we can import from src
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from src.analyze_costs import CloudBillHunter
+from src.watcher import CompactionSchedule, LandingZoneBatcher, compact_warehouses, process_batch, resume_scan
+
+HEADER = "LineItem/ResourceId,LineItem/UsageStartDate,LineItem/ProductCode,LineItem/UsageAmount,LineItem/UnblendedCost,ResourceTags/user:Owner\n"
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_batcher_waits_for_complete_files_and_debounces(tmp_path):
+    """A growing file is held back; a burst of drops is released as a single batch"""
+    clock = FakeClock()
+    batcher = LandingZoneBatcher(settle_seconds=2, debounce_seconds=5, max_batch_wait_seconds=60, clock=clock)
+
+    first = tmp_path / "account-1.csv"
+    first.write_text(HEADER)
+    batcher.add(str(first))
+    batcher.add(str(tmp_path / "notes.txt"))  # not a bill
+    assert batcher.poll() == []
+
+    # Still being written: size keeps changing, so it never settles
+    for _ in range(3):
+        clock.now += 2
+        with open(first, "a") as f:
+            f.write("i-1,2023-01-01,AmazonEC2,0.0,1.0,Team\n")
+        assert batcher.poll() == []
+
+    # Second file of the burst arrives while the first settles
+    second = tmp_path / "account-2.csv"
+    second.write_text(HEADER + "i-2,2023-01-01,AmazonEC2,0.0,1.0,Team\n")
+    batcher.add(str(second))
+    clock.now += 1
+    assert batcher.poll() == []
+    clock.now += 2
+    assert batcher.poll() == []  # both settled, but arrivals were too recent
+
+    clock.now += 5
+    assert batcher.poll() == sorted([str(first), str(second)])
+    assert batcher.pending() == []
+
+def test_compaction_waits_for_a_quiet_landing_zone(tmp_path):
+    """Compaction is due only after idle_seconds without arrivals, and at most once per interval"""
+    clock = FakeClock()
+    batcher = LandingZoneBatcher(settle_seconds=2, debounce_seconds=5, max_batch_wait_seconds=60, clock=clock)
+    schedule = CompactionSchedule(idle_seconds=100, interval_seconds=1000, clock=clock)
+
+    bill = tmp_path / "account-1.csv"
+    bill.write_text(HEADER)
+    clock.now = 90
+    batcher.add(str(bill))
+    assert not schedule.due(batcher.quiet_for())  # a file is pending
+
+    assert batcher.poll() == []  # size first seen now
+    clock.now += 10
+    assert batcher.poll() == [str(bill)]
+    assert not schedule.due(batcher.quiet_for())  # arrived 10s ago
+    clock.now += 90
+    assert schedule.due(batcher.quiet_for())
+    clock.now += 500
+    assert not schedule.due(batcher.quiet_for())  # ran 500s ago
+    clock.now += 500
+    assert schedule.due(batcher.quiet_for())
+    assert not CompactionSchedule(idle_seconds=None).due(10 ** 9)
+
+def test_compaction_skips_parquet_bronze(tmp_path, caplog):
+    """Scheduled compaction leaves Parquet-backed warehouses alone instead of failing every time"""
+    import copy
+    from src.watcher import CONFIG
+
+    config = copy.deepcopy(CONFIG)
+    config['storage'] = {'bronze_backend': 'parquet'}
+    db_path = str(tmp_path / "warehouse.duckdb")
+    engine = CloudBillHunter(db_path=db_path, config=config)
+    bill = tmp_path / "bill.csv"
+    bill.write_text(HEADER + "i-1,2023-01-01,AmazonEC2,0.0,1.0,Team\n")
+    engine.ingest_data(str(bill))
+    engine.close()
+
+    assert compact_warehouses(db_path, config) == {}
+    assert not [r for r in caplog.records if r.levelname == "ERROR"]
+
+def test_batch_runs_pipeline_once_and_resume_skips_nothing(tmp_path, monkeypatch):
+    """Files are ingested together, archived after the pipeline, and a restart picks up leftovers"""
+    landing = tmp_path / "landing_zone"
+    landing.mkdir()
+    for n in range(3):
+        (landing / f"account-{n}.csv").write_text(HEADER + f"i-zombie-{n},2023-01-01,AmazonEC2,0.0,{n + 1}.0,Team\n")
+    (landing / "broken.csv").write_text("not,a,bill\n1,2,3\n")
+
+    db_path = str(tmp_path / "warehouse.duckdb")
+    runs = []
+    original = CloudBillHunter.run_pipeline
+    monkeypatch.setattr(CloudBillHunter, "run_pipeline", lambda self, **kw: runs.append(1) or original(self, **kw))
+
+    # "Restart": everything still in the landing zone is resumed
+    batcher = LandingZoneBatcher(settle_seconds=0, debounce_seconds=0)
+    resumed = resume_scan(batcher, str(landing))
+    assert len(resumed) == 4
+
+    assert batcher.poll() == []  # first look only records sizes
+    ingested = process_batch(batcher.poll(), engine_factory=lambda: CloudBillHunter(db_path=db_path))
+    assert len(ingested) == 3
+    assert runs == [1]
+    assert sorted(os.listdir(landing / "processed")) == ["account-0.csv", "account-1.csv", "account-2.csv"]
+    assert os.listdir(landing / "failed") == ["broken.csv"]
+    assert resume_scan(LandingZoneBatcher(), str(landing)) == []
+
+    engine = CloudBillHunter(db_path=db_path)
+    try:
+        assert engine.con.execute("SELECT COUNT(*) FROM gold_zombie_report").fetchone()[0] == 3
+    finally:
+        engine.close()
+
+def test_files_of_a_failed_run_are_retried_with_the_next_batch(tmp_path, monkeypatch):
+    """A failed pipeline (single warehouse or one shard) hands its files back to the batcher"""
+    import copy
+    from src.watcher import CONFIG, process_sharded_batch
+
+    original = CloudBillHunter.run_pipeline
+    calls = []
+    def fails_once(self, **kw):
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("disk full")
+        return original(self, **kw)
+    monkeypatch.setattr(CloudBillHunter, "run_pipeline", fails_once)
+
+    config = copy.deepcopy(CONFIG)
+    config['sharding'] = {'enabled': True, 'key_column': 'LineItem/UsageAccountId', 'dir': str(tmp_path / "shards")}
+    db_path = str(tmp_path / "warehouse.duckdb")
+    runs = {
+        "single": lambda batch, batcher: process_batch(batch, lambda: CloudBillHunter(db_path=db_path), batcher=batcher),
+        "sharded": lambda batch, batcher: process_sharded_batch(batch, db_path, config, workers=1, batcher=batcher),
+    }
+    for name, run in runs.items():
+        calls.clear()
+        landing = tmp_path / name
+        landing.mkdir()
+        for n in range(2):
+            (landing / f"account-{n}.csv").write_text(
+                HEADER.rstrip("\n") + ",LineItem/UsageAccountId\n" + f"i-{name}-{n},2023-01-01,AmazonEC2,0.0,1.0,Team,{n}\n")
+
+        batcher = LandingZoneBatcher(settle_seconds=0, debounce_seconds=0)
+        resume_scan(batcher, str(landing))
+        batcher.poll()
+        # The first pipeline fails: the whole batch, or only shard 0's file, goes back to the batcher
+        retried = ["account-0.csv", "account-1.csv"] if name == "single" else ["account-0.csv"]
+        done = run(batcher.poll(), batcher)
+        assert [os.path.basename(p) for p in done] == sorted(set(["account-0.csv", "account-1.csv"]) - set(retried)), name
+        assert batcher.pending() == [str(landing / f) for f in retried], name
+
+        batcher.poll()  # sizes seen again
+        assert [os.path.basename(p) for p in run(batcher.poll(), batcher)] == retried, name
+        assert sorted(os.listdir(landing / "processed")) == ["account-0.csv", "account-1.csv"]
+        assert batcher.pending() == []